@@ -0,0 +1 @@
+# Benchmarks for md2wxhtml, run from the repository root (e.g. python -m benchmarks.startup)
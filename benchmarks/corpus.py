@@ -0,0 +1,186 @@
+"""
+Synthetic corpus for the pipeline benchmark.
+
+A DocumentSpec describes a document along the dimensions that drive the cost of the
+pipeline: code blocks (count and length), list nesting, links, table size, images
+(count and resolution) and the theme. write_document renders a spec to Markdown, next to
+the images it embeds; the same spec and seed always give the same files.
+
+    python -m benchmarks.corpus OUTPUT_DIR   # write the default corpus, for inspection
+"""
+
+import argparse
+import random
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+_WORDS = (
+    "markdown converter wechat article theme inline style code block image link table list "
+    "paragraph render parse token lexer formatter cache budget quality width pipeline stage "
+    "公众号 排版 代码 高亮 图片 链接 表格 列表 段落 主题"
+).split()
+
+_LANGUAGES = ("python", "javascript", "go", "bash", "json", "rust")
+
+_CODE_LINES = {
+    "python": "def handler_{i}(request, retries={i}):\n    return {{'status': 200, 'body': request.text[:{i}]}}",
+    "javascript": "const value{i} = items.filter((x) => x.id > {i}).map((x) => `${{x.name}}`);",
+    "go": "if err := client.Do(ctx, req{i}); err != nil {{ return fmt.Errorf(\"step {i}: %w\", err) }}",
+    "bash": "for f in build/{i}/*.md; do md2wxhtml --input \"$f\" --output \"${{f%.md}}.html\"; done",
+    "json": "{{\"id\": {i}, \"name\": \"item-{i}\", \"tags\": [\"a\", \"b\"], \"ok\": true}},",
+    "rust": "let total_{i}: u64 = values.iter().filter(|v| **v > {i}).sum();",
+}
+
+
+class DocumentSpec(NamedTuple):
+    """
+    Shape of a synthetic document. Counts are per document; image_size is the
+    (width, height) of every image.
+    """
+    name: str
+    paragraphs: int = 20
+    code_blocks: int = 4
+    code_lines: int = 12
+    list_depth: int = 2
+    links: int = 10
+    table_rows: int = 8
+    table_cols: int = 4
+    images: int = 0
+    image_size: tuple = (800, 600)
+    theme: str = "default"
+
+
+class Case(NamedTuple):
+    """
+    A benchmark case: a document and the converter settings it is converted with.
+    """
+    spec: DocumentSpec
+    settings: Dict[str, object]
+
+
+def default_cases() -> List[Case]:
+    """
+    The standard corpus: a baseline document, then variants scaling one dimension each.
+    """
+    base = DocumentSpec("baseline")
+    images = {"embed_local_images": True}
+    return [
+        Case(base, {}),
+        Case(base._replace(name="code-many", code_blocks=60), {}),
+        Case(base._replace(name="code-long", code_blocks=4, code_lines=400), {}),
+        Case(base._replace(name="lists-deep", list_depth=8), {}),
+        Case(base._replace(name="links-many", links=400), {}),
+        Case(base._replace(name="table-large", table_rows=300, table_cols=8), {}),
+        Case(base._replace(name="text-long", paragraphs=600), {}),
+        Case(base._replace(name="images-many", images=24, image_size=(640, 480)), images),
+        Case(
+            base._replace(name="images-large", images=3, image_size=(4000, 3000)),
+            dict(images, image_format="webp", image_max_width=1080),
+        ),
+        Case(base._replace(name="theme-github", theme="github"), {}),
+        Case(base._replace(name="theme-dark", theme="dark"), {}),
+    ]
+
+
+def generate_markdown(spec: DocumentSpec, image_names: List[str], seed: int = 0) -> str:
+    """
+    Markdown text of a spec: sections of paragraphs interleaved with the code blocks,
+    nested list, table, links and images, spread over the document.
+    """
+    rng = random.Random(f"{seed}:{spec.name}")
+    sections: List[List[str]] = [[f"# {spec.name}"]]
+    sections_count = max(1, min(spec.paragraphs, 12))
+    for i in range(1, sections_count):
+        sections.append([f"## Section {i}"])
+
+    def place(block: str) -> None:
+        rng.choice(sections).append(block)
+
+    for _ in range(spec.paragraphs):
+        place(_sentence(rng, 30))
+    for i in range(spec.code_blocks):
+        language = _LANGUAGES[i % len(_LANGUAGES)]
+        lines = [_CODE_LINES[language].format(i=i * spec.code_lines + n) for n in range(spec.code_lines)]
+        place(f"```{language}\n" + "\n".join(lines) + "\n```")
+    if spec.list_depth:
+        place(_nested_list(rng, spec.list_depth))
+    for i in range(spec.links):
+        # Half Markdown links (numbered references), half bare URLs (autolinked)
+        url = f"https://example.com/articles/{i}?ref=bench"
+        place(f"See [{_sentence(rng, 3).rstrip('.')}]({url})." if i % 2 else f"Source: {url}")
+    if spec.table_rows and spec.table_cols:
+        place(_table(rng, spec.table_rows, spec.table_cols))
+    for name in image_names:
+        # No alt text: link numbering would take ![alt](src) for a link
+        place(f"![]({name})")
+    return "\n\n".join("\n\n".join(section) for section in sections) + "\n"
+
+
+def write_document(spec: DocumentSpec, directory: Path, seed: int = 0) -> Path:
+    """
+    Write the Markdown of a spec, and its images, into directory. Returns the Markdown file.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    image_names = []
+    for i in range(spec.images):
+        name = f"{spec.name}-{seed}-{i}.jpg"
+        path = directory / name
+        if not path.exists():
+            _write_image(path, spec.image_size, f"{seed}:{spec.name}:{i}")
+        image_names.append(name)
+    path = directory / f"{spec.name}.md"
+    path.write_text(generate_markdown(spec, image_names, seed), encoding="utf-8")
+    return path
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    text = " ".join(rng.choice(_WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + "."
+
+
+def _nested_list(rng: random.Random, depth: int) -> str:
+    lines = []
+    for level in range(depth):
+        indent = "    " * level
+        marker = "1." if level % 2 else "-"
+        for _ in range(2):
+            lines.append(f"{indent}{marker} {_sentence(rng, 6)}")
+    return "\n".join(lines)
+
+
+def _table(rng: random.Random, rows: int, cols: int) -> str:
+    lines = [
+        "| " + " | ".join(f"Column {c}" for c in range(cols)) + " |",
+        "|" + "---|" * cols,
+    ]
+    for _ in range(rows):
+        lines.append("| " + " | ".join(rng.choice(_WORDS) for _ in range(cols)) + " |")
+    return "\n".join(lines)
+
+
+def _write_image(path: Path, size: tuple, seed: str) -> None:
+    """
+    A photo-like JPEG: a smooth gradient with noise, so it neither compresses to nothing
+    nor encodes like pure noise.
+    """
+    from PIL import Image, ImageFilter
+
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.frombytes("L", size, rng.randbytes(size[0] * size[1])).filter(ImageFilter.GaussianBlur(1))
+    image = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    image.save(path, format="JPEG", quality=90)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Write the benchmark corpus.")
+    parser.add_argument("output", help="Directory to write the documents and images to.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated text (default: 0).")
+    args = parser.parse_args(argv)
+    for case in default_cases():
+        path = write_document(case.spec, Path(args.output), args.seed)
+        print(f"Wrote '{path}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Pipeline benchmark with regression tracking.
+
+Every case of the corpus (see benchmarks.corpus) is converted `repeats` times by a
+warmed converter built with collect_stats, and the stage timings of its conversion stats
+are recorded (see "Conversion Stats" in the README for the stages), along with the time
+of the whole conversion as "total". A stage that doesn't run for a case (e.g. theme_hook
+with a theme without one) counts as 0 ms.
+
+Every repetition starts with empty code and image caches, so the numbers are those of a
+first conversion in a warm process.
+
+Results (median and minimum per stage and case, in ms) are written as JSON. Given a
+baseline (results of an earlier run), a stage whose median is over the baseline's by
+more than the threshold, and by more than min_delta_ms, is a regression:
+
+    python -m benchmarks.pipeline --output results.json     # compares to baseline.json
+    python -m benchmarks.pipeline --update-baseline         # record a new baseline
+
+Exits with status 1 if there is a regression. Baselines are only comparable on the
+machine they were recorded on.
+"""
+
+import argparse
+import gc
+import json
+import platform
+import statistics
+import sys
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from md2wxhtml import WeChatConverter, __version__
+
+from .corpus import Case, default_cases, write_document
+
+# The stages of ConversionStats, in the order they run
+STAGES = (
+    "code_extraction",
+    "link_indexing",
+    "markdown",
+    "html_parse",
+    "autolink",
+    "theme_hook",
+    "list_rewrite",
+    "spacing",
+    "css_inline",
+    "images",
+    "serialize",
+    "code_highlight",
+    "merge",
+)
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+# Results format, bumped when the stages or the corpus change incompatibly
+_FORMAT = 2
+
+
+def run_case(case: Case, directory: Path, repeats: int, seed: int = 0) -> Dict[str, Any]:
+    """
+    Benchmark one case. Returns its spec, settings, sizes and per-stage timings.
+    """
+    path = write_document(case.spec, directory, seed)
+    markdown = path.read_text(encoding="utf-8")
+    settings = dict(case.settings, content_theme=case.spec.theme)
+
+    # Warm-up: loads themes, lexers and formatters
+    html = _converter(settings).convert(markdown, base_dir=directory).html
+
+    samples: Dict[str, List[float]] = {stage: [] for stage in STAGES + ("total",)}
+    for _ in range(repeats):
+        converter = _converter(settings)
+        gc.collect()
+        stats = converter.convert(markdown, base_dir=directory).stats
+        for stage in STAGES:
+            timing = stats.stages.get(stage)
+            samples[stage].append(timing.wall_ms if timing is not None else 0.0)
+        samples["total"].append(stats.wall_ms)
+
+    return {
+        "spec": case.spec._asdict(),
+        "settings": case.settings,
+        "bytes_in": len(markdown.encode("utf-8")),
+        "bytes_out": len(html.encode("utf-8")),
+        "stages": {
+            stage: {
+                "median_ms": round(statistics.median(values), 3),
+                "min_ms": round(min(values), 3),
+            }
+            for stage, values in samples.items()
+        },
+    }
+
+
+def _converter(settings: Dict[str, Any]) -> WeChatConverter:
+    # Empty caches: nothing highlighted or encoded by an earlier run is reused
+    return WeChatConverter(**settings, code_cache={}, image_cache={}, collect_stats=True)
+
+
+def compare(
+    results: Dict[str, Any],
+    baseline: Dict[str, Any],
+    threshold: float = 0.25,
+    min_delta_ms: float = 1.0,
+) -> List[str]:
+    """
+    Describe the stages whose median regressed against the baseline (cases or stages
+    missing from either side are skipped).
+    """
+    regressions = []
+    for name, case in results["cases"].items():
+        previous = baseline.get("cases", {}).get(name)
+        if previous is None:
+            continue
+        for stage, timing in case["stages"].items():
+            old = previous["stages"].get(stage)
+            if old is None:
+                continue
+            new_ms, old_ms = timing["median_ms"], old["median_ms"]
+            if new_ms > old_ms * (1 + threshold) and new_ms - old_ms > min_delta_ms:
+                regressions.append(
+                    f"{name}/{stage}: {old_ms:.2f} ms -> {new_ms:.2f} ms (+{(new_ms / old_ms - 1) * 100:.0f}%)"
+                    if old_ms else f"{name}/{stage}: 0 ms -> {new_ms:.2f} ms"
+                )
+    return regressions
+
+
+def _environment() -> Dict[str, str]:
+    from importlib.metadata import PackageNotFoundError, version
+
+    environment = {
+        "md2wxhtml": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+    }
+    for package in ("markdown", "pygments", "pillow", "lxml", "cssutils"):
+        try:
+            environment[package] = version(package)
+        except PackageNotFoundError:
+            pass
+    return environment
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Time each stage of the conversion pipeline on a synthetic corpus."
+    )
+    parser.add_argument("--repeats", type=int, default=5, help="Timed conversions per case (default: 5).")
+    parser.add_argument("--case", action="append", metavar="NAME", help="Only run this case (repeatable).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated corpus (default: 0).")
+    parser.add_argument(
+        "--corpus-dir", metavar="DIR", help="Keep the generated corpus here (default: a temporary directory)."
+    )
+    parser.add_argument("--output", metavar="PATH", help="Write the results as JSON to PATH.")
+    parser.add_argument(
+        "--baseline",
+        metavar="PATH",
+        default=str(DEFAULT_BASELINE),
+        help="Results to compare against (default: benchmarks/baseline.json, if present).",
+    )
+    parser.add_argument(
+        "--update-baseline", action="store_true", help="Write the results to the baseline instead of comparing."
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        metavar="FRACTION",
+        help="Slowdown of a stage's median over the baseline counted as a regression (default: 0.25).",
+    )
+    parser.add_argument(
+        "--min-delta-ms",
+        type=float,
+        default=1.0,
+        metavar="MS",
+        help="Ignore slowdowns smaller than this, which are mostly noise (default: 1.0).",
+    )
+    args = parser.parse_args(argv)
+
+    cases = [case for case in default_cases() if not args.case or case.spec.name in args.case]
+    if not cases:
+        print(f"Error: No such case: {', '.join(args.case)}")
+        return 2
+
+    temporary = None
+    if args.corpus_dir:
+        directory = Path(args.corpus_dir)
+    else:
+        temporary = tempfile.TemporaryDirectory(prefix="md2wxhtml-bench-")
+        directory = Path(temporary.name)
+
+    results = {
+        "format": _FORMAT,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": _environment(),
+        "repeats": args.repeats,
+        "seed": args.seed,
+        "cases": {},
+    }
+    width = max(len(stage) for stage in STAGES) + 2
+    try:
+        print(f"{'case':<14}" + "".join(f"{stage:>{width}}" for stage in STAGES + ("total",)) + "   (median ms)")
+        for case in cases:
+            result = run_case(case, directory, args.repeats, args.seed)
+            results["cases"][case.spec.name] = result
+            print(
+                f"{case.spec.name:<14}"
+                + "".join(
+                    f"{result['stages'][stage]['median_ms']:>{width}.2f}" for stage in STAGES + ("total",)
+                )
+            )
+    finally:
+        if temporary is not None:
+            temporary.cleanup()
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+    baseline_path = Path(args.baseline)
+    if args.update_baseline:
+        baseline_path.write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+        print(f"\nBaseline written to '{baseline_path}'")
+        return 0
+    if not baseline_path.exists():
+        print(f"\nNo baseline at '{baseline_path}' to compare with.")
+        return 0
+
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+    if baseline.get("format") != _FORMAT or baseline.get("seed") != args.seed:
+        print(f"\nBaseline '{baseline_path}' was recorded with another corpus; not comparing.")
+        return 0
+    regressions = compare(results, baseline, args.threshold, args.min_delta_ms)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) against '{baseline_path}':")
+        for regression in regressions:
+            print(f"  - {regression}")
+        return 1
+    print(f"\nNo regression against '{baseline_path}'.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Scaling benchmark for the post-processing stages of process_html_tree.
+
+A stage is timed on documents of growing size (the number of items it works on doubling
+each time), parsed afresh for every run. The time per item should stay flat; the stage
+fails when the time per item on the largest document is more than --max-growth times the
+one on the smallest.
+
+    python -m benchmarks.scaling                     # every stage, 250 to 8000 items
+    python -m benchmarks.scaling --stage lists --sizes 500 1000 2000
+
+Exits with status 1 if a stage fails.
+"""
+
+import argparse
+import gc
+import sys
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from md2wxhtml.processors import content_processor
+from md2wxhtml.processors.content_processor import MARKDOWN_EXTENSIONS, parse_html
+
+
+class Stage(NamedTuple):
+    """
+    A stage to benchmark: the function run on the content container, and the Markdown of
+    a document with a given number of items for it.
+    """
+    run: Callable[[object], None]
+    document: Callable[[int], str]
+
+
+def _changelog(items: int) -> str:
+    # Sections of bulleted items, some with a nested ordered list, as in a changelog
+    lines = []
+    for section in range(max(1, items // 50)):
+        lines.append(f"## Version 1.{section}\n")
+        for i in range(min(50, items - section * 50)):
+            lines.append(f"- Change {i}：details with **bold** text and `code` {i}")
+            if i % 5 == 0:
+                lines.append(f"    1. Nested note {i}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def _bibliography(items: int) -> str:
+    # Link-dense text: references as consecutive lines of one paragraph (each a bare URL),
+    # then release notes with a URL per item and plain paragraphs without any
+    references = "\n".join(
+        f"[{i}] Author {i}. Title of work {i}. https://example.org/papers/{i}.pdf" for i in range(items // 2)
+    )
+    notes = "\n".join(
+        f"- Fix {i} (see www.example.com/issues/{i}) with **details**\n\n  Plain paragraph {i} without links."
+        for i in range(items - items // 2)
+    )
+    return f"# References\n\n{references}\n\n# Release notes\n\n{notes}\n"
+
+
+STAGES: Dict[str, Stage] = {
+    "lists": Stage(content_processor._lists_to_paragraphs, _changelog),
+    "autolink": Stage(content_processor._auto_link_urls, _bibliography),
+}
+
+
+def time_stage(stage: Stage, items: int, repeats: int) -> float:
+    """
+    Best time of stage on a document of items items, in seconds.
+    """
+    import markdown
+
+    html = markdown.markdown(stage.document(items), extensions=MARKDOWN_EXTENSIONS)
+    best = float("inf")
+    for _ in range(repeats):
+        container = parse_html('<div class="wechat-content">' + html + '</div>').getroot().find("body/div")
+        gc.collect()
+        start = time.perf_counter()
+        stage.run(container)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Check that post-processing stages scale linearly.")
+    parser.add_argument("--stage", action="append", choices=sorted(STAGES), help="Only run this stage (repeatable).")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[250, 500, 1000, 2000, 4000, 8000], metavar="N",
+        help="Numbers of items of the documents (default: 250 to 8000).",
+    )
+    parser.add_argument("--repeats", type=int, default=5, help="Runs per size, the best is kept (default: 5).")
+    parser.add_argument(
+        "--max-growth", type=float, default=2.0, metavar="RATIO",
+        help="Largest allowed ratio between the time per item on the largest and smallest documents (default: 2).",
+    )
+    args = parser.parse_args(argv)
+
+    sizes = sorted(args.sizes)
+    failed = []
+    print(f"{'stage':<10}" + "".join(f"{size:>10}" for size in sizes) + "    growth   (us per item)")
+    for name in args.stage or sorted(STAGES):
+        per_item = [time_stage(STAGES[name], size, args.repeats) / size * 1e6 for size in sizes]
+        growth = per_item[-1] / per_item[0]
+        print(f"{name:<10}" + "".join(f"{value:>10.1f}" for value in per_item) + f"{growth:>9.2f}x")
+        if growth > args.max_growth:
+            failed.append(name)
+
+    if failed:
+        print(f"\nSuperlinear: {', '.join(failed)} (time per item grew more than {args.max_growth}x).")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+Startup-time benchmark.
+
+Each scenario runs in a fresh interpreter, which times itself from its first import of
+md2wxhtml (interpreter startup excluded) and reports the modules it ended up loading.
+A scenario fails when its best time is over its target, or when it loads a dependency
+it has no use for (e.g. Pillow for a document without images), so a stray top-level
+import is caught even on a machine fast enough to hide it.
+
+    python -m benchmarks.startup [--runs N] [--slack FACTOR]
+
+Exits with status 1 if any scenario fails.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Heavy dependencies, by top-level module name
+HEAVY = ("markdown", "lxml", "cssutils", "pygments", "PIL", "bs4", "premailer", "requests")
+
+_TEXT_DOCUMENT = "# Title\n\nA paragraph with a https://example.com link.\n\n- one\n- two\n"
+_CODE_DOCUMENT = "# Title\n\n```python\nprint('hello')\n```\n"
+
+# Runs in the child: time `code`, then print the elapsed time and the loaded modules
+_HARNESS = """
+import json, sys, time
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"ms": elapsed * 1000, "modules": sorted({{m.split(".")[0] for m in sys.modules}})}}))
+"""
+
+
+class Scenario(NamedTuple):
+    name: str
+    code: str
+    target_ms: float
+    # Heavy dependencies the scenario may load
+    allowed: tuple = ()
+
+
+SCENARIOS = [
+    Scenario("import md2wxhtml", "import md2wxhtml", 25),
+    Scenario(
+        "md2wxhtml --help",
+        "import contextlib, io\n"
+        "from md2wxhtml.main import main\n"
+        "sys.argv = ['md2wxhtml', '--help']\n"
+        "with contextlib.redirect_stdout(io.StringIO()), contextlib.suppress(SystemExit):\n"
+        "    main()",
+        50,
+    ),
+    Scenario(
+        "first conversion, text",
+        "from md2wxhtml import WeChatConverter\n"
+        f"WeChatConverter().convert({_TEXT_DOCUMENT!r})",
+        600,
+        # codehilite, which imports Pygments, is only loaded for documents with code
+        allowed=("markdown", "lxml", "cssutils"),
+    ),
+    Scenario(
+        "first conversion, code",
+        "from md2wxhtml import WeChatConverter\n"
+        f"WeChatConverter().convert({_CODE_DOCUMENT!r})",
+        700,
+        allowed=("markdown", "lxml", "cssutils", "pygments"),
+    ),
+]
+
+
+class Measurement(NamedTuple):
+    best_ms: float
+    median_ms: float
+    unexpected: List[str]
+
+
+def measure(scenario: Scenario, runs: int) -> Measurement:
+    """
+    Run a scenario `runs` times, each in a new interpreter.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(ROOT), env.get("PYTHONPATH")]))
+    times = []
+    loaded = set()
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", _HARNESS.format(code=scenario.code)],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        report = json.loads(output.strip().splitlines()[-1])
+        times.append(report["ms"])
+        loaded.update(report["modules"])
+    times.sort()
+    unexpected = sorted(name for name in HEAVY if name in loaded and name not in scenario.allowed)
+    return Measurement(times[0], times[len(times) // 2], unexpected)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Check md2wxhtml startup times against their targets.")
+    parser.add_argument("--runs", type=int, default=5, help="Interpreters started per scenario (default: 5).")
+    parser.add_argument(
+        "--slack",
+        type=float,
+        default=1.0,
+        metavar="FACTOR",
+        help="Multiply every target by FACTOR, for slow machines (default: 1.0).",
+    )
+    args = parser.parse_args(argv)
+
+    failed = 0
+    print(f"{'scenario':<26} {'best':>9} {'median':>9} {'target':>9}")
+    for scenario in SCENARIOS:
+        result = measure(scenario, args.runs)
+        target = scenario.target_ms * args.slack
+        problems = []
+        if result.best_ms > target:
+            problems.append("over target")
+        if result.unexpected:
+            problems.append("loaded " + ", ".join(result.unexpected))
+        failed += bool(problems)
+        print(
+            f"{scenario.name:<26} {result.best_ms:7.1f}ms {result.median_ms:7.1f}ms {target:7.0f}ms"
+            + (f"  FAIL: {'; '.join(problems)}" if problems else "")
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,44 @@
-from .core.converter import WeChatConverter
-from .models.code_block import ConversionResult, CodeBlock, ProcessingContext
+from typing import TYPE_CHECKING
+
+from .models.code_block import (
+    ChangedRange, ConversionResult, ConversionStats, CodeBlock, ProcessingContext, StageStats,
+)
 
 __version__ = "0.1.13"
 
 __all__ = [
     'WeChatConverter',
+    'IncrementalConverter',
+    'ChangedRange',
     'CodeBlock',
     'ProcessingContext',
     'ConversionResult',
+    'ConversionStats',
+    'StageStats',
 ]
+
+# The converters are imported on first access, so importing the package (e.g. for
+# __version__ or the CLI's --help) doesn't load Markdown, lxml and the processors
+_lazy_exports = {
+    'WeChatConverter': '.core.converter',
+    'IncrementalConverter': '.core.incremental',
+}
+
+if TYPE_CHECKING:
+    from .core.converter import WeChatConverter
+    from .core.incremental import IncrementalConverter
+
+
+def __getattr__(name):
+    module = _lazy_exports.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_exports))
@@ -1,11 +1,52 @@
-from typing import Optional
+import tempfile
+from concurrent.futures import Executor, as_completed as futures_as_completed
+from contextlib import nullcontext
+from typing import (
+    TYPE_CHECKING, Any, AsyncContextManager, Dict, Iterable, Iterator, List, MutableMapping,
+    Optional, Sequence, TextIO, Tuple, Union,
+)
 from pathlib import Path
 from .markdown_parser import extract_code_blocks
-from ..processors.content_processor import process_content
-from ..processors.code_processor import process_code_block
-from ..processors.image_processor import process_images
+from .merger import merge_content_and_code
+from ..processors.content_processor import process_content_tree, serialize_html
+from ..processors.code_processor import (
+    code_block_cache_key,
+    preload_code_highlighting,
+    process_code_block,
+)
+from ..processors.image_processor import (
+    DEFAULT_IMAGE_MEMORY,
+    FetchImages,
+    image_content_hash,
+    is_outside_base_dir,
+    is_remote_image,
+    process_images_tree,
+    resolve_image_path,
+)
 from ..processors.link_processor import md_links_to_index
-from ..models.code_block import ConversionResult
+from ..models.code_block import CodeBlock, ConversionResult
+from ..utils.code_cache import CodeBlockCache
+from ..utils.image_cache import ImageCache
+from ..utils.instrumentation import Recorder, StageHook, count, measure
+
+# Loaded only by converters that fetch remote images (it imports http.client and ssl)
+if TYPE_CHECKING:
+    from ..utils.image_fetcher import ImageFetcher
+
+# A document for convert_many: Markdown text, or (markdown, base_dir)
+Document = Union[str, Tuple[str, Optional[Path]]]
+
+# Small document touching every stage, used to warm up a converter
+_WARM_UP_MARKDOWN = """# Warm up
+
+A paragraph with a https://example.com link and a [reference](https://example.com).
+
+- item：detail
+
+```python
+print("warm up")
+```
+"""
 
 
 # Main orchestrator for the conversion process
@@ -18,6 +59,21 @@ class WeChatConverter:
         image_format: Optional[str] = None,
         image_quality: int = 85,
         image_max_width: Optional[int] = None,
+        code_cache: Optional[MutableMapping[str, str]] = None,
+        image_cache: Optional[MutableMapping[str, str]] = None,
+        code_cache_dir: Optional[Path] = None,
+        image_workers: Optional[int] = None,
+        image_memory: int = DEFAULT_IMAGE_MEMORY,
+        image_cache_dir: Optional[Path] = None,
+        image_max_bytes: Optional[int] = None,
+        image_total_bytes: Optional[int] = None,
+        fetch_remote_images: bool = False,
+        remote_image_dir: Optional[Path] = None,
+        image_fetcher: Optional["ImageFetcher"] = None,
+        confine_images: bool = False,
+        collect_stats: bool = False,
+        trace_memory: bool = False,
+        stage_hooks: Sequence[StageHook] = (),
     ):
         self.content_theme = content_theme
         self.code_theme = code_theme
@@ -25,39 +81,343 @@ class WeChatConverter:
         self.image_format = image_format
         self.image_quality = image_quality
         self.image_max_width = image_max_width
+        # Optional size budgets (bytes) for each embedded image and for all of a document's
+        self.image_max_bytes = image_max_bytes
+        self.image_total_bytes = image_total_bytes
+        # Threads encoding the images of a document, and the budget for their decoded pixels
+        self.image_workers = image_workers
+        self.image_memory = image_memory
+        # Dict-like stores for highlighted code blocks and embedded image data URIs; both
+        # default to LRU caches, persisted in code_cache_dir/image_cache_dir if given
+        self.code_cache_dir = code_cache_dir
+        self.code_cache = code_cache if code_cache is not None else CodeBlockCache(directory=code_cache_dir)
+        self.image_cache_dir = image_cache_dir
+        self.image_cache = image_cache if image_cache is not None else ImageCache(directory=image_cache_dir)
+        # With embed_local_images, also download http(s):// images (kept in remote_image_dir,
+        # or a temporary directory) and embed them; passing image_fetcher implies it
+        self.fetch_remote_images = fetch_remote_images or image_fetcher is not None
+        self.remote_image_dir = remote_image_dir
+        if image_fetcher is None and fetch_remote_images:
+            from ..utils.image_fetcher import ImageFetcher
+
+            image_fetcher = ImageFetcher(directory=remote_image_dir)
+        self.image_fetcher = image_fetcher
+        # With confine_images, local images outside the base directory of a conversion are
+        # not embedded but reported as errors (for documents from untrusted sources)
+        self.confine_images = confine_images
+        # With collect_stats, convert and convert_async time each stage and set result.stats
+        # (trace_memory also records peak memory, see utils.instrumentation); stage_hooks
+        # are called after every stage and imply collect_stats
+        self.collect_stats = collect_stats or bool(stage_hooks)
+        self.trace_memory = trace_memory
+        self.stage_hooks = tuple(stage_hooks)
+
+    def settings(self) -> Dict[str, Any]:
+        """
+        Return the constructor arguments of this converter (used to rebuild it in worker processes).
+        Stage hooks are left out: functions can't be sent to other processes in general.
+        """
+        return {
+            "content_theme": self.content_theme,
+            "code_theme": self.code_theme,
+            "embed_local_images": self.embed_local_images,
+            "image_format": self.image_format,
+            "image_quality": self.image_quality,
+            "image_max_width": self.image_max_width,
+            "image_max_bytes": self.image_max_bytes,
+            "image_total_bytes": self.image_total_bytes,
+            "code_cache_dir": self.code_cache_dir,
+            "image_workers": self.image_workers,
+            "image_memory": self.image_memory,
+            "image_cache_dir": self.image_cache_dir,
+            "fetch_remote_images": self.fetch_remote_images,
+            "remote_image_dir": self.remote_image_dir,
+            "confine_images": self.confine_images,
+            "collect_stats": self.collect_stats,
+            "trace_memory": self.trace_memory,
+        }
+
+    def warm_up(self, languages: Iterable[str] = ()) -> None:
+        """
+        Run a tiny document through the pipeline so themes, lexers and formatters are loaded.
+
+        Args:
+            languages: Code block languages to load the lexers for as well
+        """
+        preload_code_highlighting(languages, [self.code_theme])
+        self.convert(_WARM_UP_MARKDOWN)
 
     def convert(self, markdown: str, base_dir: Optional[Path] = None) -> ConversionResult:
+        recorder = self._recorder()
+        with recorder if recorder is not None else nullcontext():
+            code_blocks, links, content_tree = self._parse(markdown, recorder)
+            fetch = self.image_fetcher.fetch_all if self.image_fetcher is not None else None
+            image_results = self._embed_images(content_tree, base_dir, fetch, recorder)
+            return self._assemble(content_tree, code_blocks, links, *image_results, recorder)
+
+    async def convert_async(
+        self,
+        markdown: str,
+        base_dir: Optional[Path] = None,
+        executor: Optional[Executor] = None,
+        limiter: Optional[AsyncContextManager] = None,
+    ) -> ConversionResult:
+        """
+        Convert without blocking the event loop. The stages of convert (parsing, image
+        embedding, highlighting and merging) run one after the other in executor, and the
+        images of the document are read, and fetched, concurrently in between.
+
+        Args:
+            markdown: Markdown text
+            base_dir: Base directory for relative image paths
+            executor: Thread pool running the stages (default: the loop's default executor)
+            limiter: Optional async context manager held for the whole conversion, e.g. an
+                asyncio.Semaphore shared by the callers to bound concurrent conversions
+
+        Cancelling the task stops the conversion when the running stage is done; image
+        reads that have not started are dropped.
+        """
+        # Only callers running an event loop need asyncio, and they have imported it already
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        async with limiter if limiter is not None else nullcontext():
+            recorder = self._recorder()
+            with recorder if recorder is not None else nullcontext():
+                code_blocks, links, content_tree = await loop.run_in_executor(
+                    executor, self._parse, markdown, recorder
+                )
+                fetch = None
+                if self.embed_local_images:
+                    fetch = await self._read_images_async(content_tree, base_dir, executor)
+                image_results = await loop.run_in_executor(
+                    executor, self._embed_images, content_tree, base_dir, fetch, recorder
+                )
+                return await loop.run_in_executor(
+                    executor, self._assemble, content_tree, code_blocks, links, *image_results, recorder
+                )
+
+    def convert_to_stream(
+        self,
+        src: Union[str, TextIO],
+        fileobj: TextIO,
+        base_dir: Optional[Path] = None,
+    ) -> ConversionResult:
+        """
+        Convert a document section by section, writing the HTML to fileobj as it goes.
+
+        The output is the same as convert's, but memory is bounded by the largest top-level
+        sections rather than the whole output (see IncrementalConverter.convert_to_stream).
+        The Markdown (src: text or a text file object) is read whole, since code blocks
+        are extracted and links numbered across the document.
+
+        Returns the result without html, code_blocks and stats.
+        """
+        # Imported here: the incremental converter is built on this module
+        from .incremental import IncrementalConverter
+
+        markdown = src if isinstance(src, str) else src.read()
+        return IncrementalConverter(self).convert_to_stream(markdown, fileobj, base_dir=base_dir)
+
+    def _recorder(self) -> Optional[Recorder]:
+        if not self.collect_stats:
+            return None
+        return Recorder(trace_memory=self.trace_memory, hooks=self.stage_hooks)
+
+    def _parse(
+        self, markdown: str, recorder: Optional[Recorder] = None
+    ) -> Tuple[List[CodeBlock], Dict[str, Tuple[int, str]], Any]:
+        if recorder is not None:
+            recorder.count("bytes_in", len(markdown.encode("utf-8")))
         # 1. Extract code blocks
-        clean_md, code_blocks, placeholder_map = extract_code_blocks(markdown)
+        with measure(recorder, "code_extraction"):
+            clean_md, code_blocks, _ = extract_code_blocks(markdown)
         # 2. Convert links to numbered references
-        clean_md, links = md_links_to_index(clean_md)
-        # 3. Process general content
-        html_with_placeholders = process_content(clean_md, theme=self.content_theme)
-        # 4. Process code blocks
-        code_html_map = {}
-        for cb in code_blocks:
-            code_html_map[cb.placeholder] = process_code_block(cb, theme=self.code_theme)
-        # 5. Merge components
-        for placeholder, code_html in code_html_map.items():
-            html_with_placeholders = html_with_placeholders.replace(placeholder, code_html)
-        all_warnings = []
-        all_errors = []
-        if self.embed_local_images:
-            html_with_placeholders, img_warnings, img_errors = process_images(
-                html_with_placeholders,
-                embed_images=True,
+        with measure(recorder, "link_indexing"):
+            clean_md, links = md_links_to_index(clean_md)
+        count(recorder, "code_blocks", len(code_blocks))
+        count(recorder, "links", len(links))
+        # 3. Process general content (parsed once into a tree that later stages modify in place)
+        content_tree = process_content_tree(clean_md, theme=self.content_theme, recorder=recorder)
+        return code_blocks, links, content_tree
+
+    def _embed_images(
+        self,
+        content_tree,
+        base_dir: Optional[Path],
+        fetch: Optional[FetchImages],
+        recorder: Optional[Recorder] = None,
+    ) -> Tuple[List[str], List[str], Dict[str, int]]:
+        """
+        Embed the images of the content tree in place. Returns (warnings, errors, image_sizes).
+        """
+        image_sizes: Dict[str, int] = {}
+        if not self.embed_local_images:
+            return [], [], image_sizes
+        with measure(recorder, "images"):
+            warnings, errors = process_images_tree(
+                content_tree,
                 image_format=self.image_format,
                 image_quality=self.image_quality,
                 max_width=self.image_max_width,
                 base_dir=base_dir,
+                cache=self.image_cache,
+                workers=self.image_workers,
+                max_pixel_bytes=self.image_memory,
+                max_bytes=self.image_max_bytes,
+                total_bytes=self.image_total_bytes,
+                sizes=image_sizes,
+                fetch=fetch,
+                recorder=recorder,
+                confine=self.confine_images,
             )
-            all_warnings.extend(img_warnings)
-            all_errors.extend(img_errors)
+        return warnings, errors, image_sizes
+
+    async def _read_images_async(
+        self, content_tree, base_dir: Optional[Path], executor: Optional[Executor]
+    ) -> Optional[FetchImages]:
+        """
+        Hash the local images of the content tree (so image_cache_key does not read them
+        again) and fetch its remote images, concurrently in executor. Returns the fetch
+        function serving the downloads to the image stage, if remote images are fetched.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        sources = [img.get("src") for img in content_tree.iter("img") if img.get("src")]
+        if self.confine_images:
+            sources = [src for src in sources if not is_outside_base_dir(src, base_dir)]
+        paths = {resolve_image_path(src, base_dir) for src in sources} - {None}
+        reads = [loop.run_in_executor(executor, image_content_hash, path) for path in paths]
+        urls = []
+        if self.image_fetcher is not None:
+            urls = [src for src in sources if is_remote_image(src)]
+        if urls:
+            reads.append(loop.run_in_executor(executor, self.image_fetcher.fetch_all, urls))
+        # Missing and unreadable files are reported by the image stage
+        results = await asyncio.gather(*reads, return_exceptions=True)
+        if not urls:
+            return None
+        remote = results[-1]
+        if isinstance(remote, BaseException):
+            raise remote
+        return lambda requested: {url: remote[url] for url in requested}
+
+    def _assemble(
+        self,
+        content_tree,
+        code_blocks: List[CodeBlock],
+        links: Dict[str, Tuple[int, str]],
+        warnings: List[str],
+        errors: List[str],
+        image_sizes: Dict[str, int],
+        recorder: Optional[Recorder] = None,
+    ) -> ConversionResult:
+        with measure(recorder, "serialize"):
+            html_with_placeholders = serialize_html(content_tree)
+        # 4. Process code blocks
+        code_html_map = {}
+        for cb in code_blocks:
+            with measure(recorder, "code_highlight"):
+                code_html_map[cb.placeholder] = self._highlight(cb, recorder)
+        # 5. Merge components
+        with measure(recorder, "merge"):
+            html = merge_content_and_code(html_with_placeholders, code_html_map)
+        if recorder is not None:
+            recorder.count("bytes_out", len(html.encode("utf-8")))
         return ConversionResult(
-            html=html_with_placeholders,
+            html=html,
             code_blocks=code_html_map,
-            success=len(all_errors) == 0,
-            errors=all_errors,
-            warnings=all_warnings,
+            success=len(errors) == 0,
+            errors=errors,
+            warnings=warnings,
             links=links,
+            image_sizes=image_sizes,
+            stats=recorder.stats if recorder is not None else None,
         )
+
+    def _highlight(self, code_block, recorder: Optional[Recorder] = None) -> str:
+        if self.code_cache is None:
+            return process_code_block(code_block, theme=self.code_theme)
+        key = code_block_cache_key(code_block, self.code_theme)
+        code_html = self.code_cache.get(key)
+        if code_html is None:
+            code_html = process_code_block(code_block, theme=self.code_theme)
+            self.code_cache[key] = code_html
+        else:
+            count(recorder, "code_cache_hits")
+        return code_html
+
+    def convert_many(
+        self,
+        docs: Iterable[Document],
+        workers: Optional[int] = None,
+        as_completed: bool = False,
+    ) -> Iterator[Union[ConversionResult, Tuple[int, ConversionResult]]]:
+        """
+        Convert many documents on a process pool.
+
+        Args:
+            docs: Markdown strings, or (markdown, base_dir) tuples
+            workers: Number of worker processes (default: os.cpu_count()). With 1, documents
+                are converted in this process.
+            as_completed: Yield (index, result) pairs as soon as each document is done instead
+                of results in input order
+
+        Each worker builds its converter from settings() once and warms it up. The largest
+        documents are submitted first so a long one doesn't end up running last on its own.
+        Without an image_cache_dir (or remote_image_dir), the workers share encoded (or
+        downloaded) images through a temporary one, so an image used by several documents
+        is encoded (or downloaded) once.
+        """
+        jobs = [(doc, None) if isinstance(doc, str) else (doc[0], doc[1]) for doc in docs]
+        if workers == 1 or len(jobs) <= 1:
+            for index, (markdown, base_dir) in enumerate(jobs):
+                result = self.convert(markdown, base_dir=base_dir)
+                yield (index, result) if as_completed else result
+            return
+
+        settings = self.settings()
+        shared_images = None
+        share_cache = self.image_cache_dir is None
+        share_downloads = self.fetch_remote_images and self.remote_image_dir is None
+        if self.embed_local_images and (share_cache or share_downloads):
+            shared_images = tempfile.TemporaryDirectory(prefix="md2wxhtml-images-")
+            if share_cache:
+                settings["image_cache_dir"] = Path(shared_images.name) / "cache"
+            if share_downloads:
+                settings["remote_image_dir"] = Path(shared_images.name) / "remote"
+        # multiprocessing is only needed by batch conversions
+        from concurrent.futures import ProcessPoolExecutor
+
+        pool = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(settings,)
+        )
+        try:
+            by_size = sorted(range(len(jobs)), key=lambda i: len(jobs[i][0]), reverse=True)
+            futures = {i: pool.submit(_convert_in_worker, *jobs[i]) for i in by_size}
+            if as_completed:
+                index_of = {future: i for i, future in futures.items()}
+                for future in futures_as_completed(index_of):
+                    yield index_of[future], future.result()
+            else:
+                for i in range(len(jobs)):
+                    yield futures[i].result()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            if shared_images is not None:
+                shared_images.cleanup()
+
+
+# Per-process converter used by convert_many workers
+_worker_converter: Optional[WeChatConverter] = None
+
+
+def _init_worker(settings: Dict[str, Any]) -> None:
+    global _worker_converter
+    _worker_converter = WeChatConverter(**settings)
+    _worker_converter.warm_up()
+
+
+def _convert_in_worker(markdown: str, base_dir: Optional[Path]) -> ConversionResult:
+    return _worker_converter.convert(markdown, base_dir=base_dir)
@@ -0,0 +1,691 @@
+"""
+Incremental conversion: render a document block by block and reuse the blocks that did
+not change since the previous conversion.
+
+The Markdown is split into top-level blocks at blank lines that the Markdown renderer
+never joins across (lists, block quotes, indented continuations, fences and open HTML
+blocks stay in one block). Each block is rendered through the regular pipeline and its
+final HTML, code blocks included, is cached under a hash of its text and everything else
+its output depends on: the theme stylesheet, the code theme, the image options and the
+images it embeds (remote ones are revalidated once per conversion), what kind of content surrounds it (``:first-child``/``:last-child``
+rules) and the heading ids taken by the blocks before it. The document is the themed
+container with the block fragments joined inside, identical to WeChatConverter.convert.
+Documents that cannot be split this way are converted as a whole.
+
+The same rendering also streams large documents: convert_to_stream writes the fragments
+as they are done instead of joining them.
+"""
+
+import difflib
+import hashlib
+import re
+from pathlib import Path
+from typing import (
+    Dict, FrozenSet, List, Mapping, NamedTuple, Optional, Sequence, Set, TextIO, Tuple, Union,
+)
+
+import markdown
+from lxml import etree
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
+
+from .converter import WeChatConverter
+from .markdown_parser import extract_code_blocks
+from .merger import find_placeholders, merge_content_and_code
+from ..models.code_block import ChangedRange, ConversionResult
+from ..processors.content_processor import (
+    MARKDOWN_EXTENSIONS,
+    get_theme_css,
+    get_theme_module,
+    process_html_tree,
+    serialize_contents,
+    serialize_html,
+)
+from ..processors.image_processor import (
+    find_local_images,
+    find_remote_images,
+    process_images_tree,
+)
+from ..processors.link_processor import md_links_to_index
+from ..utils.placeholder_manager import PLACEHOLDER_PATTERN
+
+# Stand-ins for the neighbouring blocks while a block is styled alone: an element if the
+# neighbours contain elements (so :first-child/:last-child rules see a sibling), a comment
+# if they only contain text such as an unwrapped code block placeholder
+_BOUNDARY_NAME = "md2wxhtml-block-boundary"
+_BOUNDARIES = {
+    "element": f'<hr class="{_BOUNDARY_NAME}">',
+    "text": f"<!--{_BOUNDARY_NAME}-->",
+}
+
+_blank_line = re.compile(r"^[ \t\r]*$")
+_list_item = re.compile(r"^[ ]{0,3}(?:[*+-]|\d+\.)[ ]+")
+_block_quote = re.compile(r"^[ ]{0,3}>", re.MULTILINE)
+_fence = re.compile(r"^(`{3,}|~{3,})")
+_code_span = re.compile(r"`[^`\n]*`")
+_html_tag = re.compile(r"<(/?)([A-Za-z][\w-]*)[^<>]*?(/?)>")
+_html_void_tags = frozenset({
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param",
+    "source", "track", "wbr",
+})
+_header_tags = ("h1", "h2", "h3", "h4", "h5", "h6")
+# Blocks expected to render to text only (no element in the container)
+_text_only_block = re.compile(
+    rf"^\s*(?:(?:{PLACEHOLDER_PATTERN.pattern}|<!--.*?-->)\s*)+$", re.DOTALL
+)
+
+# Documents whose rendering is not local to blocks are always converted as a whole:
+# a [TOC] marker, reference-style link definitions and embedded stylesheets
+_whole_document = re.compile(
+    r"\[TOC\]|^[ ]{0,3}\[[^\]]+\]:|<(?:style|link)\b", re.IGNORECASE | re.MULTILINE
+)
+
+
+class _BoundaryLost(Exception):
+    """
+    A block could not be rendered on its own, e.g. an unclosed raw HTML element
+    swallowed one of its boundaries.
+    """
+
+
+class _Fragment(NamedTuple):
+    html: str
+    code_blocks: Tuple[Tuple[str, str], ...]
+    heading_ids: Tuple[str, ...]
+    has_elements: bool
+    warnings: Tuple[str, ...]
+    errors: Tuple[str, ...]
+    image_sizes: Tuple[Tuple[str, int], ...]
+
+
+class IncrementalConverter:
+    """
+    Convert successive versions of a document, re-rendering only the blocks that changed.
+
+    Each result has ``changes``: the ranges of the previous output that were replaced,
+    with the ranges of the new output replacing them, so a preview can patch its copy
+    instead of reloading. Fragments not used by the latest conversion are forgotten.
+    Not thread-safe; use one instance per document.
+    """
+
+    def __init__(self, converter: Optional[WeChatConverter] = None):
+        self.converter = converter if converter is not None else WeChatConverter()
+        self.blocks_total = 0
+        self.blocks_rendered = 0
+        self._fragments: Dict[str, _Fragment] = {}
+        self._heading_ids = _HeadingIdsExtension()
+        self._markdown = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS + [self._heading_ids])
+        self._shell: Optional[Tuple[str, str, str]] = None
+        # Remote images fetched during the current conversion, by URL
+        self._remote: Dict[str, Union[Path, Exception]] = {}
+        # (context, fragment keys, fragment lengths, offset of the first fragment, html)
+        self._previous: Optional[Tuple[Optional[str], List[str], List[int], int, str]] = None
+
+    def reset(self) -> None:
+        """
+        Forget the cached fragments and the previous output.
+        """
+        self._fragments = {}
+        self._shell = None
+        self._previous = None
+
+    def convert(self, markdown_text: str, base_dir: Optional[Path] = None) -> ConversionResult:
+        clean_md, _, placeholder_map = extract_code_blocks(markdown_text)
+        clean_md, links = md_links_to_index(clean_md)
+        blocks = split_blocks(clean_md)
+        if self._renders_whole(clean_md) or _unbalanced_html(blocks):
+            return self._convert_whole(markdown_text, base_dir)
+
+        context = self._context(base_dir)
+        prefix, suffix = self._container_shell(context)
+        self._prefetch(clean_md)
+
+        fragments = {}
+        keys = []
+        html_parts = []
+        code_html_map = {}
+        all_warnings = []
+        all_errors = []
+        image_sizes = {}
+        used_ids = set()
+        text_only = [bool(_text_only_block.match(block)) for block in blocks]
+        last_element_block = max(
+            (index for index, only_text in enumerate(text_only) if not only_text), default=-1
+        )
+        has_elements = False
+        self.blocks_rendered = 0
+        try:
+            for index, block in enumerate(blocks):
+                before = "" if index == 0 else "element" if has_elements else "text"
+                after = (
+                    "" if index == len(blocks) - 1
+                    else "element" if index < last_element_block else "text"
+                )
+                key, fragment, _ = self._render_unique(
+                    block, context, before, after, used_ids, placeholder_map, base_dir, fragments
+                )
+                if fragment.has_elements == text_only[index]:
+                    # Guessed wrong whether the block renders to text only
+                    raise _BoundaryLost()
+                has_elements = has_elements or fragment.has_elements
+                used_ids.update(fragment.heading_ids)
+                keys.append(key)
+                html_parts.append(fragment.html)
+                all_warnings.extend(fragment.warnings)
+                all_errors.extend(fragment.errors)
+                image_sizes.update(fragment.image_sizes)
+                code_html_map.update(fragment.code_blocks)
+        except _BoundaryLost:
+            return self._convert_whole(markdown_text, base_dir)
+
+        self._fragments = fragments
+        self.blocks_total = len(blocks)
+        html = prefix + "".join(html_parts) + suffix
+        return ConversionResult(
+            html=html,
+            code_blocks=code_html_map,
+            success=len(all_errors) == 0,
+            errors=all_errors,
+            warnings=all_warnings,
+            links=links,
+            image_sizes=image_sizes,
+            changes=self._record(html, context, keys, [len(part) for part in html_parts], len(prefix)),
+        )
+
+    def convert_to_stream(
+        self, markdown_text: str, fileobj: TextIO, base_dir: Optional[Path] = None
+    ) -> ConversionResult:
+        """
+        Convert a document block by block, writing the HTML to fileobj (a text file object)
+        as it goes, so only a few blocks and their HTML are held at a time.
+
+        The HTML is the same as convert's. A block is written once a later block with
+        elements shows what its :last-child rules see; the blocks after the last such block
+        are written at the end. Documents that must be converted as a whole (see convert),
+        or whose HTML elements don't balance, are, and written at once.
+        Fragments of the previous convert() are reused, but none are kept and the previous
+        output is not changed.
+
+        Returns the result without html and code_blocks.
+        """
+        clean_md, _, placeholder_map = extract_code_blocks(markdown_text)
+        clean_md, links = md_links_to_index(clean_md)
+        blocks = split_blocks(clean_md)
+        if self._renders_whole(clean_md) or _unbalanced_html(blocks):
+            result = self.converter.convert(markdown_text, base_dir=base_dir)
+            fileobj.write(result.html)
+            result.html = ""
+            result.code_blocks = {}
+            return result
+
+        context = self._context(base_dir)
+        prefix, suffix = self._container_shell(context)
+        self._prefetch(clean_md)
+
+        text_only = [bool(_text_only_block.match(block)) for block in blocks]
+        last_element_block = max(
+            (index for index, only_text in enumerate(text_only) if not only_text), default=-1
+        )
+        warnings: List[str] = []
+        errors: List[str] = []
+        image_sizes: Dict[str, int] = {}
+        used_ids: Set[str] = set()
+        # Rendered blocks not written yet: (index, before, after, reserved ids, fragment)
+        pending: List[Tuple[int, str, str, FrozenSet[str], _Fragment]] = []
+
+        def write_pending(after: str) -> None:
+            # Re-render the blocks whose neighbour after them was guessed wrong
+            for index, before, guessed, reserved, fragment in pending:
+                actual = "" if index == len(blocks) - 1 else after
+                if guessed != actual:
+                    fragment = self._render_block(
+                        blocks[index], before, actual, reserved, placeholder_map, base_dir
+                    )
+                    self.blocks_rendered += 1
+                fileobj.write(fragment.html)
+                warnings.extend(fragment.warnings)
+                errors.extend(fragment.errors)
+                image_sizes.update(fragment.image_sizes)
+            pending.clear()
+
+        fileobj.write(prefix)
+        has_elements = False
+        self.blocks_rendered = 0
+        index = 0
+        try:
+            while index < len(blocks):
+                before = "" if index == 0 else "element" if has_elements else "text"
+                after = (
+                    "" if index == len(blocks) - 1
+                    else "element" if index < last_element_block else "text"
+                )
+                try:
+                    _, fragment, reserved = self._render_unique(
+                        blocks[index], context, before, after, used_ids, placeholder_map,
+                        base_dir, {},
+                    )
+                except _BoundaryLost:
+                    if index == len(blocks) - 1:
+                        raise
+                    # Render the rest of the document as one block instead
+                    blocks[index:] = ["\n\n".join(blocks[index:])]
+                    continue
+                if fragment.has_elements:
+                    write_pending("element")
+                has_elements = has_elements or fragment.has_elements
+                used_ids.update(fragment.heading_ids)
+                pending.append((index, before, after, reserved, fragment))
+                index += 1
+            # The blocks after the last block with elements only have text after them
+            write_pending("text")
+        except _BoundaryLost:
+            raise ValueError(
+                "The document cannot be converted block by block (unbalanced HTML?)"
+            ) from None
+        fileobj.write(suffix)
+        self.blocks_total = len(blocks)
+        return ConversionResult(
+            html="",
+            success=len(errors) == 0,
+            errors=errors,
+            warnings=warnings,
+            links=links,
+            image_sizes=image_sizes,
+        )
+
+    def _renders_whole(self, clean_md: str) -> bool:
+        """
+        Whether a document's rendering is not local to its blocks.
+        """
+        converter = self.converter
+        # A budget for all the images of the document is not local to blocks either
+        return bool(
+            _whole_document.search(clean_md)
+            or hasattr(get_theme_module(converter.content_theme), "postprocess_html")
+            or (converter.embed_local_images and converter.image_total_bytes is not None)
+        )
+
+    def _context(self, base_dir: Optional[Path]) -> str:
+        """
+        Hash of everything besides its neighbours that the rendering of every block depends on.
+        """
+        converter = self.converter
+        css = get_theme_css(converter.content_theme) or ""
+        return _hash(
+            css, converter.content_theme, converter.code_theme, converter.embed_local_images,
+            converter.image_format, converter.image_quality, converter.image_max_width,
+            converter.image_max_bytes, converter.fetch_remote_images, converter.confine_images,
+            Path(base_dir).resolve() if base_dir is not None else None,
+        )
+
+    def _prefetch(self, clean_md: str) -> None:
+        """
+        Fetch (or revalidate) the remote images up front, together, so the fragment keys
+        see their current content.
+        """
+        self._remote = {}
+        if self.converter.embed_local_images and self.converter.image_fetcher is not None:
+            self._fetch(find_remote_images(clean_md))
+
+    def _render_unique(
+        self,
+        block: str,
+        context: str,
+        before: str,
+        after: str,
+        used_ids: Set[str],
+        placeholder_map: Dict[str, object],
+        base_dir: Optional[Path],
+        fragments: Dict[str, _Fragment],
+    ) -> Tuple[str, _Fragment, FrozenSet[str]]:
+        """
+        Render a block, or reuse its fragment from fragments or the previous conversion,
+        with heading ids that do not clash with used_ids (as the toc extension makes them).
+        Adds the fragment to fragments. Returns (key, fragment, reserved ids).
+        """
+        reserved: FrozenSet[str] = frozenset()
+        while True:
+            key = self._fragment_key(block, context, before, after, reserved, base_dir)
+            fragment = fragments.get(key) or self._fragments.get(key)
+            if fragment is None:
+                fragment = self._render_block(
+                    block, before, after, reserved, placeholder_map, base_dir
+                )
+                self.blocks_rendered += 1
+            fragments[key] = fragment
+            clashes = used_ids.intersection(fragment.heading_ids)
+            if not clashes:
+                return key, fragment, reserved
+            reserved = reserved | clashes
+
+    def _convert_whole(self, markdown_text: str, base_dir: Optional[Path]) -> ConversionResult:
+        result = self.converter.convert(markdown_text, base_dir=base_dir)
+        self._fragments = {}
+        self.blocks_total = self.blocks_rendered = 1
+        result.changes = self._record(result.html, None, [result.html], [len(result.html)], 0)
+        return result
+
+    def _record(
+        self,
+        html: str,
+        context: Optional[str],
+        keys: List[str],
+        lengths: List[int],
+        offset: int,
+    ) -> List[ChangedRange]:
+        """
+        Remember this output and return the ranges that changed since the previous one.
+        """
+        previous = self._previous
+        self._previous = (context, keys, lengths, offset, html)
+        if previous is None or previous[0] != context or context is None:
+            old_length = len(previous[4]) if previous is not None else 0
+            if previous is not None and previous[4] == html:
+                return []
+            return [ChangedRange(0, old_length, 0, len(html))]
+
+        _, old_keys, old_lengths, old_offset, _ = previous
+        old_starts = _offsets(old_lengths, old_offset)
+        new_starts = _offsets(lengths, offset)
+        changes = []
+        matcher = difflib.SequenceMatcher(None, old_keys, keys, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != "equal":
+                changes.append(ChangedRange(old_starts[i1], old_starts[i2], new_starts[j1], new_starts[j2]))
+        return changes
+
+    def _container_shell(self, context: str) -> Tuple[str, str]:
+        """
+        Return the output before and after the container contents (head, styled container).
+        """
+        if self._shell is None or self._shell[0] != context:
+            shell = serialize_html(process_html_tree("", theme=self.converter.content_theme))
+            start = shell.index('<div class="wechat-content"')
+            end = shell.index(">", start) + 1
+            self._shell = (context, shell[:end], shell[end:])
+        return self._shell[1], self._shell[2]
+
+    def _fragment_key(
+        self,
+        block: str,
+        context: str,
+        before: str,
+        after: str,
+        reserved: FrozenSet[str],
+        base_dir: Optional[Path],
+    ) -> str:
+        images = ()
+        if self.converter.embed_local_images:
+            images = tuple(
+                (str(path), file_signature(path)) for path in find_local_images(block, base_dir)
+            )
+            if self.converter.image_fetcher is not None:
+                remote = self._fetch(find_remote_images(block))
+                images += tuple(
+                    (url, file_signature(path) if isinstance(path, Path) else None)
+                    for url, path in remote.items()
+                )
+        return _hash(block, context, before, after, sorted(reserved), images)
+
+    def _fetch(self, urls: Sequence[str]) -> Mapping[str, Union[Path, Exception]]:
+        """
+        Fetch remote images once per conversion (see process_images_tree).
+        """
+        missing = [url for url in urls if url not in self._remote]
+        if missing:
+            self._remote.update(self.converter.image_fetcher.fetch_all(missing))
+        return {url: self._remote[url] for url in urls}
+
+    def _render_block(
+        self,
+        block: str,
+        before: str,
+        after: str,
+        reserved: FrozenSet[str],
+        placeholder_map: Dict[str, object],
+        base_dir: Optional[Path],
+    ) -> _Fragment:
+        """
+        Render one block styled as if the blocks before and after it were present
+        (before/after: "" at the document edges, else "element" or "text", see _BOUNDARIES).
+        """
+        converter = self.converter
+        self._heading_ids.reserved = reserved
+        self._markdown.reset()
+        html = self._markdown.convert(block)
+        heading_ids = tuple(self._heading_ids.generated)
+
+        if before:
+            html = _BOUNDARIES[before] + "\n" + html
+        if after:
+            html = html + "\n" + _BOUNDARIES[after]
+        tree = process_html_tree(html, theme=converter.content_theme)
+        warnings: List[str] = []
+        errors: List[str] = []
+        image_sizes: Dict[str, int] = {}
+        if converter.embed_local_images:
+            warnings, errors = process_images_tree(
+                tree,
+                image_format=converter.image_format,
+                image_quality=converter.image_quality,
+                max_width=converter.image_max_width,
+                base_dir=base_dir,
+                cache=converter.image_cache,
+                workers=converter.image_workers,
+                max_pixel_bytes=converter.image_memory,
+                max_bytes=converter.image_max_bytes,
+                sizes=image_sizes,
+                fetch=self._fetch if converter.image_fetcher is not None else None,
+                confine=converter.confine_images,
+            )
+        container = tree.getroot().find("body/div")
+        if container.getnext() is not None or (container.tail or "").strip():
+            # A stray closing tag ended the container early
+            raise _BoundaryLost()
+        _remove_boundaries(container, bool(before), bool(after))
+        has_elements = any(isinstance(child.tag, str) for child in container)
+        fragment_html = serialize_contents(container)
+        code_html_map = {}
+        for placeholder in find_placeholders(fragment_html):
+            if placeholder in placeholder_map and placeholder not in code_html_map:
+                code_html_map[placeholder] = converter._highlight(placeholder_map[placeholder])
+        fragment_html = merge_content_and_code(fragment_html, code_html_map)
+        code_blocks = tuple(code_html_map.items())
+        return _Fragment(
+            fragment_html, code_blocks, heading_ids, has_elements,
+            tuple(warnings), tuple(errors), tuple(image_sizes.items()),
+        )
+
+
+def split_blocks(clean_markdown: str) -> List[str]:
+    """
+    Split Markdown into top-level blocks that render independently.
+
+    Returns the blocks without the blank lines between them. A blank line only separates
+    two blocks if the Markdown renderer would not join what follows it to what precedes it.
+    """
+    blocks: List[List[str]] = []
+    chunk: List[str] = []
+    fence: Optional[str] = None
+    html_depth = 0
+    has_list = has_quote = False
+    # Whether a line of the chunk outside fenced blocks starts a list item: a list can
+    # start partway through a chunk (e.g. after an indented code line), and then the
+    # chunk ends inside it
+    chunk_has_list = False
+    # Blank lines since the last chunk, kept verbatim when the next chunk is joined to it
+    # (raw HTML blocks keep their blank lines)
+    gap: List[str] = []
+
+    def close_chunk():
+        nonlocal has_list, has_quote, html_depth, chunk_has_list
+        if not chunk:
+            return
+        text = "\n".join(chunk)
+        starts_list = bool(_list_item.match(chunk[0]))
+        joined = blocks and (
+            chunk[0][:1] in (" ", "\t")
+            or (starts_list and has_list)
+            or (chunk[0].lstrip(" ").startswith(">") and has_quote)
+            or html_depth > 0
+        )
+        if joined:
+            blocks[-1].extend(gap)
+            blocks[-1].extend(chunk)
+        else:
+            blocks.append(list(chunk))
+            has_list = has_quote = False
+        has_list = has_list or chunk_has_list
+        chunk_has_list = False
+        has_quote = has_quote or bool(_block_quote.search(text))
+        html_depth = max(0, html_depth + _html_depth_change(text))
+        chunk.clear()
+        gap.clear()
+
+    for line in clean_markdown.split("\n"):
+        if fence is None and _blank_line.match(line):
+            close_chunk()
+            gap.append(line)
+            continue
+        if fence is None:
+            match = _fence.match(line)
+            if match:
+                # Blank lines inside a fenced block never split it
+                fence = match.group(1)
+            elif _list_item.match(line):
+                chunk_has_list = True
+        elif line.rstrip(" \r") == fence:
+            fence = None
+        chunk.append(line)
+    close_chunk()
+    return ["\n".join(lines) for lines in blocks]
+
+
+def _html_depth_change(text: str) -> int:
+    """
+    Net number of HTML elements (and comments) a chunk opens, ignoring code spans.
+    """
+    return _html_depth_range(text)[0]
+
+
+def _html_depth_range(text: str) -> Tuple[int, int]:
+    """
+    Net number of HTML elements (and comments) a chunk opens, ignoring code spans, and
+    the lowest depth reached on the way (negative if it closes elements it didn't open).
+    """
+    text = _code_span.sub("", text)
+    depth = lowest = text.count("<!--") - text.count("-->")
+    for closing, tag, self_closing in _html_tag.findall(text):
+        if tag.lower() in _html_void_tags or self_closing:
+            continue
+        depth += -1 if closing else 1
+        lowest = min(lowest, depth)
+    return depth, min(lowest, 0)
+
+
+def _unbalanced_html(blocks: Sequence[str]) -> bool:
+    """
+    Whether a block closes an HTML element that no block before it opened, which ends
+    the container early when the document is rendered as a whole, or an element is left
+    open at the end, which then holds the rest of the document (and the link list).
+    """
+    depth = 0
+    for block in blocks:
+        change, lowest = _html_depth_range(block)
+        if depth + lowest < 0:
+            return True
+        depth += change
+    return depth > 0
+
+
+def _is_boundary(node) -> bool:
+    if node.tag is etree.Comment:
+        return node.text == _BOUNDARY_NAME
+    return node.tag == "hr" and node.get("class") == _BOUNDARY_NAME
+
+
+def _remove_boundaries(container, leading: bool, trailing: bool) -> None:
+    """
+    Remove the boundaries of a styled block. The newline separating a block from
+    the next one belongs to the next block, so it is dropped at the end.
+    """
+    if leading:
+        boundary = container[0] if len(container) else None
+        if boundary is None or not _is_boundary(boundary):
+            raise _BoundaryLost()
+        container.text = (container.text or "") + (boundary.tail or "")
+        boundary.tail = None
+        container.remove(boundary)
+    if trailing:
+        boundary = container[-1] if len(container) else None
+        if boundary is None or not _is_boundary(boundary):
+            raise _BoundaryLost()
+        previous = boundary.getprevious()
+        text = previous.tail if previous is not None else container.text
+        if text and text.endswith("\n"):
+            text = text[:-1] or None
+        if previous is not None:
+            previous.tail = text
+        else:
+            container.text = text
+        container.remove(boundary)
+
+
+class _HeadingIdsTreeprocessor(Treeprocessor):
+    """
+    Before the toc extension runs: add placeholder elements holding the reserved ids.
+    After it ran: remove them again and record the ids given to the headings.
+    """
+
+    def __init__(self, md, extension: "_HeadingIdsExtension", before_toc: bool):
+        super().__init__(md)
+        self.extension = extension
+        self.before_toc = before_toc
+
+    def run(self, root):
+        if self.before_toc:
+            for heading_id in sorted(self.extension.reserved):
+                reserved = root.makeelement("div", {"id": heading_id, "class": "reserved-id"})
+                root.append(reserved)
+            return None
+        for element in [el for el in root if el.get("class") == "reserved-id" and el.tag == "div"]:
+            root.remove(element)
+        self.extension.generated = [
+            el.get("id") for el in root.iter() if el.tag in _header_tags and el.get("id") is not None
+        ]
+        return None
+
+
+class _HeadingIdsExtension(Extension):
+    def __init__(self):
+        super().__init__()
+        self.reserved: FrozenSet[str] = frozenset()
+        self.generated: List[str] = []
+
+    def extendMarkdown(self, md):
+        # The toc extension assigns heading ids at priority 5
+        md.treeprocessors.register(_HeadingIdsTreeprocessor(md, self, True), "reserve_ids", 6)
+        md.treeprocessors.register(_HeadingIdsTreeprocessor(md, self, False), "collect_ids", 4)
+
+
+def _hash(*parts) -> str:
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+def _offsets(lengths: Sequence[int], offset: int) -> List[int]:
+    starts = [offset]
+    for length in lengths:
+        starts.append(starts[-1] + length)
+    return starts
+
+
+def file_signature(path: Path) -> Optional[Tuple[int, int]]:
+    """
+    (mtime_ns, size) of a file, or None if it is missing; compared to tell whether the
+    file changed.
+    """
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
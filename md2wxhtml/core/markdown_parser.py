@@ -6,7 +6,7 @@ from ..utils.placeholder_manager import PlaceholderManager
 def extract_code_blocks(markdown: str) -> Tuple[str, List[CodeBlock], dict]:
     """
     Extract fenced and indented code blocks from markdown.
-    Replace them with unique placeholders.
+    Replace them with placeholders derived from their language and content.
     Return (clean_markdown, code_blocks, placeholder_map)
     """
     code_blocks = []
@@ -19,7 +19,7 @@ def extract_code_blocks(markdown: str) -> Tuple[str, List[CodeBlock], dict]:
         lang = match.group(1) or None
         content = match.group(2)
         code_block = CodeBlock(content=content, language=lang)
-        placeholder = placeholder_manager.generate()
+        placeholder = placeholder_manager.generate(f"{lang or ''}\n{content}")
         code_block.placeholder = placeholder
         code_blocks.append(code_block)
         placeholder_map[placeholder] = code_block
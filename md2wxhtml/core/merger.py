@@ -1,12 +1,36 @@
 # Component merging logic
 
-# The merger logic is handled in the main converter for now.
-# This module can be expanded for more advanced merging if needed.
+from typing import Iterator, Mapping
 
-def merge_content_and_code(html_with_placeholders: str, code_html_map: dict) -> str:
+from ..utils.placeholder_manager import PLACEHOLDER_PATTERN
+
+
+def find_placeholders(html: str) -> Iterator[str]:
+    """
+    Yield the code block placeholders in HTML, in document order.
+    """
+    for match in PLACEHOLDER_PATTERN.finditer(html):
+        yield match.group(0)
+
+
+def merge_content_and_code(html_with_placeholders: str, code_html_map: Mapping[str, str]) -> str:
     """
     Replace placeholders in HTML with processed code block HTML.
+
+    The HTML is scanned once and the result built with a single join, so merging takes
+    linear time however many code blocks there are. Placeholders missing from
+    code_html_map are left as they are.
     """
-    for placeholder, code_html in code_html_map.items():
-        html_with_placeholders = html_with_placeholders.replace(placeholder, code_html)
-    return html_with_placeholders
+    parts = []
+    position = 0
+    for match in PLACEHOLDER_PATTERN.finditer(html_with_placeholders):
+        code_html = code_html_map.get(match.group(0))
+        if code_html is None:
+            continue
+        parts.append(html_with_placeholders[position:match.start()])
+        parts.append(code_html)
+        position = match.end()
+    if not parts:
+        return html_with_placeholders
+    parts.append(html_with_placeholders[position:])
+    return "".join(parts)
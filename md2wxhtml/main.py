@@ -1,14 +1,166 @@
 import argparse
+import glob
+import os
+import sys
 from pathlib import Path
-from . import WeChatConverter
+from typing import TYPE_CHECKING, List, Tuple
+
+from . import __version__
+from .utils.manifest import Manifest, hash_bytes, hash_options
+
+# The converter and processors are imported once the arguments are parsed, so --help and
+# argument errors don't wait for them
+if TYPE_CHECKING:
+    from .core.converter import WeChatConverter
+
+MANIFEST_NAME = ".md2wxhtml-manifest.json"
 
 def main():
-    parser = argparse.ArgumentParser(description="Convert Markdown to WeChat HTML.")
-    parser.add_argument("--input", required=True, help="Input Markdown file path.")
-    parser.add_argument("--output", required=True, help="Output HTML file path.")
+    if sys.argv[1:2] == ["serve"]:
+        from .serve import serve_main
+
+        serve_main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(
+        description="Convert Markdown to WeChat HTML.",
+        epilog="Run 'md2wxhtml serve --help' for the conversion service.",
+    )
+    parser.add_argument(
+        "--input",
+        required=True,
+        help="Input Markdown file path, or a directory / glob pattern (quoted) for batch conversion.",
+    )
+    parser.add_argument(
+        "--output",
+        required=True,
+        help="Output HTML file path (output directory in batch mode, mirroring the input tree).",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Write the output of a single input file section by section, bounding memory for very large documents.",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print the time spent in each stage of the conversion and counters (blocks, images, bytes, cache hits).",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="With --stats, also print the peak memory allocated by each stage (slows the conversion down).",
+    )
+    add_converter_arguments(parser)
+
+    batch_group = parser.add_argument_group("Batch Options")
+    batch_group.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of worker processes for batch conversion (default: 1).",
+    )
+    batch_group.add_argument(
+        "--manifest",
+        metavar="PATH",
+        help=f"Manifest used to skip unchanged inputs (default: <output>/{MANIFEST_NAME}).",
+    )
+    batch_group.add_argument(
+        "--force",
+        action="store_true",
+        help="Convert every input, even if the manifest says it is unchanged.",
+    )
+
+    watch_group = parser.add_argument_group("Watch Options")
+    watch_group.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and rebuild the output whenever the input or its local images change.",
+    )
+    watch_group.add_argument(
+        "--watch-theme",
+        action="store_true",
+        help="Also reload the content theme when its source file changes (requires --watch).",
+    )
+    watch_group.add_argument(
+        "--watch-interval",
+        type=float,
+        default=0.1,
+        metavar="SECONDS",
+        help="Polling interval for --watch (default: 0.1).",
+    )
+
+    args = parser.parse_args()
+
+    converter = converter_from_args(args)
+    converter.collect_stats = args.stats
+    converter.trace_memory = args.stats and args.trace_memory
+
+    if os.path.isdir(args.input) or _is_glob(args.input):
+        if args.watch:
+            print("Error: --watch needs a single input file.")
+            return
+        _convert_batch(args, converter)
+        return
+
+    if args.watch:
+        from .watch import watch
+
+        watch(
+            Path(args.input),
+            Path(args.output),
+            converter,
+            watch_theme=args.watch_theme,
+            interval=args.watch_interval,
+        )
+        return
+
+    try:
+        with open(args.input, 'r', encoding='utf-8') as f:
+            markdown_content = f.read()
+
+        input_file_path = Path(args.input)
+        base_dir = input_file_path.parent.resolve()
+
+        if args.stream:
+            conversion_result = _convert_to_file(converter, markdown_content, base_dir, Path(args.output))
+        else:
+            conversion_result = converter.convert(markdown_content, base_dir=base_dir)
 
+        if conversion_result.success:
+            if not args.stream:
+                with open(args.output, 'w', encoding='utf-8') as f:
+                    f.write(conversion_result.html)
+
+            print(f"Successfully converted '{args.input}' to '{args.output}'")
+            if args.image_budget or args.total_image_budget:
+                _print_image_sizes(conversion_result)
+            _print_messages(conversion_result)
+            if args.stats:
+                _print_stats(conversion_result)
+        else:
+            print(f"Conversion failed for '{args.input}'. Errors: {conversion_result.errors}")
+
+    except FileNotFoundError:
+        print(f"Error: Input file '{args.input}' not found.")
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+
+
+def add_converter_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the options configuring the converter (themes, caches, images), shared by
+    conversions and the conversion service.
+    """
     parser.add_argument("--content-theme", default="default", help="Content theme for styling.")
     parser.add_argument("--code-theme", default="default", help="Pygments code highlighting theme.")
+    parser.add_argument(
+        "--code-cache-dir",
+        metavar="DIR",
+        help="Keep highlighted code blocks in this directory across runs (shared by --jobs workers).",
+    )
 
     image_group = parser.add_argument_group("Image Options")
     image_group.add_argument(
@@ -34,49 +186,217 @@ def main():
         metavar="PIXELS",
         help="Resize images to max width while maintaining aspect ratio (requires --embed-images).",
     )
+    image_group.add_argument(
+        "--image-workers",
+        type=int,
+        metavar="N",
+        help="Threads encoding the images of a document (default: up to 4, requires --embed-images).",
+    )
+    image_group.add_argument(
+        "--image-cache-dir",
+        metavar="DIR",
+        help="Keep encoded images in this directory across runs (shared by --jobs workers).",
+    )
+    image_group.add_argument(
+        "--image-budget",
+        type=int,
+        metavar="KB",
+        help="Lower the quality (then the size) of each embedded image until it fits in KB.",
+    )
+    image_group.add_argument(
+        "--total-image-budget",
+        type=int,
+        metavar="KB",
+        help="Fit all the embedded images of a document in KB, in proportion to their sizes.",
+    )
+    image_group.add_argument(
+        "--fetch-remote-images",
+        action="store_true",
+        help="Also download http(s):// images and embed them (requires --embed-images).",
+    )
+    image_group.add_argument(
+        "--remote-image-dir",
+        metavar="DIR",
+        help="Keep downloaded images in this directory, revalidating them on later runs.",
+    )
 
-    args = parser.parse_args()
 
-    try:
-        with open(args.input, 'r', encoding='utf-8') as f:
-            markdown_content = f.read()
+def converter_from_args(args, **overrides) -> "WeChatConverter":
+    """
+    Build the converter configured by the options of add_converter_arguments, with
+    overrides for other constructor arguments.
+    """
+    from .core.converter import WeChatConverter
+
+    return WeChatConverter(
+        content_theme=args.content_theme,
+        code_theme=args.code_theme,
+        embed_local_images=args.embed_images,
+        image_format=args.image_format,
+        image_quality=args.image_quality,
+        image_max_width=args.image_max_width,
+        code_cache_dir=Path(args.code_cache_dir) if args.code_cache_dir else None,
+        image_workers=args.image_workers,
+        image_cache_dir=Path(args.image_cache_dir) if args.image_cache_dir else None,
+        image_max_bytes=args.image_budget * 1024 if args.image_budget else None,
+        image_total_bytes=args.total_image_budget * 1024 if args.total_image_budget else None,
+        fetch_remote_images=args.fetch_remote_images,
+        remote_image_dir=Path(args.remote_image_dir) if args.remote_image_dir else None,
+        **overrides,
+    )
 
-        converter = WeChatConverter(
-            content_theme=args.content_theme,
-            code_theme=args.code_theme,
-            embed_local_images=args.embed_images,
-            image_format=args.image_format,
-            image_quality=args.image_quality,
-            image_max_width=args.image_max_width,
+
+def _convert_batch(args, converter: "WeChatConverter"):
+    """
+    Convert every Markdown file matched by a directory or glob input into a mirrored
+    output tree, skipping inputs whose manifest fingerprint hasn't changed.
+    """
+    from .processors.content_processor import get_theme_css
+    from .processors.image_processor import find_local_images, find_remote_images
+
+    root, files = _collect_inputs(args.input)
+    if not files:
+        print(f"Error: No Markdown files found for '{args.input}'.")
+        return
+
+    output_dir = Path(args.output)
+    manifest = Manifest.load(Path(args.manifest) if args.manifest else output_dir / MANIFEST_NAME)
+    theme_css = get_theme_css(args.content_theme) or ""
+    settings = converter.settings()
+    # Where code and images are cached and how images are scheduled don't change the output
+    for name in (
+        "code_cache_dir", "image_workers", "image_memory", "image_cache_dir", "remote_image_dir",
+        "collect_stats", "trace_memory",
+    ):
+        settings.pop(name)
+    options_hash = hash_options({
+        "version": __version__,
+        "settings": settings,
+        "theme_css": hash_bytes(theme_css.encode("utf-8")),
+    })
+
+    pending = []
+    skipped = 0
+    for path in files:
+        relative = path.relative_to(root)
+        output_path = output_dir / relative.with_suffix(".html")
+        try:
+            markdown_content = path.read_text(encoding="utf-8")
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Error: Could not read '{path}': {e}")
+            continue
+        base_dir = path.parent.resolve()
+        # Images only affect the output when they get embedded
+        images = find_local_images(markdown_content, base_dir) if converter.embed_local_images else []
+        fingerprint = manifest.fingerprint(markdown_content, images, options_hash)
+        key = relative.as_posix()
+        # Whether remote images changed is only known by fetching them again
+        remote = (
+            converter.embed_local_images and converter.fetch_remote_images
+            and find_remote_images(markdown_content)
         )
+        if not args.force and not remote and manifest.is_unchanged(key, fingerprint, output_path):
+            skipped += 1
+            continue
+        pending.append((key, path, output_path, markdown_content, base_dir, fingerprint))
 
-        input_file_path = Path(args.input)
-        base_dir = input_file_path.parent.resolve()
+    converted = 0
+    failed = 0
+    try:
+        docs = [(markdown_content, base_dir) for _, _, _, markdown_content, base_dir, _ in pending]
+        for index, result in converter.convert_many(docs, workers=args.jobs, as_completed=True):
+            key, path, output_path, _, _, fingerprint = pending[index]
+            if not result.success:
+                failed += 1
+                print(f"Conversion failed for '{path}'. Errors: {result.errors}")
+                continue
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(output_path, 'w', encoding='utf-8') as f:
+                f.write(result.html)
+            manifest.record(key, fingerprint, output_path)
+            converted += 1
+            print(f"Successfully converted '{path}' to '{output_path}'")
+            _print_messages(result)
+            if args.stats:
+                _print_stats(result)
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+    finally:
+        manifest.save()
+
+    print(f"\n{converted} converted, {skipped} unchanged, {failed} failed.")
 
-        conversion_result = converter.convert(markdown_content, base_dir=base_dir)
 
+def _convert_to_file(converter: "WeChatConverter", markdown_content: str, base_dir: Path, output_path: Path):
+    """
+    Stream the conversion into a temporary file next to output_path, moved into place if
+    the conversion succeeds.
+    """
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            conversion_result = converter.convert_to_stream(markdown_content, f, base_dir=base_dir)
         if conversion_result.success:
-            with open(args.output, 'w', encoding='utf-8') as f:
-                f.write(conversion_result.html)
+            os.replace(tmp_path, output_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return conversion_result
 
-            print(f"Successfully converted '{args.input}' to '{args.output}'")
 
-            if conversion_result.warnings:
-                print("\nWarnings:")
-                for warning in conversion_result.warnings:
-                    print(f"  - {warning}")
+def _collect_inputs(pattern: str) -> Tuple[Path, List[Path]]:
+    """
+    Return the root that output paths are mirrored from and the Markdown files to convert.
+    """
+    if os.path.isdir(pattern):
+        root = Path(pattern)
+        return root, sorted(path for path in root.rglob("*.md") if path.is_file())
+    files = sorted(Path(path) for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    # Mirror from the part of the pattern before the first wildcard
+    static_parts = []
+    for part in Path(pattern).parts:
+        if _is_glob(part):
+            break
+        static_parts.append(part)
+    return Path(*static_parts) if static_parts else Path("."), files
 
-            if conversion_result.errors:
-                print("\nErrors:")
-                for error in conversion_result.errors:
-                    print(f"  - {error}")
-        else:
-            print(f"Conversion failed for '{args.input}'. Errors: {conversion_result.errors}")
 
-    except FileNotFoundError:
-        print(f"Error: Input file '{args.input}' not found.")
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+def _is_glob(pattern: str) -> bool:
+    return any(char in pattern for char in "*?[")
+
+
+def _print_image_sizes(conversion_result):
+    sizes = conversion_result.image_sizes
+    if sizes:
+        print("\nEmbedded images:")
+        for src, size in sizes.items():
+            print(f"  - {src}: {size / 1024:.1f} KB")
+
+
+def _print_stats(conversion_result):
+    stats = conversion_result.stats
+    if stats is None:
+        print("\nStats are not collected for streamed conversions.")
+        return
+    print(f"\nStats ({stats.wall_ms:.2f} ms wall, {stats.cpu_ms:.2f} ms CPU):")
+    print(f"  {'stage':<16}{'calls':>6}{'wall ms':>10}{'cpu ms':>10}{'peak KB':>10}")
+    for name, stage in stats.stages.items():
+        peak = f"{stage.peak_bytes / 1024:.1f}" if stage.peak_bytes is not None else "-"
+        print(f"  {name:<16}{stage.calls:>6}{stage.wall_ms:>10.2f}{stage.cpu_ms:>10.2f}{peak:>10}")
+    if stats.counters:
+        print("  " + ", ".join(f"{name}={value}" for name, value in stats.counters.items()))
+
+
+def _print_messages(conversion_result):
+    if conversion_result.warnings:
+        print("\nWarnings:")
+        for warning in conversion_result.warnings:
+            print(f"  - {warning}")
+
+    if conversion_result.errors:
+        print("\nErrors:")
+        for error in conversion_result.errors:
+            print(f"  - {error}")
 
 
 if __name__ == "__main__":
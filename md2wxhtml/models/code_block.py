@@ -16,6 +16,57 @@ class ProcessingContext:
     state: Dict[str, Any] = field(default_factory=dict)
 
 
+@dataclass
+class ChangedRange:
+    """
+    A range of the previous output (old_start:old_end) replaced by a range of the new
+    output (new_start:new_end), as character offsets into the HTML strings.
+    """
+    old_start: int
+    old_end: int
+    new_start: int
+    new_end: int
+
+
+@dataclass
+class StageStats:
+    """
+    Time spent in one stage of a conversion, summed over its runs (calls). CPU time is the
+    process's, so it includes the worker threads of the stage (e.g. image encoding) and
+    anything else running in the process meanwhile. peak_bytes is the largest amount of
+    memory a run allocated on top of what was allocated when it started (with
+    trace_memory only).
+    """
+    wall_ms: float = 0.0
+    cpu_ms: float = 0.0
+    peak_bytes: Optional[int] = None
+    calls: int = 0
+
+
+@dataclass
+class ConversionStats:
+    """
+    Where the time of a conversion went (see WeChatConverter's collect_stats): the stages
+    by name, in the order they first ran, counters (blocks, images, bytes, cache hits) and
+    the totals of the whole conversion.
+    """
+    stages: Dict[str, StageStats] = field(default_factory=dict)
+    counters: Dict[str, int] = field(default_factory=dict)
+    wall_ms: float = 0.0
+    cpu_ms: float = 0.0
+
+    def add_stage(self, name: str, run: StageStats) -> None:
+        """
+        Add the timing of a run (or several) to stage name.
+        """
+        stage = self.stages.setdefault(name, StageStats())
+        stage.wall_ms += run.wall_ms
+        stage.cpu_ms += run.cpu_ms
+        if run.peak_bytes is not None:
+            stage.peak_bytes = max(stage.peak_bytes or 0, run.peak_bytes)
+        stage.calls += run.calls
+
+
 @dataclass
 class ConversionResult:
     html: str
@@ -24,3 +75,9 @@ class ConversionResult:
     errors: List[str] = field(default_factory=list)
     warnings: List[str] = field(default_factory=list)
     links: Dict[str, Tuple[int, str]] = field(default_factory=dict)
+    # Encoded size in bytes of each embedded image, by src
+    image_sizes: Dict[str, int] = field(default_factory=dict)
+    # Set by IncrementalConverter: the output ranges that changed since its previous conversion
+    changes: Optional[List[ChangedRange]] = None
+    # Set by converters collecting stats: per-stage timings and counters of this conversion
+    stats: Optional[ConversionStats] = None
@@ -0,0 +1,110 @@
+"""
+Pygments formatter that writes the code markup used inside WeChat <code> tags.
+
+It produces, in one pass over the token stream, what ``HtmlFormatter(noclasses=True,
+nowrap=True)`` output used to become after post-processing: surrounding whitespace
+stripped, spaces and tabs turned into ``&nbsp;``, line breaks into ``<br />`` and
+whitespace-only spans replaced by their ``&nbsp;`` characters.
+"""
+
+import re
+from typing import Dict, List, Union
+
+from pygments.formatters import HtmlFormatter
+from pygments.formatters.html import escape_html
+
+_NBSP = "&nbsp;"
+_TAB = _NBSP * 4
+_whitespace_only = re.compile(r"\s+")
+
+# [style, text pieces] ("" style: unstyled text)
+_Run = List[Union[str, List[str]]]
+
+
+class WeChatCodeFormatter(HtmlFormatter):
+    """
+    HtmlFormatter with inline styles whose output needs no further processing for WeChat.
+
+    Styles per token type come from the HtmlFormatter style table and are looked up once
+    per token type; the formatter keeps no other state, so one instance can serve many
+    threads.
+    """
+
+    def __init__(self, **options):
+        options.update(noclasses=True, nowrap=True)
+        super().__init__(**options)
+        self._token_styles: Dict[object, str] = {}
+
+    def _token_style(self, ttype) -> str:
+        try:
+            return self._token_styles[ttype]
+        except KeyError:
+            css_class = self._get_css_inline_styles(ttype)
+            style = self.class2style[css_class][0] if css_class else ""
+            self._token_styles[ttype] = style
+            return style
+
+    def format_unencoded(self, tokensource, outfile):
+        # Lines of runs: adjacent tokens with the same style share one <span>, like
+        # HtmlFormatter does
+        lines: List[List[_Run]] = [[]]
+        for ttype, value in tokensource:
+            style = self._token_style(ttype)
+            parts = value.split("\n")
+            for index, part in enumerate(parts):
+                if index:
+                    lines.append([])
+                if part:
+                    line = lines[-1]
+                    if line and line[-1][0] == style:
+                        line[-1][1].append(part)
+                    else:
+                        line.append([style, [part]])
+
+        _strip(lines)
+        outfile.write("<br />".join("".join(_run_markup(run) for run in line) for line in lines))
+
+
+def _strip(lines: List[List[_Run]]) -> None:
+    """
+    Strip leading and trailing whitespace (line breaks and unstyled text, a <span> stops it).
+    """
+    blank = 0
+    for line in lines:
+        while line and not line[0][0]:
+            text = "".join(line[0][1]).lstrip()
+            if text:
+                line[0][1] = [text]
+                break
+            line.pop(0)
+        if line:
+            break
+        blank += 1
+    del lines[:blank]
+    _strip_end(lines)
+
+
+def _strip_end(lines: List[List[_Run]]) -> None:
+    while lines:
+        line = lines[-1]
+        while line and not line[-1][0]:
+            text = "".join(line[-1][1]).rstrip()
+            if text:
+                line[-1][1] = [text]
+                return
+            line.pop()
+        if line:
+            return
+        lines.pop()
+
+
+def _run_markup(run: _Run) -> str:
+    style, pieces = run
+    text = "".join(pieces)
+    if style and _whitespace_only.fullmatch(text):
+        # WeChat drops whitespace-only spans, so keep just the spaces (and tabs)
+        return _NBSP * (text.count(" ") + 4 * text.count("\t"))
+    markup = escape_html(text).replace(" ", _NBSP).replace("\t", _TAB)
+    if style:
+        return f'<span style="{style}">{markup}</span>'
+    return markup
@@ -1,30 +1,92 @@
-import re
-
-from pygments import highlight
-from pygments.formatters import HtmlFormatter
-from pygments.lexers import get_lexer_by_name, guess_lexer
-from pygments.styles import get_style_by_name
+import hashlib
+import threading
+from typing import TYPE_CHECKING, Dict, Iterable, NamedTuple, Optional
 
 from ..models.code_block import CodeBlock
 
+# Pygments (and the formatter built on it) is imported by the first block highlighted,
+# so documents without code never load it
+if TYPE_CHECKING:
+    from .code_formatter import WeChatCodeFormatter
+
+
+class _CodeTheme(NamedTuple):
+    formatter: "WeChatCodeFormatter"
+    pre_style: str
+    code_style: str
+
+
+# Lexers by language name (None when Pygments doesn't know the language) and formatters
+# with their <pre>/<code> styles by theme. Lexers and formatters keep no state between
+# highlight() calls, so one instance serves every block and thread.
+_lexers: Dict[str, Optional[object]] = {}
+_themes: Dict[str, _CodeTheme] = {}
+_registry_lock = threading.Lock()
+_text_lexer = None
+
+
+def _get_lexer(language: str):
+    try:
+        return _lexers[language]
+    except KeyError:
+        pass
+    with _registry_lock:
+        if language not in _lexers:
+            from pygments.lexers import get_lexer_by_name
+
+            try:
+                _lexers[language] = get_lexer_by_name(language, stripall=True)
+            except Exception:
+                _lexers[language] = None
+        return _lexers[language]
+
+def _get_code_theme(theme: str) -> _CodeTheme:
+    try:
+        return _themes[theme]
+    except KeyError:
+        pass
+    with _registry_lock:
+        if theme not in _themes:
+            from .code_formatter import WeChatCodeFormatter
+
+            pre_style, code_style = _build_pre_code_style(_get_background_color(theme))
+            formatter = WeChatCodeFormatter(style=theme)
+            _themes[theme] = _CodeTheme(formatter, pre_style, code_style)
+        return _themes[theme]
+
+def preload_code_highlighting(languages: Iterable[str] = (), themes: Iterable[str] = ()) -> None:
+    """
+    Build the lexers and formatters for the given languages and code themes ahead of time.
+    """
+    for language in languages:
+        _get_lexer(language)
+    for theme in themes:
+        _get_code_theme(theme)
 
 def _select_lexer(language: str, code: str):
     """
     Select the appropriate lexer for the given language and code.
     """
+    global _text_lexer
+    lexer = _get_lexer(language)
+    if lexer is not None:
+        return lexer
+    from pygments.lexers import guess_lexer
+
     try:
-        return get_lexer_by_name(language, stripall=True)
+        return guess_lexer(code)
     except Exception:
-        try:
-            return guess_lexer(code)
-        except Exception:
+        if _text_lexer is None:
             from pygments.lexers.special import TextLexer
-            return TextLexer(stripall=True)
+            _text_lexer = TextLexer(stripall=True)
+        return _text_lexer
 
 def _get_background_color(theme: str) -> str:
     """
     Get the background color for the given Pygments theme.
     """
+    from pygments.styles import get_style_by_name
+
     try:
         style = get_style_by_name(theme)
         return getattr(style, 'background_color', '#272822') or '#272822'
@@ -71,68 +133,26 @@ def _build_pre_code_style(background_color: str) -> (str, str):
     )
     return pre_style, code_style
 
-def _replace_spaces_and_linebreaks(html: str) -> str:
-    # Replace all spaces/tabs outside HTML tags with &nbsp;, and \n with <br />
-    def replace_line(line):
-        result = ''
-        in_tag = False
-        for char in line:
-            if char == '<':
-                in_tag = True
-                result += char
-            elif char == '>':
-                in_tag = False
-                result += char
-            elif not in_tag and char == ' ':
-                result += '&nbsp;'
-            elif not in_tag and char == '\t':
-                result += '&nbsp;' * 4
-            else:
-                result += char
-        return result
-
-    lines = html.split('\n')
-    processed_lines = [replace_line(line) for line in lines]
-    return '<br />'.join(processed_lines)
-
-def _move_all_nbsp_outside_span(html: str) -> str:
-    # Replace all whitespace-only spans with &nbsp; outside the span
-    def repl(m):
-        ws = m.group(2)
-        nbsp_count = ws.count('&nbsp;') + ws.count(' ')
-        return '&nbsp;' * nbsp_count
-    # This regex matches any <span ...>   </span> or <span ...>&nbsp;&nbsp;</span>
-    return re.sub(r'(<span[^>]*>)((?:\s|&nbsp;)+)</span>', repl, html)
+def code_block_cache_key(code_block: CodeBlock, theme: str) -> str:
+    """
+    Cache key for the highlighted HTML of a code block: content hash, language and code theme.
+    """
+    digest = hashlib.sha256(code_block.content.encode("utf-8")).hexdigest()
+    return f"{digest}|{code_block.language or ''}|{theme}"
 
 def process_code_block(code_block: CodeBlock, theme: str = "monokai") -> str:
     """
     Convert a CodeBlock to WeChat-compatible styled HTML using <pre><code> structure,
     matching the working example for WeChat editor compatibility.
     """
+    from pygments import highlight
+
     code = code_block.content
     language = code_block.language or "text"
     lexer = _select_lexer(language, code)
-    background_color = _get_background_color(theme)
-    pre_style, code_style = _build_pre_code_style(background_color)
-    formatter = HtmlFormatter(style=theme, noclasses=True, nowrap=True)
+    formatter, pre_style, code_style = _get_code_theme(theme)
+    # The formatter writes the final markup (&nbsp;, <br />, inline token styles) directly
     highlighted_code = highlight(code, lexer, formatter)
-    # Remove outer <div class="highlight"><pre>...</pre></div> if present
-    if highlighted_code.startswith('<div class="highlight"><pre>'):
-        highlighted_code = highlighted_code[len('<div class="highlight"><pre>'):]
-    if highlighted_code.endswith('</pre></div>'):
-        highlighted_code = highlighted_code[:-len('</pre></div>')]
-    highlighted_code = highlighted_code.strip()
-    if highlighted_code.startswith('<pre'):
-        pre_start = highlighted_code.find('>') + 1
-        pre_end = highlighted_code.rfind('</pre>')
-        highlighted_code = highlighted_code[pre_start:pre_end].strip()
-    if highlighted_code.startswith('<code'):
-        code_start = highlighted_code.find('>') + 1
-        code_end = highlighted_code.rfind('</code>')
-        highlighted_code = highlighted_code[code_start:code_end].strip()
-    # Now replace spaces and linebreaks as in the working example
-    highlighted_code = _replace_spaces_and_linebreaks(highlighted_code)
-    highlighted_code = _move_all_nbsp_outside_span(highlighted_code)
     html = (
         f'<pre style="{pre_style}">'
         f'<code style="{code_style}">'
@@ -1,20 +1,53 @@
+import importlib
 import re
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-import markdown
-from bs4 import BeautifulSoup
-from premailer import transform
-
-from ..processors.themes import blue, dark, default, github, green, green_simple, hammer, red
-
-theme_map = {
-    "default": green_simple,
-    "github": github,
-    "hammer": hammer,
-    "dark": dark,
-    "blue": blue,
-    "green": green,
-    "green_simple": green_simple,
-    "red": red,
+import lxml.html
+from lxml import etree
+
+from ..utils.instrumentation import Recorder, measure
+from ..utils.placeholder_manager import PLACEHOLDER_END, PLACEHOLDER_START
+
+if TYPE_CHECKING:
+    import markdown
+
+# Block-level tags that implicitly close an open <p> when the HTML parser meets them
+_PARAGRAPH_CLOSING_TAGS = frozenset({
+    "address", "blockquote", "center", "dd", "dir", "div", "dl", "dt", "fieldset", "form",
+    "h1", "h2", "h3", "h4", "h5", "h6", "hr", "li", "listing", "menu", "ol", "p", "pre",
+    "table", "tbody", "td", "th", "tr", "ul", "xmp",
+})
+
+# Bare URLs turned into links by _auto_link_urls
+_URL_PATTERN = re.compile(r'((https?://|www\.)[^\s<>"\']+)', re.IGNORECASE)
+
+# Extensions the Markdown renderer runs with
+MARKDOWN_EXTENSIONS = ["tables", "fenced_code", "codehilite", "toc"]
+
+# Text that may make fenced_code or codehilite do something: fences extract_code_blocks
+# left alone (~~~, or ``` with an info string it doesn't match) and indented code blocks
+# (at least four spaces or a tab, also inside list items and blockquotes)
+_CODE_HINT = re.compile(r"```|~~~| {4}|\t")
+
+# Text that may make toc do something: ATX headings, setext heading underlines and the
+# [TOC] marker (toc gives headings their ids)
+_HEADING_HINT = re.compile(r"#|\[TOC\]|^[ \t>]*(?:=+|-+)[ \t]*$", re.MULTILINE)
+
+# Idle Markdown engines by extension set, see render_markdown
+_markdown_engines: Dict[Tuple[str, ...], List["markdown.Markdown"]] = {}
+_markdown_engines_lock = threading.Lock()
+
+# Modules (in processors.themes) of the article themes, imported when first used
+theme_modules = {
+    "default": "green_simple",
+    "github": "github",
+    "hammer": "hammer",
+    "dark": "dark",
+    "blue": "blue",
+    "green": "green",
+    "green_simple": "green_simple",
+    "red": "red",
 }
 
 # General content processing
@@ -23,61 +56,252 @@ def process_content(clean_markdown: str, theme: str = "default") -> str:
     Convert clean markdown (with placeholders) to WeChat-styled HTML.
     Applies the selected article theme and injects its CSS as inline styles (for WeChat compatibility).
     """
-    html = markdown.markdown(clean_markdown, extensions=["tables", "fenced_code", "codehilite", "toc"])
-    html = _auto_link_urls(html)
-    theme_mod = theme_map.get(theme, default)
+    return serialize_html(process_content_tree(clean_markdown, theme=theme))
+
+def process_content_tree(
+    clean_markdown: str, theme: str = "default", recorder: Optional[Recorder] = None
+) -> etree._ElementTree:
+    """
+    Same as process_content, but return the styled lxml document instead of a string.
+    The Markdown output is parsed exactly once; every post-processing stage and the
+    CSS inliner modify that one tree in place, so later stages (e.g. image embedding)
+    can keep working on it and the document is serialized only once, by the caller.
+    With a recorder, each stage is timed (see utils.instrumentation).
+    """
+    with measure(recorder, "markdown"):
+        html = render_markdown(clean_markdown)
+    return process_html_tree(html, theme=theme, recorder=recorder)
+
+def render_markdown(clean_markdown: str) -> str:
+    """
+    Render Markdown to HTML as markdown.markdown with MARKDOWN_EXTENSIONS would, but
+    without building an engine and loading its extensions for every document: engines
+    are reset and reused, one thread at a time each. Extensions that can't change the
+    output of a document are left out (see markdown_extensions_for).
+    """
+    extensions = markdown_extensions_for(clean_markdown)
+    with _markdown_engines_lock:
+        idle = _markdown_engines.setdefault(extensions, [])
+        engine = idle.pop() if idle else None
+    if engine is None:
+        import markdown
+
+        engine = markdown.Markdown(extensions=list(extensions))
+    try:
+        return engine.reset().convert(clean_markdown)
+    finally:
+        with _markdown_engines_lock:
+            idle.append(engine)
+
+def markdown_extensions_for(clean_markdown: str) -> Tuple[str, ...]:
+    """
+    The extensions of MARKDOWN_EXTENSIONS a document needs: tables always, fenced_code
+    and codehilite if it may contain a code block, toc if it may contain a heading. The
+    tests are conservative, so leaving an extension out never changes the output.
+    """
+    needed = {"tables"}
+    if _CODE_HINT.search(clean_markdown):
+        needed.update(("fenced_code", "codehilite"))
+    if _HEADING_HINT.search(clean_markdown):
+        needed.add("toc")
+    return tuple(name for name in MARKDOWN_EXTENSIONS if name in needed)
+
+def process_html_tree(
+    html: str, theme: str = "default", recorder: Optional[Recorder] = None
+) -> etree._ElementTree:
+    """
+    Run the post-processing stages and the CSS inliner on the HTML rendered from Markdown.
+    The HTML is wrapped in the themed container before parsing.
+    """
+    from .css_inliner import compile_css, inline_css
+
+    theme_mod = get_theme_module(theme)
+    with measure(recorder, "html_parse"):
+        # Wrap in container for theme selectors
+        tree = parse_html('<div class="wechat-content">' + html + '</div>')
+        container = tree.getroot().find("body/div")
+    with measure(recorder, "autolink"):
+        _auto_link_urls(container)
     if hasattr(theme_mod, "postprocess_html"):
-        html = theme_mod.postprocess_html(html)
-    html = _lists_to_paragraphs(html)
-    html = _add_paragraph_spacing(html, margin_px=16)
-    css = theme_mod.get_css() if hasattr(theme_mod, "get_css") else None
-    # Wrap in container for theme selectors
-    html = '<div class="wechat-content">' + html + '</div>'
+        with measure(recorder, "theme_hook"):
+            # Theme hooks work on markup, so round-trip the container contents for them
+            _replace_contents(container, theme_mod.postprocess_html(serialize_contents(container)))
+    with measure(recorder, "list_rewrite"):
+        _lists_to_paragraphs(container)
+    with measure(recorder, "spacing"):
+        # The whitespace is collapsed after the lists are unwrapped (which joins their
+        # blank text) and before the loose items' blocks leave their <p> (which joins
+        # more that is kept as it is)
+        _collapse_blank_text(container)
+        _close_paragraphs(container)
+        _add_paragraph_spacing(container, margin_px=16)
+    css = get_theme_css(theme)
     # Inline the CSS for WeChat compatibility (removes <style>, applies inline styles)
     if css:
-        html = transform(html, css_text=css, keep_style_tags=False, remove_classes=False)
-    return html
+        with measure(recorder, "css_inline"):
+            inline_css(tree.getroot(), compile_css(css))
+    return tree
+
+def get_theme_css(theme: str = "default") -> Optional[str]:
+    """
+    Return the CSS of an article theme, or None if the theme has no stylesheet.
+    """
+    theme_mod = get_theme_module(theme)
+    return theme_mod.get_css() if hasattr(theme_mod, "get_css") else None
+
+def get_theme_module(theme: str):
+    """
+    Return the module of an article theme (unknown names fall back to the default theme).
+    """
+    name = theme_modules.get(theme, "default")
+    return importlib.import_module(f"{__package__}.themes.{name}")
 
-def _auto_link_urls(html: str) -> str:
+def parse_html(html: str) -> etree._ElementTree:
     """
-    Find standalone URLs in the HTML and convert them into clickable links.
-    Skips URLs already inside <a> tags.
+    Parse an HTML document the same way premailer does (see css_inliner for the fallback to it).
     """
-    url_pattern = re.compile(
-        r'((https?://|www\.)[^\s<>"\']+)', re.IGNORECASE
+    return etree.fromstring(html.strip(), lxml.html.HTMLParser()).getroottree()
+
+def serialize_html(tree: etree._ElementTree) -> str:
+    """
+    Serialize a document produced by process_content_tree (same output format as premailer).
+    """
+    return etree.tostring(tree.getroot(), method="html", encoding="utf-8").decode("utf-8")
+
+def serialize_contents(element) -> str:
+    """
+    Serialize the text and children of an element (the element's own tag is left out).
+    """
+    return (element.text or "") + "".join(
+        etree.tostring(child, method="html", encoding="unicode") for child in element
     )
 
-    def replacer(match):
-        url = match.group(1)
-        href = url if url.startswith("http") else f"http://{url}"
-        return f'<a href="{href}" style="color:#1d4ed8; border-bottom-color:#3b82f6">{url}</a>'
+def _replace_contents(element, html: str):
+    """
+    Replace the children of an element with the nodes parsed from an HTML fragment.
+    """
+    for child in list(element):
+        element.remove(child)
+    element.text = None
+    nodes = lxml.html.fragments_fromstring(html) if html.strip() else []
+    if nodes and isinstance(nodes[0], str):
+        element.text = nodes.pop(0)
+    element.extend(nodes)
+
+def _append_text_before(element, text: str):
+    """
+    Add text right before an element (to the previous sibling's tail or the parent's text).
+    """
+    if not text:
+        return
+    previous = element.getprevious()
+    if previous is not None:
+        previous.tail = (previous.tail or "") + text
+    else:
+        parent = element.getparent()
+        parent.text = (parent.text or "") + text
+
+def _collapse_blank_text(root) -> None:
+    """
+    Collapse whitespace-only text between tags to a single newline (or space),
+    except inside <pre>/<textarea> where whitespace is significant (as the HTML parser
+    the list and spacing stages used to re-parse their output with did).
+    """
+    def collapse(text):
+        if text and not text.strip(" \n\t\f\r"):
+            return "\n" if "\n" in text else " "
+        return text
 
-    soup = BeautifulSoup(html, "html.parser")
-    for text in soup.find_all(string=True):
-        if text.parent.name == "a":
+    preformatted = {element for pre in root.iter("pre", "textarea") for element in pre.iter()}
+    for element in root.iter():
+        if isinstance(element.tag, str) and element not in preformatted:
+            element.text = collapse(element.text)
+        if element is not root and element.getparent() not in preformatted:
+            element.tail = collapse(element.tail)
+
+def _auto_link_urls(root) -> None:
+    """
+    Find standalone URLs in the tree and convert them into clickable links.
+    Skips URLs already inside <a> tags (at any depth).
+
+    Blocks (children of root) whose text has no 'http' or 'www.' are skipped without
+    visiting their elements; in the others, text nodes are split into text and <a>
+    elements in place.
+    """
+    blocks = list(root)
+    _link_text(root)
+    for block in blocks:
+        text = etree.tostring(block, method="text", encoding="unicode", with_tail=True)
+        if not _may_contain_url(text):
             continue
-        new_text = url_pattern.sub(replacer, text)
-        if new_text != text:
-            text.replace_with(BeautifulSoup(new_text, "html.parser"))
-    return str(soup)
+        in_links = {element for link in block.iter("a") for element in link.iter()}
+        for element in list(block.iter()):
+            # Comments and processing instructions only carry their tail as document text
+            if isinstance(element.tag, str) and element not in in_links:
+                _link_text(element)
+            if element.getparent() not in in_links and element.tail and _may_contain_url(element.tail) \
+                    and _URL_PATTERN.search(element.tail):
+                element.tail, links = _split_links(element.tail)
+                anchor = element
+                for link in links:
+                    anchor.addnext(link)
+                    anchor = link
 
-def _lists_to_paragraphs(html: str) -> str:
+def _link_text(element) -> None:
+    """
+    Turn the URLs of an element's text into links (the first children of element).
+    """
+    if not element.text or not _may_contain_url(element.text) or not _URL_PATTERN.search(element.text):
+        return
+    element.text, links = _split_links(element.text)
+    element.insert(0, links[0])
+    anchor = links[0]
+    for link in links[1:]:
+        anchor.addnext(link)
+        anchor = link
+
+def _may_contain_url(text: str) -> bool:
+    # Much cheaper than searching with the case-insensitive _URL_PATTERN
+    lowered = text.lower()
+    return "http" in lowered or "www." in lowered
+
+def _split_links(text: str):
+    """
+    Split text around its URLs. Returns the text before the first URL and the <a>
+    elements (with their tails) that follow.
+    """
+    parts = _URL_PATTERN.split(text)
+    links = []
+    # re.split yields [text, url, scheme, text, url, scheme, ..., text]
+    for i in range(1, len(parts), 3):
+        url, scheme = parts[i], parts[i + 1]
+        link = lxml.html.Element("a")
+        link.set("href", f"http://{url}" if scheme.lower() == "www." else url)
+        link.set("style", "color:#1d4ed8; border-bottom-color:#3b82f6")
+        link.text = url
+        link.tail = parts[i + 2] or None
+        links.append(link)
+    return parts[0] or None, links
+
+def _lists_to_paragraphs(root) -> None:
     """
     Convert <ul>/<ol>/<li> lists to <p> paragraphs for WeChat compatibility.
     Preserves nesting structure with indentation.
     For <ul>, highlight only the content before '：' if present, no vertical line.
+
+    Runs in time linear in the size of the lists: items are converted in one traversal
+    that moves their nodes (nothing is serialized and parsed again).
     """
-    soup = BeautifulSoup(html, "html.parser")
 
     def process_list_items(list_element, indent_level=0):
         """Recursively processes all items in a given list element."""
         margin_left = indent_level * 20  # 20px per nesting level
 
         # Iterate over a static copy of the list items
-        for li in list(list_element.find_all("li", recursive=False)):
-            p = soup.new_tag("p")
-            if list_element.name == "ul":
-                p["class"] = "list-highlight"
+        for li in [child for child in list_element if child.tag == "li"]:
+            p = lxml.html.Element("p")
+            if list_element.tag == "ul":
+                p.set("class", "list-highlight")
 
             # Add indentation for nested items
             base_style = li.get("style", "")
@@ -87,81 +311,194 @@ def _lists_to_paragraphs(html: str) -> str:
                 base_style += f"margin-left:{margin_left}px;"
 
             # Temporarily remove nested lists to isolate li content
-            nested_lists = li.find_all(["ul", "ol"], recursive=False)
+            nested_lists = [child for child in li if child.tag in ("ul", "ol")]
             for nested in nested_lists:
-                nested.extract()
-
-            # Get li content without the nested lists
-            li_html = li.decode_contents()
+                nested.drop_tree()
+                nested.tail = None
 
             # Handle the '：' highlighting logic for ul
-            if list_element.name == "ul" and '：' in li.get_text(strip=False):
-                before, _ = li.get_text(strip=False).split('：', 1)
-                highlight_span = soup.new_tag("span")
-                highlight_span["class"] = "list-highlight-span"
-                highlight_span.string = before + '：'
+            li_text = li.text_content()
+            if list_element.tag == "ul" and '：' in li_text:
+                before, _ = li_text.split('：', 1)
+                highlight_span = lxml.html.Element("span")
+                highlight_span.set("class", "list-highlight-span")
+                highlight_span.text = before + '：'
                 p.append(highlight_span)
 
-                html_split = li_html.split('：', 1)
-                if len(html_split) == 2 and html_split[1].strip():
-                    after_html = BeautifulSoup(html_split[1], "html.parser")
-                    for elem in after_html.contents:
-                        p.append(elem)
+                text, after = _split_after(li, '：')
+                # Like an HTML parser reading the markup after the '：', which drops
+                # leading whitespace before the first element
+                if text.strip():
+                    highlight_span.tail = text
+                p.extend(after)
             else:
-                # No '：' or ordered list, just insert the HTML as-is
-                if li_html.strip():
-                    p.append(BeautifulSoup(li_html, "html.parser"))
+                # No '：' or ordered list, just move the content as-is
+                if (li.text or "").strip() or len(li):
+                    p.text = li.text
+                    p.extend(list(li))
 
-            p["style"] = base_style
+            p.set("style", base_style)
 
             # Replace the li with the new paragraph
-            li.replace_with(p)
+            tail = li.tail
+            list_element.replace(li, p)
+            p.tail = None
+            # Block content of loose list items stays inside the <p> until _close_paragraphs
 
             # Re-insert the nested lists after the new paragraph
-            for nested in reversed(nested_lists):
-                p.insert_after(nested)
+            anchor = p
+            for nested in nested_lists:
+                anchor.addnext(nested)
+                anchor = nested
+            anchor.tail = ((anchor.tail or "") + (tail or "")) or None
 
             # Now that nested lists are back in the document, process them
             for nested in nested_lists:
                 # The recursive call now processes the children and unwraps them
                 process_list_items(nested, indent_level + 1)
-                nested.unwrap()
+                _unwrap(nested)
 
-    # Process all lists, starting from the top-level ones
+    # Process the top-level lists (those not inside another list). Lists that were inside
+    # an item without being its children (e.g. in a blockquote) are top-level once their
+    # item is converted, so they are picked up by the next round.
     while True:
-        # Find a top-level list (one that is not inside another list)
-        top_level_list = soup.find(lambda tag: tag.name in ["ul", "ol"] and not tag.find_parent(["ul", "ol"]))
-        
-        if not top_level_list:
-            break # No more lists to process
+        top_level_lists = list(_top_level_lists(root))
+        if not top_level_lists:
+            break
+        for top_level_list in top_level_lists:
+            process_list_items(top_level_list, 0)
+            _unwrap(top_level_list)  # Remove the container of the top-level list
 
-        process_list_items(top_level_list, 0)
-        top_level_list.unwrap() # Remove the container of the top-level list
+def _top_level_lists(element):
+    """
+    Yield the <ul>/<ol> descendants of element that are not inside another list.
+    """
+    for child in element:
+        if child.tag in ("ul", "ol"):
+            yield child
+        elif len(child):
+            yield from _top_level_lists(child)
+
+def _split_after(element, separator: str):
+    """
+    Detach the content of element following the first occurrence of separator in its
+    text, with the elements enclosing the separator left out (as when parsing the markup
+    after it). Returns the text before the first detached element, and those elements.
+    """
+    leading = []
+    after = []
 
-    return str(soup)
+    def add_text(text):
+        if not text:
+            return
+        if after:
+            after[-1].tail = (after[-1].tail or "") + text
+        else:
+            leading.append(text)
 
-def _add_paragraph_spacing(html: str, margin_px: int = 16) -> str:
+    def add_siblings(node):
+        # node and its following siblings, whole (with their tails)
+        while node is not None:
+            following = node.getnext()
+            after.append(node)
+            node = following
+
+    def add_rest(node):
+        # The tail and following siblings of node, then of each enclosing element, up to
+        # (not including) element
+        while node is not element:
+            add_text(node.tail)
+            add_siblings(node.getnext())
+            node = node.getparent()
+
+    def search(node) -> bool:
+        # Comments and processing instructions only carry their tail as document text
+        if isinstance(node.tag, str):
+            if node.text and separator in node.text:
+                add_text(node.text.split(separator, 1)[1])
+                if len(node):
+                    add_siblings(node[0])
+                add_rest(node)
+                return True
+            for child in node:
+                if search(child):
+                    return True
+        if node is not element and node.tail and separator in node.tail:
+            add_text(node.tail.split(separator, 1)[1])
+            add_siblings(node.getnext())
+            add_rest(node.getparent())
+            return True
+        return False
+
+    search(element)
+    return "".join(leading), after
+
+def _unwrap(element) -> None:
+    """
+    Replace an element with its contents (like lxml.html's drop_tag, but without looking
+    up the element's index, which takes time linear in the number of its siblings).
+    """
+    parent = element.getparent()
+    _append_text_before(element, element.text)
+    children = list(element)
+    if element.tail:
+        if children:
+            children[-1].tail = (children[-1].tail or "") + element.tail
+        else:
+            _append_text_before(element, element.tail)
+    for child in children:
+        element.addprevious(child)
+    element.tail = None
+    parent.remove(element)
+
+def _close_paragraphs(root) -> None:
+    """
+    Close the <p> elements holding block content (the blocks of loose list items).
+    """
+    for p in list(root.iter("p")):
+        tail = p.tail
+        p.tail = None
+        anchor = _close_paragraph(p)
+        anchor.tail = ((anchor.tail or "") + (tail or "")) or None
+
+def _close_paragraph(p):
+    """
+    Move everything from the first block-level child of p onwards to follow p,
+    the way an HTML parser closes an open <p> when a block element starts.
+    Returns the last node now following p (or p itself if nothing moved).
+    """
+    for index, child in enumerate(p):
+        if child.tag in _PARAGRAPH_CLOSING_TAGS:
+            break
+    else:
+        return p
+    anchor = p
+    for child in p[index:]:
+        anchor.addnext(child)
+        anchor = child
+    return anchor
+
+def _add_paragraph_spacing(root, margin_px: int = 16) -> None:
     """
     Add inline margin-bottom to all <p> tags for WeChat compatibility.
     Excludes paragraphs containing code block placeholders.
     """
-    soup = BeautifulSoup(html, "html.parser")
-    for p in soup.find_all("p"):
+    for p in list(root.iter("p")):
         # Skip paragraphs that contain code block placeholders
-        text_content = p.get_text(strip=False)
-        if text_content.startswith("{{CODE_BLOCK_PLACEHOLDER_") and text_content.endswith("}}"):
+        text_content = p.text_content()
+        if text_content.startswith(PLACEHOLDER_START) and text_content.endswith(PLACEHOLDER_END):
             # Remove the <p> wrapper from code block placeholders
-            p.replace_with(text_content)
+            _append_text_before(p, text_content + (p.tail or ""))
+            p.getparent().remove(p)
             continue
-            
+
         style = p.get("style", "")
         # Ensure margin-bottom is set (append or update)
         if "margin-bottom" not in style:
             if style and not style.strip().endswith(";"):
                 style += ";"
             style += f"margin-bottom:{margin_px}px;"
-        p["style"] = style
-    return str(soup)
+        p.set("style", style)
 
 
 
@@ -171,4 +508,4 @@ def _add_paragraph_spacing(html: str, margin_px: int = 16) -> str:
 # ✅ Preserves content order
 # ✅ Maintains proper indentation
 # ✅ Avoids processing conflicts
-# ✅ WeChat compatibility
\ No newline at end of file
+# ✅ WeChat compatibility
@@ -0,0 +1,277 @@
+"""
+Compiled CSS inliner for the article themes.
+
+premailer re-parses the theme CSS, recomputes selector specificity and merges
+declarations for every document. The themes never change while the process runs,
+so compile_css turns a stylesheet into a cached rule table once and inline_css
+applies that table to a document tree. The result matches
+``premailer.transform(html, css_text=css, keep_style_tags=False, remove_classes=False)``.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import cssutils
+from lxml import etree
+from lxml.cssselect import CSSSelector
+
+# Pseudo-classes premailer still inlines; every other pseudo selector is kept in a <style> tag
+_FILTER_PSEUDOSELECTORS = (":last-child", ":first-child", ":nth-child")
+_element_selector_regex = re.compile(r"(^|\s)\w")
+_short_color_codes = re.compile(r"^#([0-9a-f])([0-9a-f])([0-9a-f])$", re.I)
+_combinator_regex = re.compile(r"\s*[\s>+~]\s*")
+_attribute_selector_regex = re.compile(r"\[[^\]]*\]")
+_class_selector_regex = re.compile(r"\.([-\w]+)")
+_tag_selector_regex = re.compile(r"^[A-Za-z][-\w]*")
+
+# Documents that bring their own stylesheets are handed to premailer unchanged (the only
+# case premailer, and the requests library it pulls in, gets imported)
+_embedded_stylesheets = CSSSelector("style,link[rel~=stylesheet]")
+
+# cssutils is not thread-safe
+_cssutils_lock = threading.RLock()
+
+# Upper bound on memoized (matched rules, inline style) merges per stylesheet
+_MERGE_CACHE_SIZE = 4096
+
+
+class _Rule:
+    """
+    One selector of a stylesheet with its pre-parsed declarations.
+
+    tag/classes are the prerequisites the document must contain for the selector
+    to possibly match, so rules can be skipped without running the selector.
+    """
+
+    __slots__ = ("selector", "xpath", "declarations", "tag", "classes")
+
+    def __init__(self, selector: str, declarations: List[Tuple[str, str]]):
+        self.selector = selector
+        self.xpath = etree.XPath(CSSSelector(selector).path)
+        self.declarations = declarations
+        plain = _attribute_selector_regex.sub("", selector)
+        subject = _combinator_regex.split(plain.strip())[-1]
+        tag = _tag_selector_regex.match(subject)
+        self.tag = tag.group(0) if tag else None
+        self.classes = frozenset(_class_selector_regex.findall(plain))
+
+
+class CompiledCSS:
+    """
+    A stylesheet parsed once into inlinable rules (sorted by specificity) and the
+    leftover CSS that has to stay in a <style> tag (pseudo-classes, media rules).
+    """
+
+    def __init__(self, css_text: str, rules: List[_Rule], leftover_css: Optional[str]):
+        self.css_text = css_text
+        self.rules = rules
+        self.leftover_css = leftover_css
+        self._merged: Dict[Tuple[Tuple[int, ...], str], Tuple[str, Tuple[Tuple[str, str], ...]]] = {}
+
+    def merge(self, rule_ids: Tuple[int, ...], inline_style: str) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+        """
+        Return the final style attribute and the basic HTML attributes derived from it
+        for an element matched by the given rules (memoized per combination).
+        """
+        key = (rule_ids, inline_style)
+        merged = self._merged.get(key)
+        if merged is None:
+            if len(self._merged) >= _MERGE_CACHE_SIZE:
+                self._merged.clear()
+            final_style = _merge_styles(
+                inline_style, [self.rules[i].declarations for i in rule_ids]
+            )
+            merged = (final_style, _basic_html_attributes(final_style))
+            self._merged[key] = merged
+        return merged
+
+
+@lru_cache(maxsize=32)
+def compile_css(css_text: str) -> CompiledCSS:
+    """
+    Parse a theme stylesheet into a CompiledCSS (cached per stylesheet text).
+    """
+    with _cssutils_lock:
+        sheet = cssutils.parseString(css_text, validate=True)
+
+    rules = []
+    leftover = []
+    for rule in sheet:
+        if rule.type == rule.MEDIA_RULE:
+            leftover.append(_media_rule_to_string(rule))
+            continue
+        if rule.type != rule.STYLE_RULE:
+            continue
+
+        properties = rule.style.getProperties()
+        normal = [prop for prop in properties if prop.priority != "important"]
+        important = [prop for prop in properties if prop.priority == "important"]
+        bulk_normal = _join_properties(normal)
+        bulk_important = _join_properties(important)
+        bulk_all = _join_properties(normal + important)
+
+        selectors = (
+            x.strip()
+            for x in rule.selectorText.split(",")
+            if x.strip() and not x.strip().startswith("@")
+        )
+        for selector in selectors:
+            if ":" in selector and ":" + selector.split(":", 1)[1] not in _FILTER_PSEUDOSELECTORS:
+                leftover.append("%s {%s}" % (selector, _make_important(bulk_all)))
+                continue
+            elif "*" in selector or selector.startswith(":"):
+                continue
+
+            specificity = (
+                selector.count("#"),
+                selector.count("."),
+                len(_element_selector_regex.findall(selector)),
+            )
+            # !important declarations form their own rule that sorts above all normal ones
+            for is_important, bulk in ((1, bulk_important), (0, bulk_normal)):
+                if bulk:
+                    rules.append(((is_important,) + specificity + (len(rules),), selector, bulk))
+
+    rules.sort(key=lambda rule: rule[0])
+    compiled_rules = [
+        _Rule(selector, list(_csstext_to_pairs(bulk))) for _, selector, bulk in rules
+    ]
+    return CompiledCSS(css_text, compiled_rules, "\n".join(leftover) if leftover else None)
+
+
+def inline_css(root, compiled: CompiledCSS) -> None:
+    """
+    Apply a compiled stylesheet to a document (the root <html> element) in place:
+    matching declarations become inline styles, the rest goes to a <style> tag in <head>.
+    """
+    if _embedded_stylesheets(root):
+        from premailer import transform
+
+        # premailer also inlines stylesheets found in the document itself
+        transform(root, css_text=compiled.css_text, keep_style_tags=False, remove_classes=False)
+        return
+
+    head = root.find("head")
+    if head is None:
+        head = root.makeelement("head", {})
+        root.find("body").getparent().insert(0, head)
+    if compiled.leftover_css is not None:
+        style = root.makeelement("style", {"type": "text/css"})
+        style.text = compiled.leftover_css
+        head.append(style)
+
+    tags = set()
+    classes = set()
+    for element in root.iter():
+        if isinstance(element.tag, str):
+            tags.add(element.tag)
+            class_attr = element.get("class")
+            if class_attr:
+                classes.update(class_attr.split())
+
+    matched: "OrderedDict[etree._Element, List[int]]" = OrderedDict()
+    for rule_id, rule in enumerate(compiled.rules):
+        if rule.tag is not None and rule.tag not in tags:
+            continue
+        if not rule.classes <= classes:
+            continue
+        for element in rule.xpath(root):
+            matched.setdefault(element, []).append(rule_id)
+
+    for element, rule_ids in matched.items():
+        final_style, attributes = compiled.merge(tuple(rule_ids), element.get("style", ""))
+        if final_style:
+            element.set("style", final_style)
+        for key, value in attributes:
+            element.set(key, value)
+
+    # Outlook-style align attribute for floated images, as premailer does
+    for img in root.iter("img"):
+        style = img.get("style")
+        if style is not None:
+            align = _image_float(style)
+            if align in ("left", "right"):
+                img.set("align", align)
+
+
+def _join_properties(properties) -> str:
+    return ";".join("{0}:{1}".format(prop.name, prop.value) for prop in properties)
+
+
+def _make_important(bulk: str) -> str:
+    return ";".join(
+        "%s !important" % p if not p.endswith("!important") else p for p in bulk.split(";")
+    )
+
+
+def _media_rule_to_string(rule) -> str:
+    for inner in rule.cssRules:
+        if isinstance(inner, (cssutils.css.CSSComment, cssutils.css.CSSUnknownRule)):
+            continue
+        for key in inner.style.keys():
+            inner.style[key] = (inner.style.getPropertyValue(key, False), "!important")
+    return rule.cssText
+
+
+@lru_cache(maxsize=1024)
+def _csstext_to_pairs(css_text: str) -> Tuple[Tuple[str, str], ...]:
+    """
+    (name, value) pairs of a declaration list, as premailer.merge_style.csstext_to_pairs.
+    """
+    with _cssutils_lock:
+        return tuple(
+            (prop.name.strip(), _format_value(prop))
+            for prop in cssutils.parseStyle(css_text, validate=True)
+        )
+
+
+def _format_value(prop) -> str:
+    value = prop.propertyValue.cssText.strip()
+    return value + " !important" if prop.priority == "important" else value
+
+
+def _merge_styles(inline_style: str, new_styles: List[List[Tuple[str, str]]]) -> str:
+    """
+    Merge rule declarations in specificity order, then the element's own inline style
+    on top; 'unset' values are dropped (premailer's remove_unset_properties).
+    """
+    merged = OrderedDict()
+    for declarations in new_styles:
+        for key, value in declarations:
+            merged[key] = value
+    if inline_style:
+        for key, value in _csstext_to_pairs(inline_style):
+            merged[key] = value
+    return "; ".join(
+        "%s:%s" % (key, value) for key, value in merged.items() if value.lower() != "unset"
+    ).strip()
+
+
+def _basic_html_attributes(style: str) -> Tuple[Tuple[str, str], ...]:
+    """
+    HTML attributes premailer mirrors from inline styles (align, valign, bgcolor, width, height).
+    """
+    attributes = OrderedDict()
+    for key, value in [x.split(":") for x in style.split(";") if len(x.split(":")) == 2]:
+        key = key.strip()
+        if key == "text-align":
+            attributes["align"] = value.strip()
+        elif key == "vertical-align":
+            attributes["valign"] = value.strip()
+        elif key == "background-color" and "transparent" not in value.lower():
+            attributes["bgcolor"] = _short_color_codes.sub(r"#\1\1\2\2\3\3", value.strip())
+        elif key == "width" or key == "height":
+            value = value.strip()
+            if value.endswith("px"):
+                value = value[:-2]
+            attributes[key] = value
+    return tuple(attributes.items())
+
+
+@lru_cache(maxsize=256)
+def _image_float(style: str) -> str:
+    with _cssutils_lock:
+        return cssutils.parseStyle(style).float
@@ -1,16 +1,82 @@
 """
 Image processor for embedding local images as base64 in HTML.
-Supports optional image compression and format conversion.
+Supports optional image compression and format conversion, and embedding remote images
+downloaded by a fetch function (see utils.image_fetcher).
 """
 
 import base64
+import hashlib
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from io import BytesIO
 from pathlib import Path
-from typing import Optional, Tuple, List
+from typing import (
+    TYPE_CHECKING, Callable, Dict, Iterator, Mapping, MutableMapping, NamedTuple, Optional, Sequence, Tuple,
+    List, Union,
+)
 from urllib.parse import unquote
 
-from bs4 import BeautifulSoup
-from PIL import Image
+from ..utils.instrumentation import Recorder, count
+
+# Pillow and BeautifulSoup are imported by the first image encoded (or HTML string parsed),
+# so the finders below and documents without images never load them
+if TYPE_CHECKING:
+    from PIL import Image
+
+# <img ... src="..."> tags and Markdown ![alt](src "title") images
+_image_reference_pattern = re.compile(
+    r"""<img\b[^>]*?\bsrc\s*=\s*["']([^"']+)["']|!\[[^\]]*\]\(\s*<?([^)\s>]+)>?(?:\s+[^)]*)?\)""",
+    re.IGNORECASE,
+)
+
+# When downscaling, how much larger than the target the image is kept before the final
+# LANCZOS pass (JPEG DCT scaling and integer reduction only go down to this). 2 is the
+# default of Image.thumbnail; the result stays within ~1/255 per pixel (PSNR > 50 dB) of
+# a LANCZOS resize from full resolution.
+_REDUCING_GAP = 2.0
+
+# Formats encoded with a quality setting, and the lowest quality (and width) used to fit
+# an image in a byte budget. Lowering the quality rarely shrinks an image more than
+# _QUALITY_REACH times; beyond that it is scaled down first.
+_LOSSY_FORMATS = ("JPEG", "WEBP")
+_MIN_QUALITY = 30
+_MIN_FIT_WIDTH = 64
+_QUALITY_REACH = 4
+
+# Downloads remote image URLs: returns the local file, or the exception raised, per URL
+# (e.g. ImageFetcher.fetch_all)
+FetchImages = Callable[[Sequence[str]], Mapping[str, Union[Path, Exception]]]
+
+# Default budget for the decoded pixels of the images being encoded at the same time
+DEFAULT_IMAGE_MEMORY = 256 * 1024 * 1024
+
+
+class _PixelBudget:
+    """
+    Bounds the decoded size of the images encoded at the same time. An image larger than
+    the whole budget is still encoded, but only once nothing else is in flight.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size: int) -> Iterator[None]:
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_use == 0 or self.in_use + size <= self.limit)
+            self.in_use += size
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_use -= size
+                self._condition.notify_all()
 
 
 def process_images(
@@ -20,6 +86,15 @@ def process_images(
     image_quality: int = 85,
     max_width: Optional[int] = None,
     base_dir: Optional[Path] = None,
+    cache: Optional[MutableMapping[str, str]] = None,
+    workers: Optional[int] = None,
+    max_pixel_bytes: int = DEFAULT_IMAGE_MEMORY,
+    max_bytes: Optional[int] = None,
+    total_bytes: Optional[int] = None,
+    sizes: Optional[Dict[str, int]] = None,
+    fetch: Optional[FetchImages] = None,
+    recorder: Optional[Recorder] = None,
+    confine: bool = False,
 ) -> Tuple[str, List[str], List[str]]:
     """
     Process images in HTML, embedding local images as base64 data URIs.
@@ -31,6 +106,20 @@ def process_images(
         image_quality: Quality for lossy formats (1-100, default 85)
         max_width: Optional max width to resize images to (in pixels)
         base_dir: Base directory for resolving relative image paths. If None, uses cwd.
+        cache: Optional dict-like store of encoded data URIs (see image_cache_key)
+        workers: Threads decoding and encoding images (default: up to 4, one per CPU)
+        max_pixel_bytes: Budget for the decoded pixels of the images encoded at the same time
+        max_bytes: Optional budget for each encoded image (in bytes, before base64). Quality,
+            then size, is lowered as needed to fit.
+        total_bytes: Optional budget for all the embedded images together, shared out in
+            proportion to their sizes at image_quality
+        sizes: Optional dict to fill with the encoded size of each embedded image, by src
+        fetch: Optional function downloading http(s):// images, which are then embedded
+            like local ones (otherwise they are left as is)
+        recorder: Optional recorder counting the images, cache hits and encodings
+        confine: Only embed local images inside base_dir (for documents from untrusted
+            sources): absolute and ../ paths leading elsewhere are reported as errors
+            (see utils.instrumentation)
 
     Returns:
         Tuple of (processed_html, warnings, errors)
@@ -38,59 +127,422 @@ def process_images(
     if not embed_images:
         return html, [], []
 
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html, "html.parser")
     warnings = []
     errors = []
 
-    for img in soup.find_all("img"):
-        src = img.get("src")
+    images = [img for img in soup.find_all("img") if img.get("src") is not None]
+    data_uris = _embed_images(
+        [str(img["src"]) for img in images], warnings, errors,
+        _Encoding(image_format, image_quality, max_width, max_bytes), base_dir, cache,
+        workers, max_pixel_bytes, total_bytes, sizes, fetch, recorder, confine,
+    )
+    for img, data_uri in zip(images, data_uris):
+        if data_uri is not None:
+            img["src"] = data_uri
 
-        if src is None:
-            continue
+    return str(soup), warnings, errors
 
-        src_str = str(src)
 
-        if not src_str or src_str.startswith("data:"):
-            continue
+def process_images_tree(
+    tree,
+    image_format: Optional[str] = None,
+    image_quality: int = 85,
+    max_width: Optional[int] = None,
+    base_dir: Optional[Path] = None,
+    cache: Optional[MutableMapping[str, str]] = None,
+    workers: Optional[int] = None,
+    max_pixel_bytes: int = DEFAULT_IMAGE_MEMORY,
+    max_bytes: Optional[int] = None,
+    total_bytes: Optional[int] = None,
+    sizes: Optional[Dict[str, int]] = None,
+    fetch: Optional[FetchImages] = None,
+    recorder: Optional[Recorder] = None,
+    confine: bool = False,
+) -> Tuple[List[str], List[str]]:
+    """
+    Embed local images of an lxml document (see content_processor.process_content_tree) in place.
 
-        if src_str.startswith("http://") or src_str.startswith("https://"):
-            continue
+    Takes the same image options as process_images, but works on the already parsed tree
+    instead of re-parsing and re-serializing the whole document.
+
+    Returns:
+        Tuple of (warnings, errors)
+    """
+    warnings = []
+    errors = []
 
-        # URL decode to handle Chinese characters and special characters in filenames
-        src_str = unquote(src_str)
+    images = [img for img in tree.iter("img") if img.get("src") is not None]
+    data_uris = _embed_images(
+        [img.get("src") for img in images], warnings, errors,
+        _Encoding(image_format, image_quality, max_width, max_bytes), base_dir, cache,
+        workers, max_pixel_bytes, total_bytes, sizes, fetch, recorder, confine,
+    )
+    for img, data_uri in zip(images, data_uris):
+        if data_uri is not None:
+            img.set("src", data_uri)
 
-        try:
-            image_path = Path(src_str)
-            if not image_path.is_absolute():
-                if base_dir is not None:
-                    image_path = base_dir / src_str
-                else:
-                    image_path = Path.cwd() / src_str
-
-            if not image_path.exists():
-                errors.append(f"Image not found: {image_path}")
-                continue
-
-            data_uri = _image_to_data_uri(
-                image_path, format=image_format, quality=image_quality, max_width=max_width
+    return warnings, errors
+
+
+class _Encoding(NamedTuple):
+    """
+    How an image is encoded (see _image_to_data_uri).
+    """
+    format: Optional[str]
+    quality: int
+    max_width: Optional[int]
+    max_bytes: Optional[int]
+
+
+def _embed_images(
+    sources: Sequence[str],
+    warnings: List[str],
+    errors: List[str],
+    encoding: _Encoding,
+    base_dir: Optional[Path],
+    cache: Optional[MutableMapping[str, str]],
+    workers: Optional[int],
+    max_pixel_bytes: int,
+    total_bytes: Optional[int] = None,
+    sizes: Optional[Dict[str, int]] = None,
+    fetch: Optional[FetchImages] = None,
+    recorder: Optional[Recorder] = None,
+    confine: bool = False,
+) -> List[Optional[str]]:
+    """
+    Resolve <img> srcs (downloading remote ones with fetch, if given) and encode them as
+    data URIs, the images that are not cached yet on a thread pool (Pillow releases the
+    GIL while decoding, resizing and encoding).
+
+    Problems are appended to warnings/errors in document order. Returns the data URI for
+    each src, or None when it should be left as is.
+    """
+    count(recorder, "images", len(sources))
+    outside = {src for src in sources if is_outside_base_dir(src, base_dir)} if confine else set()
+    if outside:
+        # Never read: left as is, like srcs that aren't images
+        local_sources = ["" if src in outside else src for src in sources]
+    else:
+        local_sources = sources
+    remote: Mapping[str, Union[Path, Exception]] = {}
+    if fetch is not None:
+        urls = [src for src in sources if is_remote_image(src)]
+        if urls:
+            remote = fetch(urls)
+    encodings = [encoding] * len(sources)
+    keys, encoded = _encode_images(
+        local_sources, encodings, base_dir, remote, cache, workers, max_pixel_bytes, recorder=recorder
+    )
+    if total_bytes is not None:
+        image_sizes = [
+            _data_uri_size(encoded[key]) if isinstance(encoded.get(key), str) else 0
+            for key in keys
+        ]
+        total = sum(image_sizes)
+        if total > total_bytes:
+            # Images under an even share of the budget are kept as they are; the others
+            # share the rest in proportion to their sizes at the requested quality
+            even_share = total_bytes / sum(1 for size in image_sizes if size)
+            small = sum(size for size in image_sizes if size <= even_share)
+            ratio = (total_bytes - small) / (total - small)
+            encodings = [
+                encoding._replace(max_bytes=max(1, int(size * ratio)))
+                if size > even_share else encoding
+                for size in image_sizes
+            ]
+            _encode_images(
+                local_sources, encodings, base_dir, remote, cache, workers, max_pixel_bytes, encoded,
+                recorder,
             )
-            img["src"] = data_uri
 
-            size_kb = len(base64.b64decode(data_uri.split(",")[1])) / 1024
-            if size_kb > 500:
+    data_uris: List[Optional[str]] = []
+    for src, image_encoding in zip(sources, encodings):
+        if src in outside:
+            errors.append(f"Image outside the base directory: {unquote(src)}")
+            data_uris.append(None)
+        else:
+            data_uris.append(
+                _embed_image(src, warnings, errors, image_encoding, base_dir, cache, encoded, remote)
+            )
+    embedded = [(src, data_uri) for src, data_uri in zip(sources, data_uris) if data_uri is not None]
+    if total_bytes is not None:
+        total = sum(_data_uri_size(data_uri) for _, data_uri in embedded)
+        if total > total_bytes:
+            warnings.append(
+                f"Embedded images total {total / 1024:.1f} KB, over the budget of "
+                f"{total_bytes / 1024:.1f} KB."
+            )
+    if sizes is not None:
+        for src, data_uri in embedded:
+            sizes[unquote(src)] = _data_uri_size(data_uri)
+    return data_uris
+
+
+def _encode_images(
+    sources: Sequence[str],
+    encodings: Sequence[_Encoding],
+    base_dir: Optional[Path],
+    remote: Mapping[str, Union[Path, Exception]],
+    cache: Optional[MutableMapping[str, str]],
+    workers: Optional[int],
+    max_pixel_bytes: int,
+    encoded: Optional[Dict[str, Union[str, Exception]]] = None,
+    recorder: Optional[Recorder] = None,
+) -> Tuple[List[Optional[str]], Dict[str, Union[str, Exception]]]:
+    """
+    Look up the distinct images of sources in the cache and encode the others, in parallel
+    when there are several, adding them to the cache.
+
+    Returns the image cache key of each src (None if it is neither a local image nor a
+    fetched one in remote, or cannot be read), and the data URI, or the exception raised, per key: the encoded dict if
+    given (keys already in it are not looked up again), else a new one.
+    """
+    keys: List[Optional[str]] = []
+    if encoded is None:
+        encoded = {}
+    pending: Dict[str, Tuple[Path, _Encoding]] = {}
+    for src, encoding in zip(sources, encodings):
+        image_path = remote.get(src) or resolve_image_path(src, base_dir)
+        key = None
+        if isinstance(image_path, Exception):
+            # Reported by _embed_image
+            image_path = None
+        if image_path is not None:
+            try:
+                key = image_cache_key(image_path, *encoding)
+            except OSError:
+                # Missing or unreadable, reported by _embed_image
+                pass
+        keys.append(key)
+        if key is None or key in encoded or key in pending:
+            continue
+        data_uri = cache.get(key) if cache is not None else None
+        if data_uri is not None:
+            encoded[key] = data_uri
+            count(recorder, "image_cache_hits")
+        else:
+            pending[key] = (image_path, encoding)
+    count(recorder, "images_encoded", len(pending))
+    if workers is None:
+        workers = min(4, os.cpu_count() or 1)
+
+    budget = _PixelBudget(max_pixel_bytes)
+
+    def encode(job: Tuple[Path, _Encoding]) -> Union[str, Exception]:
+        image_path, encoding = job
+        try:
+            with budget.reserve(_decoded_size(image_path, encoding.max_width)):
+                return _image_to_data_uri(image_path, *encoding)
+        except Exception as e:
+            return e
+
+    if len(pending) < 2 or workers < 2:
+        results = [encode(job) for job in pending.values()]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(pending))) as pool:
+            results = list(pool.map(encode, pending.values()))
+    for key, data_uri in zip(pending, results):
+        encoded[key] = data_uri
+        if cache is not None and isinstance(data_uri, str):
+            cache[key] = data_uri
+    return keys, encoded
+
+
+def _decoded_size(image_path: Path, max_width: Optional[int] = None) -> int:
+    """
+    Estimate the memory taken by the decoded pixels of an image (Pillow stores most
+    modes with 4 bytes per pixel), scaled down as _image_to_data_uri decodes it for
+    max_width. Only the header is read.
+    """
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        target_size = _target_size(img.size, max_width)
+        if target_size is not None:
+            _draft(img, target_size)
+        return img.width * img.height * 4
+
+
+def _embed_image(
+    src_str: str,
+    warnings: List[str],
+    errors: List[str],
+    encoding: _Encoding,
+    base_dir: Optional[Path],
+    cache: Optional[MutableMapping[str, str]] = None,
+    encoded: Optional[Dict[str, Union[str, Exception]]] = None,
+    remote: Optional[Mapping[str, Union[Path, Exception]]] = None,
+) -> Optional[str]:
+    """
+    Resolve a single <img> src and encode it as a data URI (unless encoded, see
+    _encode_images, already holds the result). Remote srcs are embedded from their
+    download in remote, if any.
+
+    Problems are appended to warnings/errors. Returns None when the src should be left as is.
+    """
+    fetched = remote.get(src_str) if remote else None
+    if isinstance(fetched, Exception):
+        # The remote image still displays where it is reachable
+        warnings.append(f"Could not fetch image {src_str}: {fetched}")
+        return None
+    image_path = fetched if fetched is not None else resolve_image_path(src_str, base_dir)
+    if image_path is None:
+        return None
+    name = src_str if fetched is not None else image_path.name
+    # Decoded form, for messages
+    src_str = unquote(src_str)
+
+    try:
+        if not image_path.exists():
+            errors.append(f"Image not found: {image_path}")
+            return None
+
+        key = image_cache_key(image_path, *encoding)
+        data_uri = encoded.get(key) if encoded else None
+        if isinstance(data_uri, Exception):
+            raise data_uri
+        if data_uri is None and cache is not None:
+            data_uri = cache.get(key)
+        if data_uri is None:
+            data_uri = _image_to_data_uri(image_path, *encoding)
+            if cache is not None:
+                cache[key] = data_uri
+
+        size_kb = _data_uri_size(data_uri) / 1024
+        if encoding.max_bytes is not None:
+            if size_kb * 1024 > encoding.max_bytes:
                 warnings.append(
-                    f"Embedded image {image_path.name} is large ({size_kb:.1f} KB). "
-                    "Consider using a smaller image or external hosting."
+                    f"Embedded image {name} ({size_kb:.1f} KB) does not fit in its "
+                    f"budget of {encoding.max_bytes / 1024:.1f} KB even at the lowest quality and size."
                 )
+        elif size_kb > 500:
+            warnings.append(
+                f"Embedded image {name} is large ({size_kb:.1f} KB). "
+                "Consider using a smaller image or external hosting."
+            )
+        return data_uri
 
-        except FileNotFoundError:
-            errors.append(f"Image file not found: {src_str}")
-        except PermissionError:
-            errors.append(f"Permission denied reading image: {src_str}")
-        except Exception as e:
-            errors.append(f"Error processing image {src_str}: {str(e)}")
+    except FileNotFoundError:
+        errors.append(f"Image file not found: {src_str}")
+    except PermissionError:
+        errors.append(f"Permission denied reading image: {src_str}")
+    except Exception as e:
+        errors.append(f"Error processing image {src_str}: {str(e)}")
+    return None
+
+
+def _data_uri_size(data_uri: str) -> int:
+    """
+    Size of the data encoded in a base64 data URI, without decoding it.
+    """
+    encoded_length = len(data_uri) - data_uri.index(",") - 1
+    return encoded_length * 3 // 4 - data_uri.count("=", len(data_uri) - 2)
 
-    return str(soup), warnings, errors
+
+def resolve_image_path(src: str, base_dir: Optional[Path] = None) -> Optional[Path]:
+    """
+    Resolve an <img> src to the local file that would be embedded.
+
+    Args:
+        src: The src attribute value (may be URL-encoded)
+        base_dir: Base directory for relative paths. If None, uses cwd.
+
+    Returns:
+        The image path, or None for empty, data: and http(s):// sources
+    """
+    if not src or src.startswith("data:"):
+        return None
+
+    if is_remote_image(src):
+        return None
+
+    # URL decode to handle Chinese characters and special characters in filenames
+    src = unquote(src)
+
+    image_path = Path(src)
+    if not image_path.is_absolute():
+        image_path = (base_dir if base_dir is not None else Path.cwd()) / src
+    return image_path
+
+
+def is_outside_base_dir(src: str, base_dir: Optional[Path] = None) -> bool:
+    """
+    Whether an <img> src is a local file outside base_dir (the cwd if None), e.g. an
+    absolute path or one going up with ../, once symbolic links are resolved.
+    """
+    image_path = resolve_image_path(src, base_dir)
+    if image_path is None:
+        return False
+    root = Path(base_dir).resolve() if base_dir is not None else Path.cwd().resolve()
+    return not image_path.resolve().is_relative_to(root)
+
+
+def is_remote_image(src: str) -> bool:
+    """
+    Whether an <img> src is an http(s):// URL.
+    """
+    return src.startswith("http://") or src.startswith("https://")
+
+
+def image_cache_key(
+    image_path: Path,
+    format: Optional[str] = None,
+    quality: int = 85,
+    max_width: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+) -> str:
+    """
+    Cache key for the data URI of an image: a hash of the file content plus the encoding
+    options, so editing the file (or changing an option) yields a new key while copies
+    of an image share one.
+
+    The hash is remembered (see image_content_hash), so unchanged files are only read
+    once per process.
+    """
+    return f"{image_content_hash(image_path)}|{format}|{quality}|{max_width}|{max_bytes}"
+
+
+def image_content_hash(image_path: Path) -> str:
+    """
+    SHA-256 of an image file, remembered per path, size and modification time.
+    """
+    stat = image_path.stat()
+    return _file_hash(str(image_path.resolve()), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=4096)
+def _file_hash(path: str, size: int, mtime_ns: int) -> str:
+    # size and mtime_ns only key the cache, so an edited file is hashed again
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def find_local_images(markdown: str, base_dir: Optional[Path] = None) -> List[Path]:
+    """
+    List the local image files a Markdown document refers to (<img> tags and ![alt](src)),
+    resolved the same way process_images does. Files are not checked for existence.
+    """
+    paths = []
+    for match in _image_reference_pattern.finditer(markdown):
+        image_path = resolve_image_path(match.group(1) or match.group(2), base_dir)
+        if image_path is not None and image_path not in paths:
+            paths.append(image_path)
+    return paths
+
+
+def find_remote_images(markdown: str) -> List[str]:
+    """
+    List the http(s):// image URLs a Markdown document refers to (<img> tags and ![alt](src)).
+    """
+    urls = []
+    for match in _image_reference_pattern.finditer(markdown):
+        src = match.group(1) or match.group(2)
+        if is_remote_image(src) and src not in urls:
+            urls.append(src)
+    return urls
 
 
 def _image_to_data_uri(
@@ -98,6 +550,7 @@ def _image_to_data_uri(
     format: Optional[str] = None,
     quality: int = 85,
     max_width: Optional[int] = None,
+    max_bytes: Optional[int] = None,
 ) -> str:
     """
     Convert an image file to a base64 data URI with optional compression.
@@ -107,11 +560,20 @@ def _image_to_data_uri(
         format: Optional format to convert to (e.g., 'webp', 'jpeg')
         quality: Quality for lossy formats (1-100)
         max_width: Optional max width to resize to
+        max_bytes: Optional size budget for the encoded image; quality, then size, is
+            lowered as needed to fit (see _fit_to_budget)
 
     Returns:
         Data URI string (e.g., "data:image/jpeg;base64,...")
     """
+    from PIL import Image
+
     with Image.open(image_path) as img:
+        # Decide from the header whether to downscale, before anything is decoded
+        target_size = _target_size(img.size, max_width)
+        if target_size is not None:
+            _draft(img, target_size)
+
         # Convert RGBA to RGB if target format doesn't support transparency
         if format in ["jpeg", "jpg"] and img.mode == "RGBA":
             # Create white background
@@ -121,11 +583,10 @@ def _image_to_data_uri(
         elif format and format.lower() in ["jpeg", "jpg"]:
             img = img.convert("RGB")
 
-        # Resize if max_width is specified
-        if max_width and img.width > max_width:
-            # Calculate new height maintaining aspect ratio
-            new_height = int(img.height * (max_width / img.width))
-            img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
+        # Resize if max_width is specified: reduce by an integer factor first (box filter, cheap)
+        # as long as LANCZOS still gets _REDUCING_GAP times the target size to work from
+        if target_size is not None:
+            img = img.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=_REDUCING_GAP)
 
         # Determine output format
         output_format = format.upper() if format else img.format
@@ -134,31 +595,110 @@ def _image_to_data_uri(
         if not output_format:
             output_format = "PNG"
 
-        # Save to bytes buffer
-        from io import BytesIO
+        data = _save(img, output_format, quality)
+        if max_bytes is not None and len(data) > max_bytes:
+            data = _fit_to_budget(img, output_format, quality, max_bytes, data)
+
+        # Encode to base64
+        image_data = base64.b64encode(data).decode("utf-8")
+
+        # Determine MIME type
+        mime_type = _format_to_mime_type(output_format)
+
+        return f"data:{mime_type};base64,{image_data}"
 
-        buffer = BytesIO()
 
-        # Handle compression parameters
-        save_kwargs = {"format": output_format}
+def _save(img: "Image.Image", output_format: str, quality: int) -> bytes:
+    """
+    Encode an image in memory.
+    """
+    buffer = BytesIO()
 
-        # Add quality parameter for formats that support it
-        if output_format in ["JPEG", "WEBP"]:
-            save_kwargs["quality"] = quality
+    # Handle compression parameters
+    save_kwargs = {"format": output_format}
 
-        # Handle PNG optimization
-        if output_format == "PNG":
-            save_kwargs["optimize"] = True
+    # Add quality parameter for formats that support it
+    if output_format in _LOSSY_FORMATS:
+        save_kwargs["quality"] = quality
 
-        img.save(buffer, **save_kwargs)
+    # Handle PNG optimization
+    if output_format == "PNG":
+        save_kwargs["optimize"] = True
 
-        # Encode to base64
-        image_data = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    img.save(buffer, **save_kwargs)
+    return buffer.getvalue()
 
-        # Determine MIME type
-        mime_type = _format_to_mime_type(output_format)
 
-        return f"data:{mime_type};base64,{image_data}"
+def _fit_to_budget(
+    img: "Image.Image", output_format: str, quality: int, max_bytes: int, data: bytes
+) -> bytes:
+    """
+    Re-encode an image whose encoding at quality (data) is larger than max_bytes: search
+    the highest quality down to _MIN_QUALITY (or quality, if lower) that fits (lossy
+    formats), and if none does, scale the image down and search again. The decoded image
+    is reused for every attempt.
+
+    Returns the best encoding that fits, or the smallest one tried.
+    """
+    from PIL import Image
+
+    lossy = output_format in _LOSSY_FORMATS
+    # Never encode at a higher quality than asked for
+    floor = min(_MIN_QUALITY, quality)
+    source = img
+    smallest = at_quality = data
+    while True:
+        # Only search quality when it can close the gap: large images are slow to encode
+        if lossy and len(at_quality) <= max_bytes * _QUALITY_REACH:
+            lowest = _save(img, output_format, floor)
+            if len(lowest) <= max_bytes:
+                # Binary search for the highest quality that fits
+                fitting = lowest
+                low, high = floor + 1, quality - 1
+                while low <= high:
+                    middle = (low + high) // 2
+                    candidate = _save(img, output_format, middle)
+                    if len(candidate) <= max_bytes:
+                        fitting = candidate
+                        low = middle + 1
+                    else:
+                        high = middle - 1
+                return fitting
+            smallest = min(smallest, lowest, key=len)
+        if img.width <= _MIN_FIT_WIDTH:
+            return smallest
+        # The encoded size goes roughly with the pixel count. Lossy images are scaled to
+        # about twice the budget at full quality, leaving the rest to the quality search.
+        target = 2 * max_bytes if lossy else max_bytes
+        scale = min(0.9, max(0.25, (target / len(at_quality)) ** 0.5))
+        width = max(_MIN_FIT_WIDTH, int(img.width * scale))
+        size = (width, max(1, int(source.height * width / source.width)))
+        img = source.resize(size, Image.Resampling.LANCZOS, reducing_gap=_REDUCING_GAP)
+        at_quality = _save(img, output_format, quality)
+        if len(at_quality) <= max_bytes:
+            return at_quality
+        smallest = min(smallest, at_quality, key=len)
+
+
+def _target_size(size: Tuple[int, int], max_width: Optional[int]) -> Optional[Tuple[int, int]]:
+    """
+    Size to resize an image of the given size to for max_width, or None to keep it.
+    """
+    width, height = size
+    if not max_width or width <= max_width:
+        return None
+    # Calculate new height maintaining aspect ratio
+    return max_width, int(height * (max_width / width))
+
+
+def _draft(img: "Image.Image", target_size: Tuple[int, int]) -> None:
+    """
+    Let the JPEG decoder scale the image down by 1/2, 1/4 or 1/8 while decoding (DCT
+    scaling), keeping at least _REDUCING_GAP times the target size. No-op for other formats
+    and for images that are already decoded.
+    """
+    width, height = target_size
+    img.draft(None, (int(width * _REDUCING_GAP), max(1, int(height * _REDUCING_GAP))))
 
 
 def _format_to_mime_type(format: str) -> str:
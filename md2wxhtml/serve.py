@@ -0,0 +1,451 @@
+"""
+Serve mode: keep warmed converters in one long-running process and convert documents
+sent over local HTTP or a Unix socket, so editors and CMSs previewing a document don't
+pay interpreter and import startup for every conversion.
+
+Endpoints:
+    POST /convert   Markdown (UTF-8) as the request body. The content_theme and
+                    code_theme query parameters select other themes than the server's.
+                    Answers {"success", "html", "warnings", "errors", "image_sizes"} as
+                    JSON, with status 422 if the conversion failed.
+    GET /health     {"status": "ok"}
+    GET /metrics    Request, conversion and cache counters as JSON
+
+Converters are built once per (content theme, code theme) and warmed up (theme CSS
+compiled, lexers and formatters loaded); they share the code and image caches. Documents
+come from clients, so only local images inside the base directory are embedded, and
+remote images are not fetched (the server would request any URL a client names). At most
+max_concurrency conversions run at once; a request waiting longer than queue_timeout
+for its turn is answered 503.
+"""
+
+import argparse
+import json
+import os
+import socketserver
+import stat
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from .core.converter import WeChatConverter
+from .processors.content_processor import theme_modules
+
+DEFAULT_MAX_REQUEST_BYTES = 10 * 1024 * 1024
+
+# Seconds a client may take to send its request
+_READ_TIMEOUT = 30
+
+
+class ConverterPool:
+    """
+    Warmed converters by (content theme, code theme), all built from the settings of a
+    base converter and sharing its caches and image fetcher.
+
+    Args:
+        converter: Converter for the default themes, warmed up here
+        languages: Code block languages to load the lexers for up front
+    """
+
+    def __init__(self, converter: WeChatConverter, languages: Iterable[str] = ()):
+        from pygments.styles import get_all_styles
+
+        self.base = converter
+        self.languages = list(languages)
+        # Only known theme names are accepted, which also bounds the number of converters
+        self._code_themes = frozenset(get_all_styles())
+        self._converters: Dict[Tuple[str, str], WeChatConverter] = {}
+        self._lock = threading.Lock()
+        converter.warm_up(self.languages)
+        self._converters[(converter.content_theme, converter.code_theme)] = converter
+
+    def get(
+        self, content_theme: Optional[str] = None, code_theme: Optional[str] = None
+    ) -> WeChatConverter:
+        """
+        Return the converter for the given themes (default: the base converter's).
+
+        Raises:
+            ValueError: Unknown content or code theme
+        """
+        key = (content_theme or self.base.content_theme, code_theme or self.base.code_theme)
+        converter = self._converters.get(key)
+        if converter is not None:
+            return converter
+        if key[0] not in theme_modules:
+            raise ValueError(f"Unknown content theme: {key[0]}")
+        if key[1] not in self._code_themes:
+            raise ValueError(f"Unknown code theme: {key[1]}")
+        with self._lock:
+            converter = self._converters.get(key)
+            if converter is None:
+                settings = self.base.settings()
+                settings.update(content_theme=key[0], code_theme=key[1])
+                converter = WeChatConverter(
+                    **settings,
+                    code_cache=self.base.code_cache,
+                    image_cache=self.base.image_cache,
+                    image_fetcher=self.base.image_fetcher,
+                )
+                converter.warm_up(self.languages)
+                self._converters[key] = converter
+        return converter
+
+    def __len__(self) -> int:
+        return len(self._converters)
+
+
+class ConversionService:
+    """
+    Converts request bodies with a ConverterPool, enforcing the request size limit and
+    the concurrency bound, and keeps the counters reported by /metrics.
+
+    Args:
+        pool: Warmed converters
+        base_dir: Directory relative image paths are resolved against
+        max_request_bytes: Largest Markdown body accepted
+        max_concurrency: Conversions running at once at most
+        queue_timeout: Seconds a request waits for a free slot before it is turned down
+    """
+
+    def __init__(
+        self,
+        pool: ConverterPool,
+        base_dir: Optional[Path] = None,
+        max_request_bytes: int = DEFAULT_MAX_REQUEST_BYTES,
+        max_concurrency: Optional[int] = None,
+        queue_timeout: float = 30.0,
+    ):
+        self.pool = pool
+        self.base_dir = base_dir
+        self.max_request_bytes = max_request_bytes
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.queue_timeout = queue_timeout
+        self.started = time.time()
+        self.requests = 0
+        self.conversions = 0
+        self.failed = 0
+        self.rejected_too_large = 0
+        self.rejected_busy = 0
+        self.bad_requests = 0
+        self.in_flight = 0
+        self.conversion_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._lock = threading.Lock()
+
+    def count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def convert(self, converter: WeChatConverter, markdown: str):
+        """
+        Convert one document with a converter of the pool, waiting for a free slot.
+
+        Returns the ConversionResult, or None if no slot freed up within queue_timeout.
+        """
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.count("rejected_busy")
+            return None
+        with self._lock:
+            self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            result = converter.convert(markdown, base_dir=self.base_dir)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._slots.release()
+            with self._lock:
+                self.in_flight -= 1
+                self.conversion_seconds += elapsed
+        with self._lock:
+            self.conversions += 1
+            self.failed += not result.success
+            self.bytes_in += len(markdown.encode("utf-8"))
+            self.bytes_out += len(result.html.encode("utf-8"))
+        return result
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = {
+                "uptime_seconds": round(time.time() - self.started, 3),
+                "requests": self.requests,
+                "conversions": self.conversions,
+                "failed": self.failed,
+                "rejected_too_large": self.rejected_too_large,
+                "rejected_busy": self.rejected_busy,
+                "bad_requests": self.bad_requests,
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "conversion_seconds": round(self.conversion_seconds, 6),
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "converters": len(self.pool),
+            }
+        base = self.pool.base
+        for name, store in (
+            ("code_cache", base.code_cache),
+            ("image_cache", base.image_cache),
+            ("image_fetcher", base.image_fetcher),
+        ):
+            if hasattr(store, "stats"):
+                metrics[name] = store.stats()
+        return metrics
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "md2wxhtml"
+    timeout = _READ_TIMEOUT
+
+    def do_GET(self):
+        service = self.server.service
+        service.count("requests")
+        path = urlsplit(self.path).path
+        if path == "/health":
+            self._send_json(HTTPStatus.OK, {"status": "ok"})
+        elif path == "/metrics":
+            self._send_json(HTTPStatus.OK, service.metrics())
+        elif path == "/convert":
+            self._send_error(HTTPStatus.METHOD_NOT_ALLOWED, "Use POST", {"Allow": "POST"})
+        else:
+            self._send_error(HTTPStatus.NOT_FOUND, f"No such endpoint: {path}")
+
+    def do_POST(self):
+        service = self.server.service
+        service.count("requests")
+        url = urlsplit(self.path)
+        if url.path != "/convert":
+            if url.path in ("/health", "/metrics"):
+                self._send_error(HTTPStatus.METHOD_NOT_ALLOWED, "Use GET", {"Allow": "GET"})
+            else:
+                self._send_error(HTTPStatus.NOT_FOUND, f"No such endpoint: {url.path}")
+            return
+
+        markdown = self._read_body()
+        if markdown is None:
+            return
+        query = parse_qs(url.query)
+        try:
+            converter = service.pool.get(
+                query.get("content_theme", [None])[0], query.get("code_theme", [None])[0]
+            )
+        except ValueError as e:
+            service.count("bad_requests")
+            self._send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        try:
+            result = service.convert(converter, markdown)
+        except Exception as e:
+            service.count("failed")
+            self._send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f"An unexpected error occurred: {e}")
+            return
+        if result is None:
+            self._send_error(HTTPStatus.SERVICE_UNAVAILABLE, "Server busy", {"Retry-After": "1"})
+            return
+        self._send_json(
+            HTTPStatus.OK if result.success else HTTPStatus.UNPROCESSABLE_ENTITY,
+            {
+                "success": result.success,
+                "html": result.html,
+                "warnings": result.warnings,
+                "errors": result.errors,
+                "image_sizes": result.image_sizes,
+            },
+        )
+
+    def _read_body(self) -> Optional[str]:
+        """
+        Read the request body as UTF-8 text, or answer with an error and return None.
+        """
+        service = self.server.service
+        length = self.headers.get("Content-Length")
+        if length is None or self.headers.get("Transfer-Encoding"):
+            service.count("bad_requests")
+            self._send_error(HTTPStatus.LENGTH_REQUIRED, "Content-Length required", close=True)
+            return None
+        # str.isdigit also accepts digits int() refuses, such as "²"
+        if not (length.isascii() and length.isdigit()):
+            service.count("bad_requests")
+            self._send_error(HTTPStatus.BAD_REQUEST, "Invalid Content-Length", close=True)
+            return None
+        if int(length) > service.max_request_bytes:
+            # The body is left unread, so the connection can't be reused
+            service.count("rejected_too_large")
+            self._send_error(
+                HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                f"Request larger than {service.max_request_bytes // 1024} KB",
+                close=True,
+            )
+            return None
+        body = self.rfile.read(int(length))
+        try:
+            return body.decode("utf-8")
+        except UnicodeDecodeError:
+            service.count("bad_requests")
+            self._send_error(HTTPStatus.BAD_REQUEST, "Request body is not UTF-8")
+            return None
+
+    def _send_error(
+        self,
+        status: HTTPStatus,
+        message: str,
+        headers: Optional[Dict[str, str]] = None,
+        close: bool = False,
+    ) -> None:
+        if close:
+            self.close_connection = True
+            headers = dict(headers or {}, Connection="close")
+        self._send_json(status, {"success": False, "errors": [message]}, headers)
+
+    def _send_json(
+        self, status: HTTPStatus, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None
+    ) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix"
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], service: ConversionService):
+        self.service = service
+        super().__init__(address, _Handler)
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, service: ConversionService):
+        self.service = service
+        super().__init__(path, _Handler)
+
+
+def serve(
+    service: ConversionService,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    unix_socket: Optional[Path] = None,
+) -> None:
+    """
+    Answer conversion requests on host:port, or on a Unix socket, until interrupted.
+    """
+    if unix_socket is not None:
+        _remove_stale_socket(unix_socket)
+        server = _UnixHTTPServer(str(unix_socket), service)
+        where = f"unix:{unix_socket}"
+    else:
+        server = _HTTPServer((host, port), service)
+        where = f"http://{host}:{server.server_address[1]}"
+
+    print(f"Serving on {where} (press Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped serving.")
+    finally:
+        server.server_close()
+        if unix_socket is not None:
+            _remove_stale_socket(unix_socket)
+
+
+def _remove_stale_socket(path: Path) -> None:
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"'{path}' exists and is not a socket")
+    os.unlink(path)
+
+
+def serve_main(argv: Optional[List[str]] = None) -> None:
+    """
+    Entry point of `md2wxhtml serve`.
+    """
+    from .main import add_converter_arguments, converter_from_args
+
+    parser = argparse.ArgumentParser(
+        prog="md2wxhtml serve",
+        description="Serve Markdown to WeChat HTML conversions over local HTTP or a Unix socket.",
+    )
+    server_group = parser.add_argument_group("Server Options")
+    server_group.add_argument(
+        "--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)."
+    )
+    server_group.add_argument("--port", type=int, default=8000, help="Port to listen on (default: 8000).")
+    server_group.add_argument(
+        "--unix-socket",
+        metavar="PATH",
+        help="Listen on this Unix socket instead of a TCP port.",
+    )
+    server_group.add_argument(
+        "--base-dir",
+        metavar="DIR",
+        help="Directory relative image paths are resolved against (default: current directory).",
+    )
+    server_group.add_argument(
+        "--max-request-size",
+        type=int,
+        default=DEFAULT_MAX_REQUEST_BYTES // 1024,
+        metavar="KB",
+        help=f"Largest Markdown document accepted (default: {DEFAULT_MAX_REQUEST_BYTES // 1024}).",
+    )
+    server_group.add_argument(
+        "--max-concurrency",
+        type=int,
+        metavar="N",
+        help="Conversions running at once at most (default: number of CPUs).",
+    )
+    server_group.add_argument(
+        "--queue-timeout",
+        type=float,
+        default=30.0,
+        metavar="SECONDS",
+        help="Turn a request down (503) if it waits longer than this for its turn (default: 30).",
+    )
+    server_group.add_argument(
+        "--preload-language",
+        action="append",
+        default=[],
+        metavar="LANG",
+        help="Load the lexer for this code block language at startup (repeatable).",
+    )
+    add_converter_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.fetch_remote_images:
+        # Documents come from clients, who could have the server request any URL
+        parser.error("--fetch-remote-images is not supported in serve mode")
+
+    # Image paths come from requests: don't embed files outside the base directory
+    pool = ConverterPool(converter_from_args(args, confine_images=True), languages=args.preload_language)
+    service = ConversionService(
+        pool,
+        base_dir=Path(args.base_dir).resolve() if args.base_dir else Path.cwd(),
+        max_request_bytes=args.max_request_size * 1024,
+        max_concurrency=args.max_concurrency,
+        queue_timeout=args.queue_timeout,
+    )
+    serve(
+        service,
+        host=args.host,
+        port=args.port,
+        unix_socket=Path(args.unix_socket) if args.unix_socket else None,
+    )
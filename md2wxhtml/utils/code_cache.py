@@ -0,0 +1,148 @@
+"""
+Cache for highlighted code blocks.
+
+Entries are keyed by processors.code_processor.code_block_cache_key (content hash,
+language and code theme). The in-memory part is an LRU bounded by the UTF-8 size of
+the cached HTML; an optional directory keeps the entries across runs and shares them
+between the worker processes of a batch conversion. The directory is bounded in size as
+well, least recently used entries going first.
+"""
+
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterator, MutableMapping, Optional, Tuple
+
+from .disk_cache import DiskCache
+
+# Bump when the highlighted HTML changes for the same input, to ignore old files on disk
+_DISK_FORMAT = 2
+_SUFFIX = ".html"
+
+
+class CodeBlockCache(MutableMapping[str, str]):
+    """
+    LRU mapping of code block cache keys to highlighted HTML, with hit/miss statistics.
+
+    Args:
+        directory: Optional directory persisting every entry, one file per key. Files are
+            written atomically, so several processes can share the directory.
+        max_bytes: Budget for the files in the directory. When a write takes it over the
+            budget, the least recently used entries are removed until it is 90% full.
+            Processes sharing the directory only see each other's writes at that point,
+            so the budget is approximate.
+        max_memory_bytes: Budget for the in-memory entries (UTF-8 size of the HTML)
+    """
+
+    def __init__(
+        self,
+        directory: Optional[Path] = None,
+        max_bytes: int = 256 * 1024 * 1024,
+        max_memory_bytes: int = 32 * 1024 * 1024,
+    ):
+        self.directory = Path(directory) if directory is not None else None
+        self.max_bytes = max_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._size = 0
+        self._disk: Optional[DiskCache] = None
+        if self.directory is not None:
+            import pygments
+
+            self._disk = DiskCache(
+                self.directory, max_bytes, _SUFFIX, version=f"{_DISK_FORMAT}|{pygments.__version__}"
+            )
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key: str) -> str:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        value = self._disk.read(key) if self._disk is not None else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            self.disk_hits += 1
+            self._store(key, value, len(value.encode("utf-8")))
+        return value
+
+    def __setitem__(self, key: str, value: str) -> None:
+        with self._lock:
+            self._store(key, value, len(value.encode("utf-8")))
+        if self._disk is not None:
+            self._disk.write(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+        removed = self._disk is not None and self._disk.delete(key)
+        if entry is None and not removed:
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        if self._disk is None:
+            return iter(list(self._entries))
+        return self._disk.keys()
+
+    def __len__(self) -> int:
+        if self._disk is None:
+            return len(self._entries)
+        return len(self._disk)
+
+    def clear(self) -> None:
+        """
+        Drop the in-memory entries (the directory, if any, is left alone).
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    @property
+    def disk_evictions(self) -> int:
+        """
+        Number of files removed from the directory to keep it within max_bytes.
+        """
+        return self._disk.evictions if self._disk is not None else 0
+
+    @property
+    def size(self) -> int:
+        """
+        UTF-8 size of the HTML held in memory.
+        """
+        return self._size
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "evictions": self.evictions,
+            "disk_evictions": self.disk_evictions,
+            "entries": len(self._entries),
+            "bytes": self._size,
+        }
+
+    def _store(self, key: str, value: str, size: int) -> None:
+        # Callers hold the lock
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= previous[1]
+        if size > self.max_memory_bytes:
+            return
+        self._entries[key] = (value, size)
+        self._size += size
+        while self._size > self.max_memory_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._size -= evicted_size
+            self.evictions += 1
@@ -0,0 +1,155 @@
+"""
+Directory of cache entries shared by the image and code block caches.
+
+Every entry is a file holding its key on the first line and its value after it, named
+after a hash of the key and a version string (so files written for another format or
+library version are never read). Files are written atomically, so several processes can
+share the directory. The directory is bounded in size, least recently used entries going
+first: reading an entry updates its modification time.
+"""
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+
+class DiskCache:
+    """
+    Size-bounded directory of string entries, evicted least recently used first.
+
+    Args:
+        directory: Directory of the entry files, created on the first write
+        max_bytes: Budget for the files in the directory. When a write takes it over the
+            budget, the least recently used entries are removed until it is 90% full.
+            Processes sharing the directory only see each other's writes at that point,
+            so the budget is approximate.
+        suffix: Suffix of the entry files
+        version: Mixed into the file names; change it when the values change for the
+            same keys
+    """
+
+    def __init__(self, directory: Path, max_bytes: int, suffix: str, version: str):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.version = version
+        self.evictions = 0
+        # Bytes on disk as last scanned plus what this process wrote since (None: not scanned)
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def path(self, key: str) -> Path:
+        digest = hashlib.sha256(f"{self.version}|{key}".encode("utf-8")).hexdigest()
+        return self.directory / digest[:2] / f"{digest}{self.suffix}"
+
+    def read(self, key: str) -> Optional[str]:
+        """
+        Return the value of a key, or None if there is none, its file is unreadable or it
+        holds another key.
+        """
+        path = self.path(key)
+        try:
+            stored_key, separator, value = path.read_bytes().decode("utf-8").partition("\n")
+        except (OSError, UnicodeDecodeError):
+            return None
+        if stored_key != key or not separator:
+            return None
+        try:
+            # Mark as recently used for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def write(self, key: str, value: str) -> None:
+        """
+        Store a value unless the key already has a file. Failures are ignored: the
+        directory is best effort, so a read-only or full disk only costs speed.
+        """
+        path = self.path(key)
+        if path.exists():
+            return
+        data = f"{key}\n{value}".encode("utf-8")
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._scan())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def delete(self, key: str) -> bool:
+        """
+        Remove the file of a key. Returns whether there was one.
+        """
+        path = self.path(key)
+        try:
+            size = path.stat().st_size
+            os.unlink(path)
+        except OSError:
+            return False
+        with self._lock:
+            if self._size is not None:
+                self._size = max(self._size - size, 0)
+        return True
+
+    def keys(self) -> Iterator[str]:
+        """
+        Iterate over the keys of the entries in the directory.
+        """
+        for _, _, path in self._scan():
+            try:
+                with open(path, "rb") as f:
+                    yield f.readline().decode("utf-8").rstrip("\n")
+            except (OSError, UnicodeDecodeError):
+                continue
+
+    def __len__(self) -> int:
+        return len(self._scan())
+
+    def _evict(self) -> None:
+        # Callers hold the lock. Rescan, so the writes of other processes count as well.
+        entries = sorted(self._scan())
+        size = sum(entry_size for _, entry_size, _ in entries)
+        target = self.max_bytes * 9 // 10
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # Evicted by another process
+                pass
+            except OSError:
+                continue
+            else:
+                self.evictions += 1
+            size -= entry_size
+        self._size = size
+
+    def _scan(self) -> List[Tuple[int, int, Path]]:
+        """
+        (mtime_ns, size, path) of every entry in the directory.
+        """
+        entries = []
+        for path in self.directory.glob(f"*/*{self.suffix}"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return entries
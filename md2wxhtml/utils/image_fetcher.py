@@ -0,0 +1,287 @@
+"""
+Fetcher for remote (http:// and https://) images, so they can be embedded like local ones.
+
+Images are downloaded concurrently over keep-alive connections pooled per host, with a
+limit on the requests in flight to each host, and kept in a directory. A later fetch of
+the same URL sends the validators it was served with (ETag, Last-Modified) and reuses the
+file on 304 Not Modified; responses the server declares fresh (Cache-Control max-age) are
+reused without a request until they expire. Plain http:// is supported, so a local
+http.server can stand in for a CDN.
+"""
+
+import hashlib
+import http.client
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from urllib.parse import urljoin, urlsplit
+
+_USER_AGENT = "md2wxhtml"
+_REDIRECTS = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 5
+_max_age = re.compile(r"\bmax-age\s*=\s*(\d+)", re.IGNORECASE)
+_no_cache = re.compile(r"\b(?:no-cache|no-store)\b", re.IGNORECASE)
+
+# (scheme, host, port) of a connection pool
+_Origin = Tuple[str, str, int]
+
+
+class ImageFetcher:
+    """
+    Downloads remote images into a directory, one file per URL.
+
+    Args:
+        directory: Directory keeping the downloads and their validators across runs
+            (default: a temporary directory removed by close()). Files are written
+            atomically, so several processes can share the directory.
+        timeout: Timeout in seconds for connecting and for each read
+        max_per_host: Requests in flight to the same host at most
+        workers: Threads fetching the images of a fetch_all call
+        max_bytes: Largest response body accepted
+    """
+
+    def __init__(
+        self,
+        directory: Optional[Path] = None,
+        timeout: float = 10.0,
+        max_per_host: int = 4,
+        workers: int = 8,
+        max_bytes: int = 32 * 1024 * 1024,
+    ):
+        self._temporary = None
+        if directory is None:
+            self._temporary = tempfile.TemporaryDirectory(prefix="md2wxhtml-remote-")
+            directory = Path(self._temporary.name)
+        self.directory = Path(directory)
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.requests = 0
+        self.downloads = 0
+        self.not_modified = 0
+        self.fresh_hits = 0
+        self._idle: Dict[_Origin, List[http.client.HTTPConnection]] = {}
+        self._slots: Dict[_Origin, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def fetch_all(self, urls: Sequence[str]) -> Dict[str, Union[Path, Exception]]:
+        """
+        Fetch the distinct URLs, concurrently when there are several.
+
+        Returns the local file, or the exception raised, per URL.
+        """
+        distinct = list(dict.fromkeys(urls))
+        if len(distinct) < 2 or self.workers < 2:
+            results = [self._fetch_or_error(url) for url in distinct]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(distinct))) as pool:
+                results = list(pool.map(self._fetch_or_error, distinct))
+        return dict(zip(distinct, results))
+
+    def fetch(self, url: str) -> Path:
+        """
+        Fetch one URL (revalidating an earlier download) and return its local file.
+
+        Raises:
+            OSError: The request failed or the server answered with an error
+            ValueError: The URL is not http(s):// or the image is larger than max_bytes
+        """
+        path, meta_path = self._paths(url)
+        meta = _read_meta(meta_path) if path.exists() else None
+        if meta is not None and meta.get("fresh_until", 0) > time.time():
+            with self._lock:
+                self.fresh_hits += 1
+            return path
+
+        headers = {"User-Agent": _USER_AGENT, "Accept": "image/*", "Accept-Encoding": "identity"}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        target = url
+        for _ in range(_MAX_REDIRECTS + 1):
+            status, reason, response_headers, body = self._request(target, headers)
+            location = response_headers.get("Location")
+            if status not in _REDIRECTS or not location:
+                break
+            target = urljoin(target, location)
+        else:
+            raise OSError("Too many redirects")
+
+        if status == 304 and meta is not None:
+            with self._lock:
+                self.not_modified += 1
+            meta["fresh_until"] = _fresh_until(response_headers)
+            _write_atomically(meta_path, json.dumps(meta).encode("utf-8"))
+            return path
+        if status != 200:
+            raise OSError(f"HTTP {status} {reason}")
+
+        with self._lock:
+            self.downloads += 1
+        _write_atomically(path, body)
+        meta = {
+            "url": url,
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+            "fresh_until": _fresh_until(response_headers),
+        }
+        _write_atomically(meta_path, json.dumps(meta).encode("utf-8"))
+        return path
+
+    def close(self) -> None:
+        """
+        Close the pooled connections and remove the temporary directory, if any.
+        """
+        with self._lock:
+            connections = [conn for pool in self._idle.values() for conn in pool]
+            self._idle.clear()
+        for conn in connections:
+            conn.close()
+        if self._temporary is not None:
+            self._temporary.cleanup()
+            self._temporary = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "downloads": self.downloads,
+            "not_modified": self.not_modified,
+            "fresh_hits": self.fresh_hits,
+        }
+
+    def _fetch_or_error(self, url: str) -> Union[Path, Exception]:
+        try:
+            return self.fetch(url)
+        except Exception as e:
+            return e
+
+    def _request(
+        self, url: str, headers: Dict[str, str]
+    ) -> Tuple[int, str, http.client.HTTPMessage, bytes]:
+        """
+        GET url over a pooled connection. Returns (status, reason, headers, body).
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Not an http(s) URL: {url}")
+        default_port = 443 if parts.scheme == "https" else 80
+        origin = (parts.scheme, parts.hostname, parts.port or default_port)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+
+        with self._slot(origin):
+            conn, reused = self._acquire(origin)
+            try:
+                try:
+                    conn.request("GET", path, headers=headers)
+                    response = conn.getresponse()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    if not reused:
+                        raise
+                    # The server closed the idle connection meanwhile: retry on a new one
+                    conn.close()
+                    conn = self._connect(origin)
+                    conn.request("GET", path, headers=headers)
+                    response = conn.getresponse()
+                with self._lock:
+                    self.requests += 1
+                body = self._read_body(response)
+            except BaseException:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(origin, conn)
+        return response.status, response.reason, response.headers, body
+
+    def _read_body(self, response: http.client.HTTPResponse) -> bytes:
+        length = response.getheader("Content-Length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            raise ValueError(f"Image larger than {self.max_bytes // 1024} KB")
+        body = response.read(self.max_bytes + 1)
+        if len(body) > self.max_bytes:
+            raise ValueError(f"Image larger than {self.max_bytes // 1024} KB")
+        return body
+
+    @contextmanager
+    def _slot(self, origin: _Origin) -> Iterator[None]:
+        with self._lock:
+            slots = self._slots.get(origin)
+            if slots is None:
+                slots = self._slots[origin] = threading.BoundedSemaphore(self.max_per_host)
+        with slots:
+            yield
+
+    def _acquire(self, origin: _Origin) -> Tuple[http.client.HTTPConnection, bool]:
+        """
+        An idle connection to origin, or a new one. Returns (connection, reused).
+        """
+        with self._lock:
+            pool = self._idle.get(origin)
+            if pool:
+                return pool.pop(), True
+        return self._connect(origin), False
+
+    def _release(self, origin: _Origin, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            self._idle.setdefault(origin, []).append(conn)
+
+    def _connect(self, origin: _Origin) -> http.client.HTTPConnection:
+        scheme, host, port = origin
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _paths(self, url: str) -> Tuple[Path, Path]:
+        """
+        Download and validator files of a URL (the download keeps the URL's extension).
+        """
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        suffix = os.path.splitext(urlsplit(url).path)[1].lower()
+        if not re.fullmatch(r"\.[a-z0-9]{1,5}", suffix):
+            suffix = ""
+        directory = self.directory / digest[:2]
+        return directory / f"{digest}{suffix}", directory / f"{digest}.json"
+
+
+def _fresh_until(headers: http.client.HTTPMessage) -> float:
+    cache_control = headers.get("Cache-Control") or ""
+    match = _max_age.search(cache_control)
+    if match is None or _no_cache.search(cache_control):
+        return 0
+    return time.time() + int(match.group(1))
+
+
+def _read_meta(path: Path) -> Optional[Dict[str, object]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if isinstance(meta, dict) else None
+
+
+def _write_atomically(path: Path, data: bytes) -> None:
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
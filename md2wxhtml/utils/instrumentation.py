@@ -0,0 +1,125 @@
+"""
+Opt-in instrumentation of conversions.
+
+A Recorder is created for each conversion of a converter built with collect_stats. The
+pipeline stages run inside its stage() context, which records wall and CPU time (and, with
+trace_memory, the peak of memory allocated) into a ConversionStats, summed over the runs of
+a stage (e.g. once per code block for code_highlight). Stages don't nest.
+
+Functions taking an optional recorder use measure(recorder, name) and count(recorder, name),
+which do nothing when it is None, so conversions without stats pay for a few None checks.
+"""
+
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Iterator, Optional, Sequence
+
+from ..models.code_block import ConversionStats, StageStats
+
+# Called after every run of a stage with its name and the timing of that run alone
+StageHook = Callable[[str, StageStats], None]
+
+# Recorders tracing memory at the moment, and whether they started tracemalloc: the last
+# one to finish stops it, so overlapping conversions (e.g. convert_async) keep tracing
+_tracing_lock = threading.Lock()
+_tracing_recorders = 0
+_started_tracing = False
+
+
+class Recorder:
+    """
+    Collects the stats of one conversion.
+
+    Args:
+        trace_memory: Also record the peak memory allocated by each stage, with tracemalloc
+            (started while conversions tracing memory run, if it isn't tracing already).
+            Tracing slows the conversion down several times, and tracemalloc is
+            process-wide, so the peaks of concurrent conversions include each other's
+            allocations.
+        hooks: Functions called after every run of a stage
+    """
+
+    def __init__(self, trace_memory: bool = False, hooks: Sequence[StageHook] = ()):
+        self.stats = ConversionStats()
+        self.trace_memory = trace_memory
+        self.hooks = tuple(hooks)
+        self._wall_start = 0.0
+        self._cpu_start = 0.0
+
+    def __enter__(self) -> "Recorder":
+        if self.trace_memory:
+            _start_tracing()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stats.wall_ms += (time.perf_counter() - self._wall_start) * 1000
+        self.stats.cpu_ms += (time.process_time() - self._cpu_start) * 1000
+        if self.trace_memory:
+            _stop_tracing()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Time the code run in this context as a run of stage name.
+        """
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            run = StageStats(
+                wall_ms=(time.perf_counter() - wall_start) * 1000,
+                cpu_ms=(time.process_time() - cpu_start) * 1000,
+                peak_bytes=max(0, tracemalloc.get_traced_memory()[1] - memory_start) if tracing else None,
+                calls=1,
+            )
+            self.stats.add_stage(name, run)
+            for hook in self.hooks:
+                hook(name, run)
+
+    def count(self, name: str, n: int = 1) -> None:
+        """
+        Add n to counter name.
+        """
+        self.stats.counters[name] = self.stats.counters.get(name, 0) + n
+
+
+def _start_tracing() -> None:
+    global _tracing_recorders, _started_tracing
+    with _tracing_lock:
+        if _tracing_recorders == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _tracing_recorders += 1
+
+
+def _stop_tracing() -> None:
+    global _tracing_recorders, _started_tracing
+    with _tracing_lock:
+        _tracing_recorders -= 1
+        if _tracing_recorders == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+def measure(recorder: Optional[Recorder], name: str):
+    """
+    recorder.stage(name), or a context doing nothing without a recorder.
+    """
+    return recorder.stage(name) if recorder is not None else nullcontext()
+
+
+def count(recorder: Optional[Recorder], name: str, n: int = 1) -> None:
+    """
+    recorder.count(name, n), if there is a recorder.
+    """
+    if recorder is not None:
+        recorder.count(name, n)
@@ -0,0 +1,108 @@
+"""
+Build manifest for batch conversion.
+
+Records, for every converted input, a fingerprint of the Markdown source, the local
+images it refers to and the converter options, so unchanged articles can be skipped
+on the next run.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+MANIFEST_VERSION = 1
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_options(options: Dict[str, Any]) -> str:
+    """
+    Hash JSON-serializable converter options (key order does not matter).
+    """
+    return hash_bytes(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+
+
+class Manifest:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        # Image hashes known from the previous run, keyed by path, to skip re-hashing unchanged files
+        self._image_stats: Dict[str, Dict[str, Any]] = {}
+
+    @classmethod
+    def load(cls, path: Path) -> "Manifest":
+        """
+        Load a manifest, starting empty if it is missing, unreadable or from another version.
+        """
+        manifest = cls(path)
+        try:
+            with open(manifest.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return manifest
+        if data.get("version") != MANIFEST_VERSION:
+            return manifest
+        manifest.entries = data.get("entries", {})
+        manifest._image_stats = data.get("images", {})
+        return manifest
+
+    def save(self) -> None:
+        """
+        Write the manifest atomically (readers never see a partial file).
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        images = {}
+        for entry in self.entries.values():
+            for image in entry["fingerprint"]["images"]:
+                if image in self._image_stats:
+                    images[image] = self._image_stats[image]
+        data = {"version": MANIFEST_VERSION, "entries": self.entries, "images": images}
+        tmp_path = self.path.with_name(self.path.name + f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, sort_keys=True, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def fingerprint(self, source: str, images: Iterable[Path], options_hash: str) -> Dict[str, Any]:
+        """
+        Fingerprint one input: its source text, each referenced image (None if missing) and the options.
+        """
+        return {
+            "source": hash_bytes(source.encode("utf-8")),
+            "images": {str(path): self._hash_image(path) for path in images},
+            "options": options_hash,
+        }
+
+    def is_unchanged(self, key: str, fingerprint: Dict[str, Any], output_path: Path) -> bool:
+        entry = self.entries.get(key)
+        return (
+            entry is not None
+            and entry.get("fingerprint") == fingerprint
+            and entry.get("output") == str(output_path)
+            and output_path.exists()
+        )
+
+    def record(self, key: str, fingerprint: Dict[str, Any], output_path: Path) -> None:
+        self.entries[key] = {"fingerprint": fingerprint, "output": str(output_path)}
+
+    def _hash_image(self, path: Path) -> Optional[str]:
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        known = self._image_stats.get(str(path))
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return known["sha256"]
+        try:
+            digest = hash_bytes(path.read_bytes())
+        except OSError:
+            return None
+        self._image_stats[str(path)] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": digest,
+        }
+        return digest
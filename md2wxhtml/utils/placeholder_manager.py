@@ -1,4 +1,14 @@
-from typing import Dict
+import hashlib
+import re
+from typing import Dict, Optional
+
+# Placeholders are delimited by Unicode private-use code points, which Markdown, lxml and
+# the themes pass through untouched and which ordinary text does not contain, so text that
+# merely looks like a placeholder is never mistaken for one
+PLACEHOLDER_START = "\ue000"
+PLACEHOLDER_END = "\ue001"
+PLACEHOLDER_PATTERN = re.compile(f"{PLACEHOLDER_START}[0-9a-f]+{PLACEHOLDER_END}")
+
 
 # Placeholder management logic
 class PlaceholderManager:
@@ -6,9 +16,17 @@ class PlaceholderManager:
         self.counter = 0
         self.mapping: Dict[str, str] = {}
 
-    def generate(self) -> str:
+    def generate(self, content: Optional[str] = None) -> str:
+        """
+        Return a new placeholder. With content, the placeholder is derived from it instead
+        of the counter, so the same code block gets the same placeholder in every version
+        of a document (identical blocks share one placeholder).
+        """
+        if content is not None:
+            digest = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+            return f"{PLACEHOLDER_START}{digest}{PLACEHOLDER_END}"
         self.counter += 1
-        placeholder = f"{{{{CODE_BLOCK_PLACEHOLDER_{self.counter:03d}}}}}"
+        placeholder = f"{PLACEHOLDER_START}{self.counter:03d}{PLACEHOLDER_END}"
         return placeholder
 
     def add(self, placeholder: str, code_block_id: str):
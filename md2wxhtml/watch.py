@@ -0,0 +1,114 @@
+"""
+Watch mode: keep one converter warm and rebuild the output whenever the Markdown file,
+one of the local images it embeds or (optionally) the content theme changes.
+
+Rebuilds are incremental: only the blocks of the document that changed are rendered again
+(see core.incremental), and highlighted code blocks and encoded images are cached between
+rebuilds, so changing an image re-encodes only that image.
+"""
+
+import importlib
+import os
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from .core.converter import WeChatConverter
+from .core.incremental import IncrementalConverter, file_signature
+from .processors.content_processor import get_theme_module
+from .processors.image_processor import find_local_images
+
+
+def watch(
+    input_path: Path,
+    output_path: Path,
+    converter: WeChatConverter,
+    watch_theme: bool = False,
+    interval: float = 0.1,
+) -> None:
+    """
+    Convert input_path to output_path, then poll the files it depends on every
+    `interval` seconds and rebuild when one of them changes. Runs until interrupted.
+
+    Args:
+        input_path: Markdown file to convert
+        output_path: HTML file to (re)write
+        converter: Converter to keep warm
+        watch_theme: Also watch the content theme module and reload it when it changes
+        interval: Polling interval in seconds
+    """
+    input_path = Path(input_path)
+    output_path = Path(output_path)
+    base_dir = input_path.parent.resolve()
+
+    # Highlighted code and encoded images stay in the converter's own (size-bounded) caches
+    converter.warm_up()
+    incremental = IncrementalConverter(converter)
+
+    theme_module = get_theme_module(converter.content_theme) if watch_theme else None
+    theme_path = Path(theme_module.__file__) if theme_module is not None else None
+
+    print(f"Watching '{input_path}' (press Ctrl+C to stop)")
+    signatures: Dict[Path, Optional[Tuple[int, int]]] = {}
+    try:
+        while True:
+            changed = [path for path, signature in signatures.items() if file_signature(path) != signature]
+            if changed or not signatures:
+                if theme_path is not None and theme_path in changed:
+                    importlib.reload(theme_module)
+                signatures = _rebuild(input_path, output_path, base_dir, incremental, theme_path)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+
+
+def _rebuild(
+    input_path: Path,
+    output_path: Path,
+    base_dir: Path,
+    incremental: IncrementalConverter,
+    theme_path: Optional[Path],
+) -> Dict[Path, Optional[Tuple[int, int]]]:
+    """
+    Convert once and return the signatures of every file the result depends on.
+    Signatures are taken before reading, so a save during the conversion triggers another rebuild.
+    """
+    signatures = {input_path: file_signature(input_path)}
+    if theme_path is not None:
+        signatures[theme_path] = file_signature(theme_path)
+    try:
+        with open(input_path, 'r', encoding='utf-8') as f:
+            markdown_content = f.read()
+    except (OSError, UnicodeDecodeError) as e:
+        # Editors that save by rename can leave the file missing for a moment
+        print(f"Error: Could not read '{input_path}': {e}")
+        return signatures
+
+    if incremental.converter.embed_local_images:
+        for image_path in find_local_images(markdown_content, base_dir):
+            signatures[image_path] = file_signature(image_path)
+
+    start = time.perf_counter()
+    try:
+        result = incremental.convert(markdown_content, base_dir=base_dir)
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        return signatures
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    if not result.success:
+        print(f"Conversion failed for '{input_path}'. Errors: {result.errors}")
+        return signatures
+
+    # Replace the output atomically so a previewer never reads a half-written file
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(result.html)
+    os.replace(tmp_path, output_path)
+    print(
+        f"Rebuilt '{output_path}' in {elapsed_ms:.0f} ms "
+        f"({incremental.blocks_rendered} of {incremental.blocks_total} blocks rendered)"
+    )
+    for warning in result.warnings:
+        print(f"  - {warning}")
+    return signatures
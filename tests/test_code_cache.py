@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from md2wxhtml.utils.code_cache import CodeBlockCache
+
+
+class CodeBlockCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.directory = Path(self._tmp.name)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def files(self):
+        return sorted(self.directory.glob("*/*.html"))
+
+    def test_entries_persist_across_caches(self):
+        CodeBlockCache(directory=self.directory)["key"] = "<pre>x</pre>"
+        cache = CodeBlockCache(directory=self.directory)
+        self.assertEqual(cache["key"], "<pre>x</pre>")
+        self.assertEqual(cache.disk_hits, 1)
+        self.assertFalse(list(self.directory.glob("*/*.tmp")))
+
+    def test_directory_is_bounded(self):
+        cache = CodeBlockCache(directory=self.directory, max_bytes=10_000)
+        for i in range(50):
+            cache[f"key{i}"] = "x" * 1000
+        size = sum(path.stat().st_size for path in self.files())
+        self.assertLessEqual(size, 10_000)
+        self.assertGreater(cache.disk_evictions, 0)
+
+    def test_least_recently_used_files_go_first(self):
+        cache = CodeBlockCache(directory=self.directory, max_bytes=3500)
+        for i, key in enumerate(["a", "b", "c"]):
+            cache[key] = key * 1000
+            os.utime(cache._disk.path(key), ns=(i * 10**9, i * 10**9))
+        # Reading "a" marks it as recently used, so "b" is removed for "d"
+        cache.clear()
+        self.assertEqual(cache["a"], "a" * 1000)
+        cache["d"] = "d" * 1000
+        fresh = CodeBlockCache(directory=self.directory)
+        self.assertIn("a", fresh)
+        self.assertNotIn("b", fresh)
+        self.assertIn("d", fresh)
+
+    def test_memory_is_bounded(self):
+        cache = CodeBlockCache(max_memory_bytes=2500)
+        for key in "abc":
+            cache[key] = key * 1000
+        self.assertEqual(list(cache), ["b", "c"])
+        self.assertEqual(cache.size, 2000)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_mapping_covers_the_directory(self):
+        CodeBlockCache(directory=self.directory)["on disk"] = "<pre>d</pre>"
+        cache = CodeBlockCache(directory=self.directory)
+        cache["in memory"] = "<pre>m</pre>"
+        self.assertEqual(sorted(cache), ["in memory", "on disk"])
+        self.assertEqual(len(cache), 2)
+        del cache["on disk"]
+        self.assertNotIn("on disk", cache)
+        self.assertEqual(len(self.files()), 1)
+        del cache["in memory"]
+        self.assertEqual(self.files(), [])
+        self.assertEqual(len(cache), 0)
+        with self.assertRaises(KeyError):
+            del cache["in memory"]
+
+
+if __name__ == "__main__":
+    unittest.main()
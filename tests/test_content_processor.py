@@ -0,0 +1,222 @@
+import unittest
+from typing import Optional
+
+import markdown
+
+from md2wxhtml.processors.content_processor import (
+    MARKDOWN_EXTENSIONS,
+    _auto_link_urls,
+    _close_paragraphs,
+    _collapse_blank_text,
+    _lists_to_paragraphs,
+    parse_html,
+    serialize_contents,
+)
+
+
+def run_stage(stage, html: str) -> str:
+    container = parse_html('<div class="wechat-content">' + html + "</div>").getroot().find("body/div")
+    stage(container)
+    return serialize_contents(container)
+
+
+def p(content: str, margin: int = 0, highlight: bool = True) -> str:
+    style = f"margin-left:{margin}px;" if margin else ""
+    css_class = ' class="list-highlight"' if highlight else ""
+    return f'<p{css_class} style="{style}">{content}</p>'
+
+
+def span(text: str) -> str:
+    return f'<span class="list-highlight-span">{text}</span>'
+
+
+def link(url: str, href: Optional[str] = None) -> str:
+    return f'<a href="{href or url}" style="color:#1d4ed8; border-bottom-color:#3b82f6">{url}</a>'
+
+
+def rewrite_lists(container) -> None:
+    _lists_to_paragraphs(container)
+    _close_paragraphs(container)
+
+
+class ListsToParagraphsTest(unittest.TestCase):
+    def assertConverts(self, html: str, expected: str) -> None:
+        self.assertEqual(run_stage(rewrite_lists, html), expected)
+
+    def test_items_become_paragraphs(self):
+        self.assertConverts("<ul><li>a</li><li>b</li></ul>", p("a") + p("b"))
+        self.assertConverts("<ol><li>a</li></ol>", p("a", highlight=False))
+
+    def test_text_before_colon_is_highlighted(self):
+        self.assertConverts(
+            "<ul><li>Key：value</li><li>no colon</li></ul>", p(span("Key：") + "value") + p("no colon")
+        )
+        self.assertConverts(
+            "<ul><li><strong>Key</strong>：value <em>x</em></li></ul>",
+            p(span("Key：") + "value <em>x</em>"),
+        )
+        # Only the first colon, and only in unordered lists
+        self.assertConverts("<ul><li>a：b：c</li></ul>", p(span("a：") + "b：c"))
+        self.assertConverts("<ol><li>Step：one</li></ol>", p("Step：one", highlight=False))
+
+    def test_elements_enclosing_the_colon_are_left_out(self):
+        self.assertConverts("<ul><li><a href='u'>Link：</a> tail</li></ul>", p(span("Link：") + " tail"))
+        self.assertConverts("<ul><li><code>k：v</code> rest</li></ul>", p(span("k：") + "v rest"))
+
+    def test_escaped_markup_after_colon_stays_text(self):
+        self.assertConverts(
+            "<ul><li>a &lt;b&gt;：c &lt;script&gt; e</li></ul>",
+            p(span("a &lt;b&gt;：") + "c &lt;script&gt; e"),
+        )
+
+    def test_colon_in_comment_is_ignored(self):
+        self.assertConverts("<ul><li><!-- a：b -->text：after</li></ul>", p(span("text：") + "after"))
+        self.assertConverts("<ul><li>text<!-- a：b --> more</li></ul>", p("text<!-- a：b --> more"))
+
+    def test_nested_lists_are_indented(self):
+        self.assertConverts(
+            "<ul><li>Outer：o<ul><li>Inner：i<ol><li>deep</li></ol></li></ul></li><li>next</li></ul>",
+            p(span("Outer：") + "o")
+            + p(span("Inner：") + "i", margin=20)
+            + p("deep", margin=40, highlight=False)
+            + p("next"),
+        )
+        self.assertConverts(
+            "<ol><li>three</li><li>four<ul><li>sub：s</li></ul></li></ol>",
+            p("three", highlight=False) + p("four", highlight=False) + p(span("sub：") + "s", margin=20),
+        )
+
+    def test_lists_inside_other_elements(self):
+        self.assertConverts(
+            "<blockquote><ul><li>q：r</li></ul></blockquote>",
+            "<blockquote>" + p(span("q：") + "r") + "</blockquote>",
+        )
+        # A list in a blockquote of an item is picked up once the item is converted
+        self.assertConverts(
+            "<ul><li>a<blockquote><ul><li>inner</li></ul></blockquote></li></ul>",
+            p("a") + "<blockquote>" + p("inner") + "</blockquote>",
+        )
+
+    def test_loose_items_keep_their_blocks(self):
+        self.assertConverts(
+            "<ul><li><p>Loose：para</p><p>second</p></li></ul>",
+            p(span("Loose：") + "para") + "<p>second</p>",
+        )
+
+    def test_rendered_markdown(self):
+        html = markdown.markdown(
+            "- Fix：details\n    - Nested：more\n        1. deep\n- Plain\n", extensions=MARKDOWN_EXTENSIONS
+        )
+        output = run_stage(rewrite_lists, html)
+        self.assertNotIn("<li", output)
+        self.assertNotIn("<ul", output)
+        self.assertNotIn("<ol", output)
+        self.assertIn(p(span("Fix：") + "details\n"), output)
+        self.assertIn(p(span("Nested：") + "more\n", margin=20), output)
+        self.assertIn(p("deep", margin=40, highlight=False), output)
+
+
+class ListWhitespaceTest(unittest.TestCase):
+    """
+    The text between the paragraphs of converted lists is the same as before the stages
+    worked on a tree: blank text joined when lists are unwrapped is collapsed, blank text
+    joined when loose items' blocks leave their <p> is kept.
+    """
+
+    def assertConverts(self, markdown_text: str, expected: str) -> None:
+        def stages(container):
+            _lists_to_paragraphs(container)
+            _collapse_blank_text(container)
+            _close_paragraphs(container)
+
+        html = markdown.markdown(markdown_text, extensions=MARKDOWN_EXTENSIONS)
+        self.assertEqual(run_stage(stages, html), expected)
+
+    def test_tight_list(self):
+        self.assertConverts("- a\n- b\n", "\n" + p("a") + "\n" + p("b") + "\n")
+
+    def test_loose_lists(self):
+        self.assertConverts(
+            "- a\n\n- b\n", "\n" + p("\n") + "<p>a</p>\n\n" + p("\n") + "<p>b</p>\n\n"
+        )
+        self.assertConverts(
+            "1. x\n\n2. y\n",
+            "\n" + p("\n", highlight=False) + "<p>x</p>\n\n" + p("\n", highlight=False) + "<p>y</p>\n\n",
+        )
+
+    def test_loose_item_with_block(self):
+        self.assertConverts(
+            "- a\n\n    > q\n\n- b\n",
+            "\n" + p("\n") + "<p>a</p>\n<blockquote>\n<p>q</p>\n</blockquote>\n\n"
+            + p("\n") + "<p>b</p>\n\n",
+        )
+
+
+class AutoLinkUrlsTest(unittest.TestCase):
+    def assertLinks(self, html: str, expected: str) -> None:
+        self.assertEqual(run_stage(_auto_link_urls, html), expected)
+
+    def test_urls_become_links(self):
+        self.assertLinks(
+            "<p>See https://example.com/a?b=1 now</p>", f"<p>See {link('https://example.com/a?b=1')} now</p>"
+        )
+        self.assertLinks(
+            "<p>a https://one.org b http://two.org c https://three.org</p>",
+            f"<p>a {link('https://one.org')} b {link('http://two.org')} c {link('https://three.org')}</p>",
+        )
+
+    def test_www_urls_get_a_scheme(self):
+        self.assertLinks(
+            "<p>Visit www.example.org now</p>",
+            f"<p>Visit {link('www.example.org', 'http://www.example.org')} now</p>",
+        )
+        self.assertLinks(
+            "<p>WWW.EXAMPLE.ORG</p>", f"<p>{link('WWW.EXAMPLE.ORG', 'http://WWW.EXAMPLE.ORG')}</p>"
+        )
+
+    def test_schemes_are_case_insensitive(self):
+        self.assertLinks(
+            "<p>HTTPS://EXAMPLE.COM/X and Http://y.org</p>",
+            f"<p>{link('HTTPS://EXAMPLE.COM/X')} and {link('Http://y.org')}</p>",
+        )
+
+    def test_urls_inside_links_are_left_alone(self):
+        self.assertLinks(
+            "<p><a href='https://x.org'>https://x.org</a> and https://y.org</p>",
+            f'<p><a href="https://x.org">https://x.org</a> and {link("https://y.org")}</p>',
+        )
+        self.assertLinks(
+            "<p><a href='u'>go <em>https://in.em</em> www.x.org</a> tail https://z.org</p>",
+            f'<p><a href="u">go <em>https://in.em</em> www.x.org</a> tail {link("https://z.org")}</p>',
+        )
+
+    def test_urls_in_code_and_other_elements(self):
+        self.assertLinks(
+            "<p><code>https://code.example</code> then https://after.code</p>",
+            f"<p><code>{link('https://code.example')}</code> then {link('https://after.code')}</p>",
+        )
+        self.assertLinks(
+            "<p><strong>bold https://b.org</strong>tail https://t.org</p>",
+            f"<p><strong>bold {link('https://b.org')}</strong>tail {link('https://t.org')}</p>",
+        )
+
+    def test_urls_in_comments_are_left_alone(self):
+        self.assertLinks(
+            "<p>a<!-- https://comment.org -->after https://c.org</p>",
+            f"<p>a<!-- https://comment.org -->after {link('https://c.org')}</p>",
+        )
+
+    def test_url_ends_at_quotes_and_angle_brackets(self):
+        self.assertLinks(
+            '<p>"https://q.org" &lt;https://lt.org&gt;</p>',
+            f'<p>"{link("https://q.org")}" &lt;{link("https://lt.org")}&gt;</p>',
+        )
+
+    def test_text_without_urls_is_unchanged(self):
+        for html in ("<p>no links here, just http words</p>", "<p>a <em>b</em> c</p><hr><p>d</p>"):
+            with self.subTest(html=html):
+                self.assertLinks(html, html)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+import io
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from PIL import Image
+
+from md2wxhtml import WeChatConverter
+from md2wxhtml.utils.image_fetcher import ImageFetcher
+
+_LAST_MODIFIED = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+
+def _png(color: str) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (4, 4), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            self._answer()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _answer(self):
+        if self.path.startswith("/slow/"):
+            time.sleep(0.05)
+            self._send(200, self.server.body)
+        elif self.path == "/etag.png":
+            if self.headers.get("If-None-Match") == '"v1"':
+                self._send(304, headers={"ETag": '"v1"'})
+            else:
+                self._send(200, self.server.body, {"ETag": '"v1"'})
+        elif self.path == "/last-modified.png":
+            if self.headers.get("If-Modified-Since") == _LAST_MODIFIED:
+                self._send(304)
+            else:
+                self._send(200, self.server.body, {"Last-Modified": _LAST_MODIFIED})
+        elif self.path == "/fresh.png":
+            self._send(200, self.server.body, {"Cache-Control": "max-age=3600"})
+        elif self.path == "/moved.png":
+            self._send(302, headers={"Location": "/etag.png"})
+        elif self.path == "/error.png":
+            self._send(500)
+        else:
+            self._send(404)
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageFetcherTest(unittest.TestCase):
+    def setUp(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        server.daemon_threads = True
+        server.lock = threading.Lock()
+        server.connections = 0
+        server.requests = []
+        server.in_flight = server.max_in_flight = 0
+        server.body = _png("red")
+        self.server = server
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.base = f"http://127.0.0.1:{server.server_address[1]}"
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = Path(tmp.name)
+        self.fetcher = self.new_fetcher()
+
+    def new_fetcher(self, **kwargs) -> ImageFetcher:
+        fetcher = ImageFetcher(directory=self.directory, **kwargs)
+        self.addCleanup(fetcher.close)
+        return fetcher
+
+    def requests_to(self, path: str):
+        return [headers for requested, headers in self.server.requests if requested == path]
+
+    def test_connections_are_reused(self):
+        for i in range(5):
+            self.fetcher.fetch(f"{self.base}/slow/{i}.png")
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.fetcher.stats()["requests"], 5)
+
+    def test_requests_per_host_are_bounded(self):
+        fetcher = self.new_fetcher(max_per_host=2, workers=8)
+        results = fetcher.fetch_all([f"{self.base}/slow/{i}.png" for i in range(12)])
+        self.assertTrue(all(isinstance(path, Path) for path in results.values()))
+        self.assertLessEqual(self.server.max_in_flight, 2)
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_etag_revalidation(self):
+        url = f"{self.base}/etag.png"
+        path = self.fetcher.fetch(url)
+        self.assertEqual(path.read_bytes(), self.server.body)
+        # A later run revalidates its download
+        fetcher = self.new_fetcher()
+        self.assertEqual(fetcher.fetch(url), path)
+        self.assertEqual(self.requests_to("/etag.png")[-1].get("If-None-Match"), '"v1"')
+        self.assertEqual(fetcher.stats()["not_modified"], 1)
+        self.assertEqual(fetcher.stats()["downloads"], 0)
+
+    def test_last_modified_revalidation(self):
+        url = f"{self.base}/last-modified.png"
+        path = self.fetcher.fetch(url)
+        self.assertEqual(self.fetcher.fetch(url), path)
+        self.assertEqual(self.requests_to("/last-modified.png")[-1].get("If-Modified-Since"), _LAST_MODIFIED)
+        self.assertEqual(self.fetcher.stats()["not_modified"], 1)
+        self.assertEqual(path.read_bytes(), self.server.body)
+
+    def test_changed_image_is_downloaded_again(self):
+        url = f"{self.base}/slow/changing.png"
+        self.fetcher.fetch(url)
+        self.server.body = _png("blue")
+        # Without validators, every fetch downloads
+        self.assertEqual(self.fetcher.fetch(url).read_bytes(), _png("blue"))
+        self.assertEqual(self.fetcher.stats()["downloads"], 2)
+
+    def test_max_age_is_reused_without_request(self):
+        url = f"{self.base}/fresh.png"
+        path = self.fetcher.fetch(url)
+        fetcher = self.new_fetcher()
+        self.assertEqual(fetcher.fetch(url), path)
+        self.assertEqual(len(self.requests_to("/fresh.png")), 1)
+        self.assertEqual(fetcher.stats()["fresh_hits"], 1)
+
+    def test_redirects_are_followed(self):
+        path = self.fetcher.fetch(f"{self.base}/moved.png")
+        self.assertEqual(path.read_bytes(), self.server.body)
+
+    def test_errors_are_returned_per_url(self):
+        results = self.fetcher.fetch_all([
+            f"{self.base}/etag.png",
+            f"{self.base}/missing.png",
+            f"{self.base}/error.png",
+            "http://127.0.0.1:1/unreachable.png",
+        ])
+        self.assertIsInstance(results[f"{self.base}/etag.png"], Path)
+        self.assertIn("404", str(results[f"{self.base}/missing.png"]))
+        self.assertIn("500", str(results[f"{self.base}/error.png"]))
+        self.assertIsInstance(results["http://127.0.0.1:1/unreachable.png"], OSError)
+
+    def test_images_that_cannot_be_fetched_are_left_as_links(self):
+        converter = WeChatConverter(embed_local_images=True, image_fetcher=self.fetcher)
+        missing = f"{self.base}/missing.png"
+        result = converter.convert(f'<img src="{self.base}/etag.png">\n\n<img src="{missing}">\n')
+        self.assertTrue(result.success, result.errors)
+        self.assertEqual(result.html.count("data:image/png;base64,"), 1)
+        self.assertIn(f'src="{missing}"', result.html)
+        self.assertEqual(len(result.warnings), 1)
+        self.assertIn(missing, result.warnings[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from typing import Tuple
+from unittest import mock
+
+from PIL import Image
+
+from md2wxhtml.processors import image_processor
+
+
+class FitToBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.img = Image.effect_noise((400, 300), 60).convert("RGB")
+        self.qualities = []
+        save = image_processor._save
+
+        def spy(img, output_format, quality):
+            self.qualities.append(quality)
+            return save(img, output_format, quality)
+
+        patcher = mock.patch.object(image_processor, "_save", spy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fit(self, quality: int, ratio: float) -> Tuple[bytes, bytes]:
+        data = image_processor._save(self.img, "JPEG", quality)
+        self.qualities.clear()
+        return image_processor._fit_to_budget(self.img, "JPEG", quality, int(len(data) * ratio), data), data
+
+    def test_fits_budget_below_quality(self):
+        fitted, data = self.fit(85, 0.5)
+        self.assertLessEqual(len(fitted), len(data) * 0.5)
+        self.assertLess(max(self.qualities), 85)
+
+    def test_quality_below_floor_is_not_raised(self):
+        fitted, data = self.fit(10, 0.5)
+        self.assertLessEqual(len(fitted), len(data) * 0.5)
+        self.assertLessEqual(max(self.qualities), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+IncrementalConverter renders a document block by block; its output must be the same as
+WeChatConverter's for the document as a whole.
+"""
+
+import random
+import unittest
+
+from md2wxhtml import IncrementalConverter, WeChatConverter
+
+# Documents whose blocks were once split where the Markdown renderer joins them
+CASES = [
+    # A list starting after an indented code line continues past the blank line
+    "    code\n- z\n\n- w\n",
+    "Para\n- a\n\n- b\n",
+    "- a\n\n- b\n\n    continued\n",
+    "> quote\n\n> more\n",
+    # Raw HTML keeps its blank lines, and unbalanced elements hold the rest
+    "<div>\nopen\n\n\n\nstill open\n</div>\n\nafter\n",
+    "<div>\nopen\n\nnever closed\n",
+    "</div>\n\ntext\n",
+    "<div>a</div>\n<div>\n\nb\n\n</div>\n",
+    "<!-- c\n\nstill comment -->\n\ntext\n",
+    "```python\nx = 1\n\n\ny = 2\n```\n\n- a\n\n- b\n",
+]
+
+# Pieces of the random documents, joined by single newlines
+PIECES = [
+    "Para **b** text.", "- a", "- b：c", "1. one", "2. two", "    code line", "\tcode tab",
+    "```python\nx = 1\n```", "~~~\ntilde\n~~~", "<div>raw</div>", "<div>\nopen", "</div>",
+    "<!-- c -->", "| a | b |\n|---|---|\n| 1 | 2 |", "> quote", "> - ql", "# H", "Title\n---",
+    "---", "    - nested", "  continuation", "", "", "", "https://x.com/a", "[l](http://y.org)",
+    "<span>inline</span>",
+]
+
+
+def random_document(rng: random.Random) -> str:
+    return "\n".join(rng.choice(PIECES) for _ in range(rng.randint(1, 14))) + "\n"
+
+
+class IncrementalConvertTest(unittest.TestCase):
+    def setUp(self):
+        self.converter = WeChatConverter()
+
+    def assertSameAsWhole(self, markdown_text: str) -> None:
+        expected = self.converter.convert(markdown_text).html
+        actual = IncrementalConverter(self.converter).convert(markdown_text).html
+        self.assertEqual(actual, expected, f"for {markdown_text!r}")
+
+    def test_cases(self):
+        for markdown_text in CASES:
+            with self.subTest(markdown_text=markdown_text):
+                self.assertSameAsWhole(markdown_text)
+
+    def test_random_documents(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            markdown_text = random_document(rng)
+            with self.subTest(markdown_text=markdown_text):
+                self.assertSameAsWhole(markdown_text)
+
+    def test_edits_reuse_fragments(self):
+        incremental = IncrementalConverter(self.converter)
+        rng = random.Random(1)
+        markdown_text = random_document(rng)
+        for _ in range(50):
+            markdown_text += random_document(rng)
+            expected = self.converter.convert(markdown_text).html
+            self.assertEqual(incremental.convert(markdown_text).html, expected, f"for {markdown_text!r}")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import tracemalloc
+import unittest
+
+from md2wxhtml import WeChatConverter
+from md2wxhtml.utils.instrumentation import Recorder
+
+
+class TraceMemoryTest(unittest.TestCase):
+    def setUp(self):
+        if tracemalloc.is_tracing():
+            self.skipTest("tracemalloc already tracing")
+
+    def test_overlapping_recorders_keep_tracing(self):
+        first, second = Recorder(trace_memory=True), Recorder(trace_memory=True)
+        first.__enter__()
+        second.__enter__()
+        first.__exit__(None, None, None)
+        self.assertTrue(tracemalloc.is_tracing())
+        with second.stage("work"):
+            data = [bytes(1000) for _ in range(100)]
+        second.__exit__(None, None, None)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertGreater(second.stats.stages["work"].peak_bytes, 100 * 1000)
+        del data
+
+    def test_tracing_started_elsewhere_is_left_on(self):
+        tracemalloc.start()
+        try:
+            with Recorder(trace_memory=True):
+                pass
+            self.assertTrue(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+
+
+class StagesTest(unittest.TestCase):
+    def test_stages(self):
+        result = WeChatConverter(collect_stats=True).convert("# T\n\nA https://example.com link.\n\n- item\n")
+        stages = list(result.stats.stages)
+        self.assertLess(stages.index("html_parse"), stages.index("autolink"))
+        self.assertLess(stages.index("list_rewrite"), stages.index("spacing"))
+        self.assertNotIn("whitespace", stages)
+        self.assertEqual(result.stats.stages["spacing"].calls, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from md2wxhtml.utils.manifest import Manifest
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        self.image = self.root / "a.png"
+        self.image.write_bytes(b"image data")
+        self.path = self.root / "manifest.json"
+
+    def record(self, manifest: Manifest):
+        fingerprint = manifest.fingerprint("# Doc", [self.image], "options")
+        output = self.root / "doc.html"
+        output.write_text("html")
+        manifest.record("doc.md", fingerprint, output)
+        return fingerprint, output
+
+    def test_unchanged_images_are_not_read_again(self):
+        manifest = Manifest.load(self.path)
+        fingerprint, output = self.record(manifest)
+        manifest.save()
+
+        reloaded = Manifest.load(self.path)
+        with mock.patch.object(Path, "read_bytes", side_effect=AssertionError("image read")):
+            again = reloaded.fingerprint("# Doc", [self.image], "options")
+        self.assertEqual(again, fingerprint)
+        self.assertTrue(reloaded.is_unchanged("doc.md", again, output))
+
+    def test_changed_images_are_hashed_again(self):
+        manifest = Manifest.load(self.path)
+        fingerprint, output = self.record(manifest)
+        manifest.save()
+
+        self.image.write_bytes(b"other image data")
+        again = Manifest.load(self.path).fingerprint("# Doc", [self.image], "options")
+        self.assertNotEqual(again["images"], fingerprint["images"])
+
+    def test_missing_images(self):
+        manifest = Manifest.load(self.path)
+        fingerprint = manifest.fingerprint("# Doc", [self.root / "missing.png"], "options")
+        self.assertEqual(fingerprint["images"], {str(self.root / "missing.png"): None})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import contextlib
+import io
+import json
+import socket
+import tempfile
+import threading
+import unittest
+import urllib.request
+from pathlib import Path
+
+from PIL import Image
+
+from md2wxhtml import WeChatConverter
+from md2wxhtml.serve import ConversionService, ConverterPool, _HTTPServer, serve_main
+
+
+class ConfinedImagesTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        root = Path(tmp.name)
+        self.base_dir = root / "articles"
+        self.base_dir.mkdir()
+        Image.new("RGB", (8, 8), "red").save(self.base_dir / "inside.png")
+        Image.new("RGB", (8, 8), "blue").save(root / "secret.png")
+        self.secret = root / "secret.png"
+        converter = WeChatConverter(embed_local_images=True, confine_images=True)
+        self.service = ConversionService(ConverterPool(converter), base_dir=self.base_dir)
+
+    def convert(self, markdown: str):
+        return self.service.convert(self.service.pool.get(), markdown)
+
+    def test_images_inside_base_dir_are_embedded(self):
+        result = self.convert('<img src="inside.png">\n\n<img src="./inside.png">\n')
+        self.assertTrue(result.success, result.errors)
+        self.assertEqual(result.html.count('src="data:image/png;base64,'), 2)
+
+    def test_images_outside_base_dir_are_rejected(self):
+        for src in ("../secret.png", str(self.secret), "%2E%2E/secret.png"):
+            with self.subTest(src=src):
+                result = self.convert(f'<img src="inside.png">\n\n<img src="{src}">\n')
+                self.assertFalse(result.success)
+                self.assertEqual(len(result.errors), 1)
+                self.assertIn("outside the base directory", result.errors[0])
+                self.assertEqual(result.html.count("data:image"), 1)
+                self.assertNotIn("secret.png", result.image_sizes)
+
+    def test_symlinks_leading_outside_are_rejected(self):
+        (self.base_dir / "link.png").symlink_to(self.secret)
+        result = self.convert('<img src="link.png">\n')
+        self.assertFalse(result.success)
+        self.assertNotIn("data:image", result.html)
+
+    def test_pool_converters_are_confined(self):
+        converter = self.service.pool.get(content_theme="github")
+        self.assertTrue(converter.confine_images)
+        result = self.service.convert(converter, '<img src="../secret.png">\n')
+        self.assertFalse(result.success)
+
+    def test_http_request(self):
+        server = _HTTPServer(("127.0.0.1", 0), self.service)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{server.server_address[1]}/convert",
+            data=f'<img src="{self.secret}">\n'.encode("utf-8"),
+        )
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            urllib.request.urlopen(request, timeout=10)
+        self.assertEqual(raised.exception.code, 422)
+        payload = json.loads(raised.exception.read())
+        self.assertNotIn("data:image", payload["html"])
+
+
+class RequestTest(unittest.TestCase):
+    def setUp(self):
+        service = ConversionService(ConverterPool(WeChatConverter()))
+        server = _HTTPServer(("127.0.0.1", 0), service)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.service = service
+        self.address = server.server_address
+
+    def send(self, head: bytes) -> bytes:
+        with socket.create_connection(self.address, timeout=10) as connection:
+            connection.sendall(head)
+            response = b""
+            while True:
+                data = connection.recv(65536)
+                if not data:
+                    return response
+                response += data
+
+    def test_content_length_must_be_ascii_digits(self):
+        # Header values are decoded as Latin-1, where "²" and "¹" are digits to str.isdigit
+        for length in ("²", "1¹", "-1", "1e3"):
+            with self.subTest(length=length):
+                response = self.send(
+                    f"POST /convert HTTP/1.1\r\nHost: x\r\nContent-Length: {length}\r\n\r\n".encode("latin-1")
+                )
+                self.assertTrue(response.startswith(b"HTTP/1.1 400"), response[:40])
+                self.assertIn(b"Invalid Content-Length", response)
+        self.assertEqual(self.service.bad_requests, 4)
+
+    def test_remote_images_are_not_fetched(self):
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr), self.assertRaises(SystemExit) as raised:
+            serve_main(["--embed-images", "--fetch-remote-images"])
+        self.assertEqual(raised.exception.code, 2)
+        self.assertIn("--fetch-remote-images", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+"""
+convert_to_stream writes the same HTML as convert, block by block.
+"""
+
+import io
+import random
+import unittest
+
+from md2wxhtml import IncrementalConverter, WeChatConverter
+
+from test_incremental import CASES, random_document
+
+
+class ConvertToStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.converter = WeChatConverter()
+
+    def assertStreamsConvert(self, markdown_text: str) -> None:
+        expected = IncrementalConverter(self.converter).convert(markdown_text).html
+        for convert_to_stream in (
+            IncrementalConverter(self.converter).convert_to_stream,
+            self.converter.convert_to_stream,
+        ):
+            out = io.StringIO()
+            convert_to_stream(markdown_text, out)
+            self.assertEqual(out.getvalue(), expected, f"for {markdown_text!r}")
+
+    def test_cases(self):
+        for markdown_text in CASES:
+            with self.subTest(markdown_text=markdown_text):
+                self.assertStreamsConvert(markdown_text)
+
+    def test_random_documents(self):
+        rng = random.Random(2)
+        for _ in range(200):
+            markdown_text = random_document(rng)
+            with self.subTest(markdown_text=markdown_text):
+                self.assertStreamsConvert(markdown_text)
+
+    def test_result_has_no_html(self):
+        out = io.StringIO()
+        result = IncrementalConverter(self.converter).convert_to_stream("# T\n\n- a\n\n- b\n", out)
+        self.assertEqual(result.html, "")
+        self.assertTrue(out.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()